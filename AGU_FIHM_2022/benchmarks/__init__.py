@@ -0,0 +1,10 @@
+"""
+Offline benchmarks for the evaluation workflow.
+
+Run from the AGU_FIHM_2022 directory:
+
+    python -m benchmarks --scale small
+    python -m benchmarks --scale medium --compare benchmarks/results/<commit>_medium.json
+
+Results are saved to benchmarks/results/<commit>_<scale>.json.
+"""
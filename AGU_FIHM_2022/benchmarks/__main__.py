@@ -0,0 +1,77 @@
+"""Run the benchmark cases and save or compare results."""
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from pathlib import Path
+import json
+import platform
+import subprocess
+
+from .cases import CASES, SCALES
+from .runner import time_case, time_case_isolated
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+def current_commit() -> str:
+    """Short hash of the checked out commit, with a suffix if the tree is dirty."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+def compare(results: dict, baseline_file: Path) -> None:
+    """Print the ratio of each case's minimum time to a saved baseline."""
+    with Path(baseline_file).open("r", encoding="utf-8") as fi:
+        baseline = json.load(fi)
+    print(f"\nCompared to {baseline['commit']} ({baseline['scale']}):")
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        ratio = result["min"] / baseline["results"][name]["min"]
+        print(f"{name:<36} {ratio:>8.2f}x")
+
+def main():
+    parser = ArgumentParser(description="Run offline workflow benchmarks.")
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="Only run cases containing this string.")
+    parser.add_argument("--compare", type=Path, help="Saved results to compare against.")
+    parser.add_argument("--output-dir", type=Path, default=RESULTS_DIR)
+    parser.add_argument("--isolate", action="store_true",
+        help="Run each case in its own process to measure peak memory.")
+    args = parser.parse_args()
+
+    # Run cases
+    scale = SCALES[args.scale]
+    results = {
+        "commit": current_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "scale": args.scale,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": {}
+    }
+    for name in CASES:
+        if args.filter not in name:
+            continue
+        runner = time_case_isolated if args.isolate else time_case
+        result = runner(name, scale, args.repeat)
+        if result is not None:
+            results["results"][name] = result
+
+    # Save
+    args.output_dir.mkdir(exist_ok=True, parents=True)
+    ofile = args.output_dir / f"{results['commit']}_{args.scale}.json"
+    with ofile.open("w", encoding="utf-8") as fo:
+        json.dump(results, fo, indent=2)
+    print(f"Saved {ofile}")
+
+    # Compare
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
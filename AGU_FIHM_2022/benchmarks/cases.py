@@ -0,0 +1,457 @@
+"""
+Benchmark cases. Each case has a setup function that builds synthetic inputs
+(not timed) for a given scale and a run function that is timed.
+
+Cases that need optional packages (hydrotools, geopandas) list them in
+requires and are skipped when those packages are not installed.
+"""
+from typing import Any, Callable
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from . import synthetic
+
+@dataclass
+class Case:
+    name: str
+    setup: Callable[[dict], Any]
+    run: Callable[[Any], Any]
+    requires: tuple[str, ...] = ()
+
+CASES: dict[str, Case] = {}
+
+SCALES: dict[str, dict] = {
+    "small": {"n_sites": 10, "years": 1, "days": 10},
+    "medium": {"n_sites": 100, "years": 2, "days": 30},
+    "large": {"n_sites": 1000, "years": 5, "days": 90}
+}
+
+def case(name: str, setup: Callable[[dict], Any], requires: tuple[str, ...] = ()):
+    """Register the decorated function as the timed part of a benchmark case."""
+    def decorator(func):
+        CASES[name] = Case(name=name, setup=setup, run=func, requires=requires)
+        return func
+    return decorator
+
+def threshold_events(series: pd.Series, quantile: float = 0.9) -> pd.DataFrame:
+    """Simple stand-in for list_events: runs of values above a quantile."""
+    above = (series > series.quantile(quantile)).to_numpy()
+    edges = np.diff(above.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    return pd.DataFrame({"start": series.index[starts], "end": series.index[ends]})
+
+# Setup functions
+def setup_observations(scale: dict) -> pd.DataFrame:
+    return synthetic.iv_observations(n_sites=scale["n_sites"], years=scale["years"])
+
+def setup_series(scale: dict) -> pd.Series:
+    return synthetic.hourly_series(years=scale["years"])
+
+def setup_events(scale: dict) -> tuple[pd.Series, pd.DataFrame]:
+    series = synthetic.hourly_series(years=scale["years"])
+    return series, threshold_events(series)
+
+def setup_pairs_inputs(scale: dict) -> tuple[pd.DataFrame, pd.DataFrame]:
+    sim = synthetic.nwm_simulations(n_sites=scale["n_sites"], days=scale["days"])
+    obs = synthetic.iv_observations(n_sites=scale["n_sites"], years=scale["days"] / 365.25 + 0.1,
+        start=str(sim["value_time"].min().date()))
+    sim = sim[["usgs_site_code", "value_time", "value"]].drop_duplicates(
+        ["usgs_site_code", "value_time"], keep="first")
+    obs = obs[["usgs_site_code", "value_time", "value"]].drop_duplicates(
+        ["usgs_site_code", "value_time"], keep="first")
+    obs = obs.groupby(["usgs_site_code", pd.Grouper(key="value_time", freq="1h")],
+        observed=True).first()
+    return sim, obs
+
+def setup_flags(scale: dict) -> pd.DataFrame:
+    n = scale["n_sites"] * scale["days"] * 24
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "usgs_site_code": np.repeat(synthetic.site_codes(scale["n_sites"]), scale["days"] * 24),
+        "obs_flood": rng.random(n) > 0.8,
+        "sim_flood": rng.random(n) > 0.8
+    })
+
+def setup_peak_bias(scale: dict) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.normal(-0.1, 0.3, 50 * scale["years"])
+
+def setup_annual_peaks(scale: dict) -> pd.DataFrame:
+    return synthetic.annual_peaks(n_sites=scale["n_sites"] * 10)
+
+def setup_daily(scale: dict) -> pd.DataFrame:
+    obs = synthetic.iv_observations(n_sites=scale["n_sites"], years=max(scale["years"], 12),
+        step="1h", gap_fraction=0.0, duplicate_fraction=0.0)
+    return obs[["usgs_site_code", "value_time", "value"]]
+
+def setup_svi(scale: dict):
+    from utilities.svi_index import build_svi_index
+    from tempfile import mkdtemp
+    from pathlib import Path
+    rng = np.random.default_rng(0)
+    counties = np.arange(1001, 57000, 17)
+    svi = pd.DataFrame({"fips": counties.astype(str), "theme": "svi",
+        "rank": rng.random(len(counties)), "value": rng.random(len(counties))})
+    index = build_svi_index([svi], Path(mkdtemp()) / "svi_index.npy")
+    sites = synthetic.site_codes(scale["n_sites"])
+    site_fips = pd.Series(rng.choice(counties, len(sites)).astype(str), index=sites)
+    rows = pd.Series(np.repeat(sites, scale["days"] * 24)).astype("category")
+    return rows, site_fips, index
+
+def setup_waterwatch(scale: dict) -> tuple[pd.DataFrame, pd.DataFrame]:
+    stats = synthetic.waterwatch_statistics(n_sites=scale["n_sites"])
+    stats = stats[stats["time_of_year"] == "06-01"]
+    rng = np.random.default_rng(0)
+    flows = pd.DataFrame({"site_no": stats["site_no"].to_numpy(),
+        "streamflow": rng.lognormal(3.0, 1.5, len(stats))})
+    return flows, stats
+
+# Cases
+@case("resample_hourly_first", setup_observations)
+def resample_hourly_first(df):
+    df = df[["usgs_site_code", "value_time", "value"]]
+    df = df.drop_duplicates(["usgs_site_code", "value_time"], keep="first")
+    return df.groupby(["usgs_site_code", pd.Grouper(key="value_time", freq="1h")],
+        observed=True).first()
+
+@case("event_detection_list_events", setup_series, requires=("hydrotools",))
+def event_detection_list_events(series):
+    from hydrotools.events.event_detection import decomposition as ev
+    return ev.list_events(series, halflife="6h", window="7D",
+        minimum_event_duration="6h", start_radius="7h")
+
+@case("event_detection_numpy", setup_series)
+def event_detection_numpy(series):
+    from utilities.event_detection import list_events
+    return list_events(series, halflife="6h", window="7D",
+        minimum_event_duration="6h", start_radius="7h", engine="numpy")
+
+@case("event_detection_numba", setup_series, requires=("numba",))
+def event_detection_numba(series):
+    from utilities.event_detection import list_events
+    return list_events(series, halflife="6h", window="7D",
+        minimum_event_duration="6h", start_radius="7h", engine="numba")
+
+@case("peak_extraction_apply", setup_events)
+def peak_extraction_apply(data):
+    series, events = data
+    return events.apply(lambda e: series.loc[e.start:e.end].max(), axis=1)
+
+@case("peak_extraction_reduceat", setup_events)
+def peak_extraction_reduceat(data):
+    series, events = data
+    values = series.to_numpy()
+    starts = series.index.get_indexer(events["start"])
+    ends = series.index.get_indexer(events["end"])
+    bounds = np.stack((starts, ends + 1), axis=1).ravel()
+    return np.maximum.reduceat(np.append(values, -np.inf), bounds)[::2]
+
+@case("baseflow_straight_line_loop", setup_series)
+def baseflow_straight_line_loop(series):
+    # Same recurrence as straight_line.py, on a one-month window
+    values = series.iloc[:720].to_numpy()
+    baseflow = values.copy()
+    for i in range(1, len(values)):
+        baseflow[i] = min(baseflow[i-1] + 0.04, values[i])
+    return baseflow
+
+@case("baseflow_straight_line_cummin", setup_series)
+def baseflow_straight_line_cummin(series):
+    # Closed form of the recurrence b[i] = min(b[i-1] + c, q[i])
+    values = series.iloc[:720].to_numpy()
+    ramp = 0.04 * np.arange(len(values))
+    return ramp + np.minimum.accumulate(values - ramp)
+
+@case("pairing", setup_pairs_inputs)
+def pairing(data):
+    sim, obs = data
+    pairs = sim.set_index(["usgs_site_code", "value_time"])
+    pairs = pairs.rename(columns={"value": "sim"})
+    pairs["obs"] = obs["value"]
+    pairs = pairs[pairs >= 0.0]
+    return pairs.dropna().reset_index()
+
+@case("contingency_groupby_apply", setup_flags, requires=("hydrotools",))
+def contingency_groupby_apply(pairs):
+    from hydrotools.metrics import metrics
+    return pairs.groupby("usgs_site_code").apply(
+        lambda c: metrics.compute_contingency_table(c.obs_flood, c.sim_flood))
+
+@case("contingency_bincount", setup_flags)
+def contingency_bincount(pairs):
+    codes, sites = pd.factorize(pairs["usgs_site_code"])
+    cell = 2 * pairs["obs_flood"].to_numpy(dtype=np.int64) + pairs["sim_flood"].to_numpy(dtype=np.int64)
+    counts = np.bincount(4 * codes + cell, minlength=4 * len(sites)).reshape(-1, 4)
+    return pd.DataFrame(counts[:, [3, 1, 2, 0]], index=sites, columns=[
+        "true_positive", "false_positive", "false_negative", "true_negative"])
+
+@case("bootstrap_median", setup_peak_bias)
+def bootstrap_median(values):
+    rng = np.random.default_rng(0)
+    samples = values[rng.integers(0, len(values), (1000, len(values)))]
+    return np.percentile(np.median(samples, axis=1), [2.5, 97.5])
+
+@case("flood_frequency_lp3", setup_annual_peaks)
+def flood_frequency_lp3(peaks):
+    from utilities.flood_frequency import recurrence_table
+    return recurrence_table(peaks)
+
+@case("low_flow_statistics", setup_daily)
+def low_flow_statistics(df):
+    from utilities.low_flow import low_flow_statistics
+    return low_flow_statistics(df, start_month=10)
+
+@case("svi_attach", setup_svi, requires=("geopandas",))
+def svi_attach(data):
+    from utilities.svi_index import attach_svi
+    return attach_svi(*data)
+
+@case("waterwatch_classify_loop", setup_waterwatch)
+def waterwatch_classify_loop(data):
+    flows, stats = data
+    classes = []
+    for (_, f), (_, s) in zip(flows.iterrows(), stats.iterrows()):
+        classes.append(pd.cut([f["streamflow"]], bins=s["values"], right=False))
+    return classes
+
+def setup_retrospective(scale: dict):
+    from utilities.retrospective import make_fixture, get_retrospective
+    from tempfile import mkdtemp
+    from pathlib import Path
+    workdir = Path(mkdtemp())
+    ds = make_fixture(workdir / "chrtout.zarr", n_features=scale["n_sites"],
+        n_times=24 * 365 * scale["years"])
+    ids = ds["feature_id"].values[::2]
+    get_retrospective(ids, cache_dir=workdir / "cache", url=str(workdir / "chrtout.zarr"))
+    return ids, workdir
+
+@case("retrospective_cache_read", setup_retrospective, requires=("xarray", "zarr"))
+def retrospective_cache_read(data):
+    from utilities.retrospective import get_retrospective
+    ids, workdir = data
+    return get_retrospective(ids, cache_dir=workdir / "cache", url=str(workdir / "chrtout.zarr"))
+
+def setup_panel(scale: dict):
+    obs = synthetic.iv_observations(n_sites=scale["n_sites"], years=max(scale["years"], 5),
+        step="1h", start="2015-10-01", gap_fraction=0.0, duplicate_fraction=0.0)
+    return obs[["usgs_site_code", "value_time", "value"]]
+
+@case("annual_extremes_vectorized", setup_panel)
+def annual_extremes_vectorized(df):
+    from utilities.annual_extremes import annual_extremes
+    return annual_extremes(df, durations=(7,), site="usgs_site_code")
+
+@case("annual_extremes_resample", setup_panel)
+def annual_extremes_resample(df):
+    results = {}
+    for site, s in df.groupby("usgs_site_code", observed=True):
+        s = s.set_index("value_time")["value"]
+        daily = s.resample("1D").mean().rolling(7, min_periods=7).mean()
+        results[site] = pd.DataFrame({
+            "max": s.resample("YS-OCT").max(),
+            "min_7d": daily.resample("YS-OCT").min()
+        })
+    return pd.concat(results)
+
+def setup_annual_matrix(scale: dict) -> np.ndarray:
+    from scipy.stats import pearson3
+    rng = np.random.default_rng(0)
+    n_sites = scale["n_sites"] * 10
+    skew = rng.uniform(-1.0, 2.0, (n_sites, 1))
+    matrix = pearson3.rvs(skew, loc=10.0, scale=3.0, size=(n_sites, 40), random_state=rng)
+    matrix[rng.random(matrix.shape) < 0.1] = np.nan
+    return matrix
+
+@case("pearson3_fit_scipy", setup_annual_matrix)
+def pearson3_fit_scipy(matrix):
+    # Per-series maximum likelihood as in the example notebooks, first 20 series
+    from scipy.stats import pearson3
+    return [pearson3.ppf(0.1, *pearson3.fit(r[~np.isnan(r)])) for r in matrix[:20]]
+
+@case("pearson3_fit_lmoments", setup_annual_matrix)
+def pearson3_fit_lmoments(matrix):
+    from utilities.distributions import fit_pearson3, pearson3_ppf
+    return pearson3_ppf(fit_pearson3(matrix, method="lmoments"), [0.1, 1.0 - 1.0 / 1.5])
+
+def setup_raw_pairs_inputs(scale: dict) -> tuple[pd.DataFrame, pd.DataFrame]:
+    sim = synthetic.nwm_simulations(n_sites=scale["n_sites"], days=scale["days"])
+    obs = synthetic.iv_observations(n_sites=scale["n_sites"], years=scale["days"] / 365.25 + 0.1,
+        start=str(sim["value_time"].min().date()))
+    return sim, obs
+
+@case("pairs_pipeline_pandas", setup_raw_pairs_inputs)
+def pairs_pipeline_pandas(data):
+    # Cleaning and pairing as in main.py before Arrow tables
+    sim, obs = data
+    sim = sim[["usgs_site_code", "value_time", "value"]]
+    sim = sim.drop_duplicates(["usgs_site_code", "value_time"], keep="first")
+    sim = sim.groupby(["usgs_site_code", pd.Grouper(key="value_time", freq="1h")],
+        observed=True).first().reset_index()
+    sim = sim[sim["usgs_site_code"].astype(str).str.isdigit()]
+    sim.loc[:, "value"] = sim["value"].div(0.3048 ** 3.0)
+    obs = obs[["usgs_site_code", "value_time", "value"]]
+    obs = obs.drop_duplicates(["usgs_site_code", "value_time"], keep="first")
+    obs = obs.groupby(["usgs_site_code", pd.Grouper(key="value_time", freq="1h")],
+        observed=True).first()
+    pairs = sim.set_index(["usgs_site_code", "value_time"])
+    pairs = pairs.rename(columns={"value": "sim"})
+    pairs["obs"] = obs["value"]
+    pairs = pairs[pairs >= 0.0]
+    return pairs.dropna().reset_index()
+
+@case("pairs_pipeline_arrow", setup_raw_pairs_inputs, requires=("pyarrow",))
+def pairs_pipeline_arrow(data):
+    import pyarrow.compute as pc
+    from utilities.arrow_tables import from_pandas, hourly_first, pair
+    sim, obs = data
+    columns = ["usgs_site_code", "value_time", "value"]
+    sim = from_pandas(sim, columns=columns)
+    keep = pc.match_substring_regex(sim["usgs_site_code"], r"^\d+$")
+    sim = hourly_first(sim, keep=keep.to_numpy(zero_copy_only=False))
+    sim = sim.set_column(2, "value", pc.divide(sim["value"], 0.3048 ** 3.0))
+    return pair(sim, hourly_first(from_pandas(obs, columns=columns)))
+
+def setup_site_reads(scale: dict):
+    from utilities.hourly_store import HourlyStore
+    from tempfile import mkdtemp
+    from pathlib import Path
+    obs = synthetic.iv_observations(n_sites=scale["n_sites"], years=min(scale["years"], 2),
+        step="1h", gap_fraction=0.0, duplicate_fraction=0.0)
+    obs = obs[["usgs_site_code", "value_time", "value"]].astype({"usgs_site_code": str})
+    workdir = Path(mkdtemp())
+    store = HourlyStore.create(workdir / "obs.hourly", start=obs["value_time"].min())
+    store.write(obs)
+    rng = np.random.default_rng(0)
+    sites = rng.choice(store.sites, 20)
+    return obs, workdir, sites
+
+def setup_site_reads_hdf(scale: dict):
+    obs, workdir, sites = setup_site_reads(scale)
+    obs.to_hdf(workdir / "obs.h5", key="obs", format="table",
+        data_columns=["usgs_site_code"], complevel=1)
+    return workdir, sites
+
+@case("site_reads_hdf5", setup_site_reads_hdf, requires=("tables",))
+def site_reads_hdf5(data):
+    workdir, sites = data
+    with pd.HDFStore(workdir / "obs.h5", mode="r") as store:
+        return [store.select("obs", where=f"usgs_site_code == '{s}'") for s in sites]
+
+@case("site_reads_mmap", lambda scale: setup_site_reads(scale)[1:])
+def site_reads_mmap(data):
+    from utilities.hourly_store import HourlyStore
+    workdir, sites = data
+    store = HourlyStore(workdir / "obs.hourly")
+    return [store.read(s) for s in sites]
+
+def setup_forecast_pairs(scale: dict) -> pd.DataFrame:
+    # Six-hourly forecasts out to 72 hours paired with observations
+    rng = np.random.default_rng(0)
+    n_forecasts = min(scale["days"], 30) * 4
+    n = scale["n_sites"] * n_forecasts * 72
+    obs = rng.lognormal(3.0, 1.0, n)
+    return pd.DataFrame({
+        "usgs_site_code": np.repeat(synthetic.site_codes(scale["n_sites"]), n_forecasts * 72),
+        "lead_hours": np.tile(np.arange(1, 73), scale["n_sites"] * n_forecasts),
+        "sim": obs * rng.lognormal(0.0, 0.3, n),
+        "obs": obs
+    })
+
+@case("lead_metrics_groupby_apply", setup_forecast_pairs)
+def lead_metrics_groupby_apply(pairs):
+    def cell_metrics(group):
+        error = group["sim"] - group["obs"]
+        return pd.Series({
+            "root_mean_squared_error": np.sqrt(np.mean(error ** 2)),
+            "nash_sutcliffe_efficiency": 1.0 - np.sum(error ** 2) /
+                np.sum((group["obs"] - group["obs"].mean()) ** 2)
+        })
+    return pairs.groupby(["usgs_site_code", "lead_hours"])[["sim", "obs"]].apply(cell_metrics)
+
+@case("lead_metrics_bincount", setup_forecast_pairs, requires=("pyarrow",))
+def lead_metrics_bincount(pairs):
+    import pyarrow as pa
+    from utilities.forecast_verification import LeadVerifier
+    verifier = LeadVerifier(pairs["usgs_site_code"].unique(), range(1, 73))
+    verifier.add(pa.Table.from_pandas(pairs, preserve_index=False))
+    return verifier.metrics()
+
+def setup_cycles(scale: dict) -> pd.DataFrame:
+    df = synthetic.nwm_simulations(n_sites=scale["n_sites"], days=scale["days"])
+    return df[["usgs_site_code", "reference_time", "value_time", "value"]]
+
+@case("cycle_dedup_drop_duplicates", setup_cycles)
+def cycle_dedup_drop_duplicates(df):
+    # Hash-based dedup in concat order, then one value per site and hour
+    df = df.drop_duplicates(["usgs_site_code", "value_time"], keep="first")
+    return df.groupby(["usgs_site_code", pd.Grouper(key="value_time", freq="1h")],
+        observed=True)["value"].first()
+
+def setup_cycles_arrow(scale: dict):
+    # Pipeline stages receive the cycles as an Arrow table
+    from utilities.arrow_tables import from_pandas
+    return from_pandas(setup_cycles(scale))
+
+@case("cycle_dedup_sorted_keys", setup_cycles_arrow, requires=("pyarrow",))
+def cycle_dedup_sorted_keys(table):
+    # Cycle policy resolved in the same sort as the hourly values
+    from utilities.arrow_tables import hourly_first, cycle_rank
+    return hourly_first(table, rank=cycle_rank(table, "latest"))
+
+def setup_raw_obs(scale: dict) -> pd.DataFrame:
+    obs = synthetic.iv_observations(n_sites=scale["n_sites"], years=min(scale["years"], 2),
+        step="1h", start="2015-10-01", gap_fraction=0.02, duplicate_fraction=0.01)
+    return obs[["usgs_site_code", "value_time", "value"]]
+
+@case("quality_control_per_site", setup_raw_obs)
+def quality_control_per_site(df):
+    # Resample, count gaps, and fill one site at a time
+    results = {}
+    for site, s in df.groupby("usgs_site_code", observed=True):
+        duplicates = s["value_time"].duplicated().sum()
+        s = s.set_index("value_time")["value"].resample("1h").first()
+        gaps = s.isna().groupby(s.notna().cumsum()).transform("sum")
+        filled = s.interpolate(limit_area="inside").where(s.notna() | (gaps <= 3))
+        results[site] = (duplicates, s.count(), filled.count())
+    return results
+
+@case("quality_control_panel", setup_raw_obs)
+def quality_control_panel(df):
+    from utilities.quality_control import quality_control
+    return quality_control(df, max_gap=3, method="linear")
+
+def setup_stage(scale: dict):
+    from utilities.rating_curves import power_ratings
+    ratings, params = power_ratings(n_sites=scale["n_sites"])
+    times = pd.date_range("2021-08-01", periods=12 * 24 * scale["days"], freq="5min")
+    sites = np.array(sorted(params))
+    rng = np.random.default_rng(0)
+    stage = pd.DataFrame({
+        "usgs_site_code": np.repeat(sites, len(times)),
+        "value_time": np.tile(times, len(sites)),
+        "value": np.repeat([params[s][1] for s in sites], len(times)) +
+            rng.uniform(0.0, 20.0, len(sites) * len(times))
+    })
+    return ratings, stage
+
+@case("rating_per_site_interp", setup_stage)
+def rating_per_site_interp(data):
+    # Log-log interpolation one site at a time
+    ratings, stage = data
+    results = []
+    for site, rating in ratings.groupby("site_no"):
+        e = rating["stage"].iloc[0]
+        x, y = np.log(rating["stage"].to_numpy()[1:] - e), np.log(rating["discharge"].to_numpy()[1:])
+        h = stage.loc[stage["usgs_site_code"] == site, "value"].to_numpy()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            results.append(np.exp(np.interp(np.log(h - e), x, y, right=np.nan)))
+    return np.concatenate(results)
+
+@case("rating_site_offset_search", setup_stage)
+def rating_site_offset_search(data):
+    from utilities.rating_curves import RatingTable
+    ratings, stage = data
+    return RatingTable(ratings).discharge(stage["usgs_site_code"], stage["value"])
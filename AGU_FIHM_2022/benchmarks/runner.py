@@ -0,0 +1,48 @@
+"""Time a single benchmark case, in this process or a fresh one."""
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import find_spec
+from time import perf_counter
+import multiprocessing
+
+import numpy as np
+
+from utilities.profiling import peak_rss_mb
+from .cases import CASES
+
+def time_case(name: str, scale: dict, repeat: int) -> Optional[dict]:
+    """Set up a case once and time repeat runs. Returns None if skipped."""
+    case = CASES[name]
+    missing = [r for r in case.requires if find_spec(r) is None]
+    if missing:
+        print(f"{name:<36} skipped (requires {', '.join(missing)})")
+        return None
+
+    # Setup is not timed
+    data = case.setup(scale)
+    setup_rss = peak_rss_mb()
+
+    # Time runs
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        case.run(data)
+        times.append(perf_counter() - start)
+    result = {
+        "min": float(np.min(times)),
+        "median": float(np.median(times)),
+        "repeat": repeat,
+        "peak_rss_growth_mb": peak_rss_mb() - setup_rss
+    }
+    print(f"{name:<36} {result['min']:>10.4f} s (median {result['median']:.4f} s)")
+    return result
+
+def time_case_isolated(name: str, scale: dict, repeat: int) -> Optional[dict]:
+    """Run time_case in a fresh process, so the peak memory growth after
+    setup is attributable to this case alone."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        result = pool.submit(time_case, name, scale, repeat).result()
+    if result is not None:
+        print(f"{'':<36} {result['peak_rss_growth_mb']:>10.1f} MiB peak memory growth")
+    return result
@@ -0,0 +1,215 @@
+"""
+Synthetic stand-ins for the data returned by the USGS and NWM services used in
+this workflow. Every generator is seeded so benchmarks are reproducible offline.
+"""
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from scipy.signal import lfilter
+
+def site_codes(n_sites: int) -> npt.NDArray[np.str_]:
+    """Unique 8-digit USGS-like site codes."""
+    return np.array([f"{1000000 + 7919 * i:08d}" for i in range(n_sites)])
+
+def streamflow_matrix(
+    n_sites: int,
+    n_steps: int,
+    step_hours: float = 1.0,
+    recession_hours: float = 24.0,
+    storms_per_year: float = 40.0,
+    seed: int = 0
+) -> npt.NDArray[np.float64]:
+    """Generate a sites x time matrix of positive streamflow in ft^3/s
+    with storm hydrographs superimposed on a seasonal baseflow.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Storm impulses arrive as a Poisson process with lognormal volumes
+    rate = storms_per_year * step_hours / 8766.0
+    impulses = rng.poisson(rate, size=(n_sites, n_steps)) * rng.lognormal(
+        mean=5.0, sigma=1.0, size=(n_sites, n_steps))
+
+    # Linear reservoir response
+    k = np.exp(-step_hours / recession_hours)
+    quickflow = lfilter([1.0 - k], [1.0, -k], impulses, axis=1)
+
+    # Seasonal baseflow scaled per site
+    phase = 2.0 * np.pi * np.arange(n_steps) * step_hours / 8766.0
+    scale = rng.lognormal(mean=3.0, sigma=1.0, size=(n_sites, 1))
+    baseflow = scale * (1.0 + 0.5 * np.sin(phase)[np.newaxis, :])
+    return baseflow + scale * quickflow
+
+def iv_observations(
+    n_sites: int = 10,
+    years: float = 1.0,
+    step: str = "15min",
+    start: str = "2020-10-01",
+    gap_fraction: float = 0.01,
+    mean_gap_steps: int = 16,
+    duplicate_fraction: float = 0.01,
+    seed: int = 0
+) -> pd.DataFrame:
+    """Instantaneous values in the long format returned by IVDataService.get.
+
+    Parameters
+    ----------
+    n_sites: int, optional
+        Number of sites.
+    years: float, optional
+        Length of record.
+    step: str, optional
+        Reporting interval as a pandas frequency string.
+    start: str, optional
+        First value time.
+    gap_fraction: float, optional
+        Approximate fraction of values removed in contiguous gaps.
+    mean_gap_steps: int, optional
+        Mean gap length in time steps.
+    duplicate_fraction: float, optional
+        Fraction of rows repeated, as happens with overlapping requests.
+    seed: int, optional
+        Random seed.
+    """
+    rng = np.random.default_rng(seed)
+    step_td = pd.Timedelta(step)
+    n_steps = int(pd.Timedelta(days=365.25 * years) / step_td)
+    times = pd.date_range(start, periods=n_steps, freq=step_td)
+    values = streamflow_matrix(n_sites, n_steps,
+        step_hours=step_td / pd.Timedelta("1h"), seed=seed)
+
+    # Remove contiguous gaps
+    keep = np.ones((n_sites, n_steps), dtype=bool)
+    n_gaps = int(gap_fraction * n_steps / max(mean_gap_steps, 1))
+    for s in range(n_sites):
+        starts = rng.integers(0, n_steps, n_gaps)
+        lengths = rng.geometric(1.0 / max(mean_gap_steps, 1), n_gaps)
+        for a, n in zip(starts, lengths):
+            keep[s, a:a+n] = False
+    site_idx, time_idx = np.nonzero(keep)
+
+    # Repeat some rows
+    n_dup = int(duplicate_fraction * len(site_idx))
+    dup = rng.integers(0, len(site_idx), n_dup)
+    site_idx = np.concatenate((site_idx, site_idx[dup]))
+    time_idx = np.concatenate((time_idx, time_idx[dup]))
+
+    codes = site_codes(n_sites)
+    return pd.DataFrame({
+        "value_time": times[time_idx],
+        "variable_name": "streamflow",
+        "usgs_site_code": pd.Categorical(codes[site_idx], categories=codes),
+        "measurement_unit": "ft3/s",
+        "value": np.round(values[site_idx, time_idx], 2).astype(np.float32),
+        "qualifiers": "['A']",
+        "series": 0
+    })
+
+def nwm_simulations(
+    n_sites: int = 10,
+    days: int = 10,
+    start: str = "2021-08-26",
+    lookback_hours: int = 28,
+    noise: float = 0.2,
+    seed: int = 0
+) -> pd.DataFrame:
+    """Hourly analysis_assim_extend_no_da style simulations in the format
+    returned by NWMDataService.get, one cycle per day at 16Z covering the
+    previous lookback_hours, so consecutive cycles overlap.
+    """
+    rng = np.random.default_rng(seed + 1)
+    reference_times = pd.date_range(start, periods=days, freq="1D") + pd.Timedelta("16h")
+    first = reference_times[0] - pd.Timedelta(hours=lookback_hours - 1)
+    n_steps = int((reference_times[-1] - first) / pd.Timedelta("1h")) + 1
+    truth = streamflow_matrix(n_sites, n_steps, seed=seed) * 0.3048 ** 3.0
+    codes = site_codes(n_sites)
+
+    # One frame per cycle
+    frames = []
+    for rt in reference_times:
+        offset = int((rt - first) / pd.Timedelta("1h"))
+        t = np.arange(offset - lookback_hours + 1, offset + 1)
+        values = truth[:, t] * rng.lognormal(0.0, noise, size=(n_sites, len(t)))
+        frames.append(pd.DataFrame({
+            "reference_time": rt,
+            "value_time": np.tile(first + pd.to_timedelta(t, unit="h"), n_sites),
+            "nwm_feature_id": np.repeat(np.arange(n_sites) + 101, len(t)),
+            "value": values.ravel().astype(np.float32),
+            "usgs_site_code": np.repeat(codes, len(t)),
+            "configuration": "analysis_assim_extend_no_da",
+            "measurement_unit": "m3/s",
+            "variable_name": "streamflow"
+        }))
+    df = pd.concat(frames, ignore_index=True)
+    df["usgs_site_code"] = df["usgs_site_code"].astype("category")
+    return df
+
+def annual_peaks(
+    n_sites: int = 10,
+    years: int = 50,
+    min_years: int = 5,
+    missing_day_fraction: float = 0.02,
+    seed: int = 0
+) -> pd.DataFrame:
+    """Raw RDB-style annual peaks as returned by AnnualPeakService.get,
+    with string columns and some dates of unknown month and day.
+    """
+    rng = np.random.default_rng(seed + 2)
+    codes = site_codes(n_sites)
+    lengths = rng.integers(min_years, years + 1, n_sites)
+    site = np.repeat(codes, lengths)
+    year = np.concatenate([np.arange(2020 - n + 1, 2021) for n in lengths])
+
+    # Log-normal peaks with site-specific scale
+    scale = np.repeat(rng.normal(3.0, 0.7, n_sites), lengths)
+    peak = 10.0 ** rng.normal(scale, 0.3)
+
+    # Dates, some with unknown month and day
+    doy = rng.integers(0, 365, len(site))
+    dates = (pd.to_datetime(year.astype(str)) + pd.to_timedelta(doy, unit="D")).strftime("%Y-%m-%d")
+    dates = np.where(rng.random(len(site)) < missing_day_fraction,
+        pd.Index(year.astype(str)) + "-00-00", dates)
+    return pd.DataFrame({
+        "agency_cd": "USGS",
+        "site_no": site,
+        "peak_dt": dates,
+        "peak_tm": "",
+        "peak_va": np.char.mod("%.0f", peak),
+        "peak_cd": ""
+    })
+
+def waterwatch_statistics(
+    n_sites: int = 10,
+    percentiles: tuple[int, ...] = (5, 10, 25, 50, 75, 90, 95),
+    seed: int = 0
+) -> pd.DataFrame:
+    """Day-of-year streamflow percentile thresholds in the layout parsed by
+    water_watch/main.py: one row per site and time_of_year with lists of
+    percentiles and values.
+    """
+    rng = np.random.default_rng(seed + 3)
+    days = pd.date_range("2020-01-01", "2020-12-31", freq="1D").strftime("%m-%d")
+    codes = site_codes(n_sites)
+
+    # Monotonic thresholds with a seasonal cycle
+    base = rng.lognormal(3.0, 1.0, (n_sites, 1, 1))
+    season = 1.0 + 0.5 * np.sin(2.0 * np.pi * np.arange(len(days)) / len(days))
+    spread = np.exp(np.linspace(-1.5, 1.5, len(percentiles)))
+    values = base * season[np.newaxis, :, np.newaxis] * spread[np.newaxis, np.newaxis, :]
+    return pd.DataFrame({
+        "site_no": np.repeat(codes, len(days)),
+        "time_of_year": np.tile(days, n_sites),
+        "percentiles": [list(percentiles)] * (n_sites * len(days)),
+        "values": [list(np.round(v, 2)) for v in values.reshape(-1, len(percentiles))]
+    })
+
+def hourly_series(
+    years: float = 1.0,
+    start: str = "2019-10-01",
+    seed: Optional[int] = 0
+) -> pd.Series:
+    """Single-site hourly streamflow series like the resampled Little Hope Creek record."""
+    n_steps = int(8766 * years)
+    values = streamflow_matrix(1, n_steps, seed=seed)[0]
+    return pd.Series(values, index=pd.date_range(start, periods=n_steps, freq="1h"), name="value")
@@ -1,26 +1,147 @@
-from cProfile import label
 from hydrotools.nwm_client.gcp import NWMDataService
-from hydrotools.nwis_client.iv import IVDataService
 from hydrotools.metrics import metrics
 from hydrotools.svi_client import SVIClient
 from utilities.SiteService import SiteService
 from utilities.AnnualPeakService import AnnualPeakService
-
+from utilities.flood_frequency import clean_annual_peaks
+from utilities.svi_index import read_attributes, build_svi_index, load_svi_index, attach_svi
+from utilities.profiling import profiled
+from utilities.scheduler import Task, TaskScheduler
+from utilities.request_planner import retrieve_observations
+from utilities.quality_control import quality_control, panel_frame
+from utilities.forecast_verification import LeadVerifier, forecast_pairs, cell_statistics, STATISTICS
+from utilities.rollup import RollupCube
+from utilities.incremental_evaluation import IncrementalEvaluator
+from utilities.approximate import stratified_sample, approximate_metrics, svi_bins
+from utilities.arrow_tables import (from_pandas, to_pandas, hourly_first, pair,
+    site_codes, first_rows, contingency_tables, cycle_rank)
+from utilities import execution
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import matplotlib.pyplot as plt
 from dataclasses import dataclass
 from pathlib import Path
-import geopandas as gpd
-import dask.dataframe as dd
-from dask.distributed import Client
 
 plt.style.use('tableau-colorblind10')
 
 @dataclass
 class WorkflowDefaults:
     store_path: str = "local_data.h5"
+    svi_index_path: str = "gis/svi_index.npy"
+    execution_backend: str = "process"
+    max_workers: int = 4
+    min_parallel_size: int = 1_000_000
+    resumable: bool = True
+    task_dir: str = "tasks"
+    chunk_size: int = 100
+    obs_tile_dir: str = "obs_tiles"
+    max_request_rows: int = 500_000
+    max_concurrent_requests: int = 4
+    forecast_configuration: str = ""
+    forecast_frequency: str = "6h"
+    max_lead_hours: int = 240
+    lead_metrics_path: str = "lead_metrics.csv"
+    cycle_policy: str = "first"
+    rollup_path: str = "evaluation_rollup.arrow"
+    evaluation_state_path: str = "evaluation_state.arrow"
+    sample_fraction: float = 1.0
+    time_fraction: float = 1.0
+    sample_seed: int = 0
+    approximate_path: str = "approximate_svi.csv"
+    quality_report_path: str = "obs_quality.csv"
+    max_gap_hours: int = 3
+    gap_fill_method: str = "linear"
+
+SITE_COLUMNS = ["usgs_site_code", "value_time", "value"]
+FORECAST_COLUMNS = ["usgs_site_code", "reference_time", "value_time", "value"]
+
+def clean_sim(table, policy="first"):
+    # Remove non-streamflow sites, one value per hour from overlapping cycles
+    keep = pc.match_substring_regex(table["usgs_site_code"], r"^\d+$")
+    table = hourly_first(table, keep=keep.to_numpy(zero_copy_only=False),
+        rank=cycle_rank(table, policy))
+
+    # Convert to foot^3/s
+    return table.set_column(2, "value", pc.divide(table["value"], 0.3048 ** 3.0))
+
+def clean_forecast(table):
+    # Remove non-streamflow sites, keep every reference time
+    table = table.filter(pc.match_substring_regex(table["usgs_site_code"], r"^\d+$"))
+
+    # Convert to foot^3/s
+    return table.set_column(3, "value", pc.divide(table["value"], 0.3048 ** 3.0))
+
+def clean_site_data(df):
+    # Map state codes
+    sc = pd.read_csv("USPS_state_codes.csv", dtype=str, comment="#").set_index("fips_cd")
+    df["state_ab"] = df["state_cd"].map(sc["state_ab"])
+
+    # Construct full fips
+    df["fips"] = df["state_cd"].add(df["county_cd"])
+
+    # Clean-up data
+    return df[["site_no", "fips", "state_ab"]].set_index("site_no")
 
-def get_sim(startDT, endDT, store_path):
+def get_svi_attributes(state):
+    # Download state attributes once
+    ofile = Path(f"gis/svi_data_{state}.geojson")
+    print(ofile)
+    if not ofile.exists():
+        client = SVIClient()
+        gdf = client.get(
+            location=state,
+            geographic_scale="county",
+            year="2018",
+            geographic_context="national"
+            )
+
+        # Cannot store categories in GeoJSON format
+        cats = gdf.select_dtypes("category")
+        for col in cats:
+            gdf[col] = gdf[col].astype(str)
+        ofile.parent.mkdir(exist_ok=True, parents=True)
+        gdf.to_file(ofile, driver="GeoJSON")
+    return read_attributes(ofile)
+
+def attach_pairs_svi(pairs, site_fips, svi_index):
+    # Resolve SVI once per site
+    codes, sites = site_codes(pairs["usgs_site_code"])
+    fips, svi = attach_svi(pd.Series(sites), site_fips, svi_index)
+    pairs = pairs.append_column("fips", pa.array(fips[codes]))
+    return pairs.append_column("svi", pa.array(svi[codes]))
+
+def site_metrics(pairs, annual_peaks):
+    # Use the 33.3th percentile of annual peak as a threshold for a categorical evaluation
+    codes, sites = site_codes(pairs["usgs_site_code"])
+    thresholds = annual_peaks.groupby("site_no")["peak_va"].quantile(0.333)
+
+    # Map thresholds
+    threshold = thresholds.reindex(sites).to_numpy()[codes]
+
+    # Apply thresholds
+    with np.errstate(invalid="ignore"):
+        obs_flood = pairs["obs"].to_numpy() >= threshold
+        sim_flood = pairs["sim"].to_numpy() >= threshold
+
+    # Compute contingency tables
+    ct = contingency_tables(codes, sites, obs_flood, sim_flood)
+
+    # Sums for continuous metrics and rollups
+    stats = cell_statistics(codes, len(sites), pairs["sim"].to_numpy(), pairs["obs"].to_numpy())
+    for name, column in zip(STATISTICS[:8], stats[:8]):
+        ct[name] = column
+
+    # Compute some basic metrics
+    ct["POD"] = ct.apply(metrics.probability_of_detection, axis=1)
+    ct["POFA"] = ct.apply(metrics.probability_of_false_alarm, axis=1)
+    ct["TS"] = ct.apply(metrics.threat_score, axis=1)
+    return ct
+
+@profiled()
+def get_sim(startDT, endDT, store_path, policy="first"):
     with pd.HDFStore(store_path) as store:
         # Set key
         key = "sim"
@@ -60,16 +181,9 @@ def get_sim(startDT, endDT, store_path):
             )
 
     # Clean-up simulations
-    df = df[["usgs_site_code", "value_time", "value"]]
-    df = df.drop_duplicates(["usgs_site_code", "value_time"], keep="first")
-    df = df.groupby(["usgs_site_code", pd.Grouper(key="value_time", freq="1H")]).first()
-
-    # Remove non-streamflow sites and convert to foot^3/s
-    df = df.reset_index()
-    df = df[df["usgs_site_code"].str.isdigit()]
-    df.loc[:, "value"] = df["value"].div(0.3048 ** 3.0)
-    return df
+    return clean_sim(from_pandas(df, columns=FORECAST_COLUMNS), policy)
 
+@profiled()
 def get_site_data(sites, store_path):
     with pd.HDFStore(store_path) as store:
         # Set key
@@ -92,17 +206,11 @@ def get_site_data(sites, store_path):
                 format="table",
                 complevel=1
             )
-    
-    # Map state codes
-    sc = pd.read_csv("USPS_state_codes.csv", dtype=str, comment="#").set_index("fips_cd")
-    df["state_ab"] = df["state_cd"].map(sc["state_ab"])
-
-    # Construct full fips
-    df["fips"] = df["state_cd"].add(df["county_cd"])
 
     # Clean-up data
-    return df[["site_no", "fips", "state_ab"]].set_index("site_no")
+    return clean_site_data(df)
 
+@profiled()
 def get_annual_peaks(sites, store_path):
     with pd.HDFStore(store_path) as store:
         # Set key
@@ -127,24 +235,26 @@ def get_annual_peaks(sites, store_path):
             )
 
     # Clean-up data
-    df.loc[:, "peak_va"] = df["peak_va"].apply(float)
-    df.loc[:, "peak_dt"] = pd.to_datetime(df["peak_dt"], errors="coerce")
-    return df[["site_no", "peak_dt", "peak_va"]].dropna()
+    return clean_annual_peaks(df)
 
-def get_obs(sites, startDT, endDT, store_path):
+@profiled()
+def get_obs(sites, startDT, endDT, store_path, tile_dir, max_rows, max_concurrency,
+    max_gap, method):
     with pd.HDFStore(store_path) as store:
         # Set key
         key = "obs"
 
-        # Retrieve data
+        # Retrieve data in planned requests
         if key in store:
             df = store[key]
         else:
-            client = IVDataService()
-            df = client.get(
+            df = retrieve_observations(
+                sites=sites,
                 startDT=startDT,
                 endDT=endDT,
-                sites=sites
+                tile_dir=tile_dir,
+                max_rows=max_rows,
+                max_concurrency=max_concurrency
             )
             store.put(
                 value=df,
@@ -154,57 +264,26 @@ def get_obs(sites, startDT, endDT, store_path):
             )
 
     # Clean-up data
-    df = df[["usgs_site_code", "value_time", "value"]]
-    df = df.drop_duplicates(["usgs_site_code", "value_time"], keep="first")
-    return df.groupby(["usgs_site_code", pd.Grouper(key="value_time", freq="1H")]).first()
-
-def get_svi(stateCds, store_path):
-    # Check store
-    key = "svi"
-    with pd.HDFStore(store_path) as store:
-        # Retrieve data
-        if key in store:
-            all_data = store[key]
-        else:
-            # Retrieve data
-            gdfs = []
-            for s in stateCds:
-                ofile = Path(f"gis/svi_data_{s}.geojson")
-                print(ofile)
-                if ofile.exists():
-                    gdfs.append(gpd.read_file(ofile))
-                else:
-                    client = SVIClient()
-                    gdf = client.get(
-                        location=s,
-                        geographic_scale="county",
-                        year="2018",
-                        geographic_context="national"
-                        )
-
-                    # Cannot store categories in GeoJSON format
-                    cats = gdf.select_dtypes("category")
-                    for col in cats:
-                        gdf[col] = gdf[col].astype(str)
-                    gdf.to_file(ofile, driver="GeoJSON")
-                    gdfs.append(gdf)
-            
-            # Merge data data
-            all_data = pd.concat(gdfs, ignore_index=True)
-            all_data = pd.DataFrame(all_data.drop("geometry", axis=1))
-
-            # Save
-            store.put(
-                value=all_data,
-                key=key,
-                format="table",
-                complevel=1
-            )
+    return clean_obs(from_pandas(df, columns=SITE_COLUMNS), startDT, endDT, max_gap, method)
+
+@profiled()
+def get_svi(stateCds, index_path):
+    # Check index
+    if Path(index_path).exists():
+        index = load_svi_index(index_path)
+    else:
+        # Retrieve attribute tables and build index
+        frames = [get_svi_attributes(s) for s in stateCds]
+        index = build_svi_index(frames, index_path)
 
     # Clean-up
-    all_data = all_data[all_data["theme"] == "svi"]
-    return pd.DataFrame(all_data[["fips", "rank", "value"]]).set_index("fips")
+    return pd.DataFrame({
+        "fips": index["fips"],
+        "rank": index["rank"],
+        "value": index["value"]
+    }).set_index("fips")
 
+@profiled()
 def get_pairs(startDT, endDT, WORKFLOW_DEFAULTS):
     with pd.HDFStore(WORKFLOW_DEFAULTS.store_path) as store:
         # Set key
@@ -212,15 +291,16 @@ def get_pairs(startDT, endDT, WORKFLOW_DEFAULTS):
 
         # Check store
         if key in store:
-            return store[key]
+            return from_pandas(store[key])
 
         # Get simulations
         sim = get_sim(
             startDT=startDT,
             endDT=endDT,
-            store_path=WORKFLOW_DEFAULTS.store_path
+            store_path=WORKFLOW_DEFAULTS.store_path,
+            policy=WORKFLOW_DEFAULTS.cycle_policy
         )
-        sites = sim["usgs_site_code"].astype(str).unique()
+        _, sites = site_codes(sim["usgs_site_code"])
 
         # Get site information
         site_data = get_site_data(
@@ -233,25 +313,25 @@ def get_pairs(startDT, endDT, WORKFLOW_DEFAULTS):
             sites=sites,
             startDT=startDT,
             endDT=endDT,
-            store_path=WORKFLOW_DEFAULTS.store_path
+            store_path=WORKFLOW_DEFAULTS.store_path,
+            tile_dir=WORKFLOW_DEFAULTS.obs_tile_dir,
+            max_rows=WORKFLOW_DEFAULTS.max_request_rows,
+            max_concurrency=WORKFLOW_DEFAULTS.max_concurrent_requests,
+            max_gap=WORKFLOW_DEFAULTS.max_gap_hours,
+            method=WORKFLOW_DEFAULTS.gap_fill_method
         )
 
         # Retrieve SVI data
-        svi = get_svi(stateCds=site_data.dropna()["state_ab"].unique(), 
-            store_path=WORKFLOW_DEFAULTS.store_path)
+        get_svi(stateCds=site_data.dropna()["state_ab"].unique(), 
+            index_path=WORKFLOW_DEFAULTS.svi_index_path)
+        svi_index = load_svi_index(WORKFLOW_DEFAULTS.svi_index_path)
 
         # Pair data
-        pairs = sim.set_index(["usgs_site_code", "value_time"])
-        pairs = pairs.rename(columns={"value": "sim"})
-        pairs["obs"] = obs["value"]
-        pairs = pairs[pairs >= 0.0]
-        pairs = pairs.dropna().reset_index()
-        pairs["fips"] = pairs["usgs_site_code"].map(site_data["fips"])
-        pairs["svi"] = pairs["fips"].map(svi["rank"])
+        pairs = attach_pairs_svi(pair(sim, obs), site_data["fips"], svi_index)
 
         # Save
         store.put(
-            value=pairs,
+            value=to_pandas(pairs),
             key=key,
             format="table",
             complevel=1
@@ -298,6 +378,51 @@ def make_xy(x, y, xlabel, ylabel, ofile):
     # Close
     plt.close(fig)
 
+def make_errorbars(x, y, lower, upper, xlabel, ylabel, ofile):
+    # Set font size
+    plt.rc('font', size=8)
+
+    # Get figure and axes
+    fig, ax = plt.subplots(figsize=(6.4, 3.6), dpi=300)
+
+    # Plot x vs. y with intervals
+    ax.errorbar(x, y, yerr=[y - lower, upper - y], fmt="o", capsize=3)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    fig.tight_layout()
+
+    # Save
+    plt.savefig(ofile)
+
+    # Close
+    plt.close(fig)
+
+def plot_svi_coverage(gage_svi, gage_fips, svi):
+    # Assess gage counts
+    gages = gage_svi[gage_svi >= 0.0]
+
+    # Plot SVI of NWM Assimilation Gages
+    make_hist(
+        arr=gages,
+        xlabel="National SVI Rank",
+        ylabel="Number of NWM Assimilation Gages",
+        ofile="plots/svi_nwm_gages.png"
+    )
+
+    # Find ungaged counties
+    mask = svi["fips"].isin(np.unique(gage_fips))
+    svi = svi[~mask]
+    svi = svi[svi["rank"] >= 0.0]
+
+    # Plot counties with no NWM gages
+    make_hist(
+        arr=svi["rank"],
+        xlabel="National SVI Rank",
+        ylabel="Number of Counties w/o NWM Assimilation Gage",
+        ofile="plots/svi_nwm_counties.png"
+    )
+
+@profiled()
 def evaluate(startDT, endDT, WORKFLOW_DEFAULTS):
     with pd.HDFStore(WORKFLOW_DEFAULTS.store_path) as store:
         # Set key
@@ -309,74 +434,25 @@ def evaluate(startDT, endDT, WORKFLOW_DEFAULTS):
 
         # Get pairs
         pairs = get_pairs(startDT, endDT, WORKFLOW_DEFAULTS)
-
-        # Assess gage counts
-        gages = pairs.drop_duplicates(["usgs_site_code"], keep="first")
-        gages = gages[gages["svi"] >= 0.0]
-
-        # Plot SVI of NWM Assimilation Gages
-        make_hist(
-            arr=gages["svi"],
-            xlabel="National SVI Rank",
-            ylabel="Number of NWM Assimilation Gages",
-            ofile="plots/svi_nwm_gages.png"
-        )
+        codes, sites = site_codes(pairs["usgs_site_code"])
 
         # Get site information
         site_data = get_site_data(
-            sites=pairs["usgs_site_code"],
+            sites=sites,
             store_path=WORKFLOW_DEFAULTS.store_path
         )
 
         # Retrieve SVI data
         svi = get_svi(stateCds=site_data.dropna()["state_ab"].unique(), 
-            store_path=WORKFLOW_DEFAULTS.store_path).reset_index()
-
-        # Find ungaged counties
-        mask = svi["fips"].isin(pairs["fips"])
-        svi = svi[~mask]
-        svi = svi[svi["rank"] >= 0.0]
-
-        # Plot counties with no NWM gages
-        make_hist(
-            arr=svi["rank"],
-            xlabel="National SVI Rank",
-            ylabel="Number of Counties w/o NWM Assimilation Gage",
-            ofile="plots/svi_nwm_counties.png"
-        )
-
-        # Use the 33.3th percentile of annual peak as a threshold for a categorical evaluation
-        annual_peaks = get_annual_peaks(pairs["usgs_site_code"].astype(str).unique(), WORKFLOW_DEFAULTS.store_path)
-        thresholds = annual_peaks.groupby("site_no").quantile(0.333)
-
-        # Map thresholds
-        pairs["threshold"] = pairs["usgs_site_code"].map(thresholds["peak_va"])
-
-        # Apply thresholds
-        pairs["obs_flood"] = (pairs["obs"] >= pairs["threshold"])
-        pairs["sim_flood"] = (pairs["sim"] >= pairs["threshold"])
+            index_path=WORKFLOW_DEFAULTS.svi_index_path).reset_index()
 
-        # Convert categories to string
-        pairs.loc[:, "usgs_site_code"] = pairs["usgs_site_code"].astype(str)
+        # Plot SVI of gages and ungaged counties
+        first = first_rows(codes)
+        plot_svi_coverage(pairs["svi"].to_numpy()[first], pairs["fips"].to_numpy()[first], svi)
 
-        # Setup default dask client
-        dask_client = Client(n_workers=4, threads_per_worker=1)
-
-        # Compute contingency tables
-        meta = {
-            "true_positive": "int64",
-            "false_positive": "int64",
-            "false_negative": "int64",
-            "true_negative": "int64"
-        }
-        dask_pairs = dd.from_pandas(pairs[["usgs_site_code", "obs_flood", "sim_flood"]], npartitions=4).persist()
-        ct = dask_pairs.groupby("usgs_site_code").apply(lambda c: metrics.compute_contingency_table(c.obs_flood, c.sim_flood), 
-            meta=meta).compute()
-
-        # Compute some basic metrics
-        ct["POD"] = ct.apply(metrics.probability_of_detection, axis=1)
-        ct["POFA"] = ct.apply(metrics.probability_of_false_alarm, axis=1)
-        ct["TS"] = ct.apply(metrics.threat_score, axis=1)
+        # Compute categorical metrics
+        annual_peaks = get_annual_peaks(sites, WORKFLOW_DEFAULTS.store_path)
+        ct = site_metrics(pairs, annual_peaks)
 
         # Save
         store.put(
@@ -388,30 +464,355 @@ def evaluate(startDT, endDT, WORKFLOW_DEFAULTS):
 
         return ct
 
+# Restartable tasks, each result is saved under WorkflowDefaults.task_dir
+def fetch_sim(rt):
+    client = NWMDataService()
+    df = client.get(reference_time=rt, configuration="analysis_assim_extend_no_da")
+    return from_pandas(df, columns=FORECAST_COLUMNS)
+
+def combine_sim(*tables, policy):
+    return clean_sim(pa.concat_tables(tables), policy)
+
+def fetch_forecast(rt, configuration):
+    df = NWMDataService().get(reference_time=rt, configuration=configuration)
+    return clean_forecast(from_pandas(df, columns=FORECAST_COLUMNS))
+
+def fetch_site_data(sites):
+    return clean_site_data(SiteService().get(np.asarray(sites)))
+
+def combine_site_data(*frames):
+    return pd.concat(frames)
+
+def site_strata(sites, site_data, index_path):
+    # State and SVI decile of every site
+    site_data = site_data[~site_data.index.duplicated()]
+    _, svi = attach_svi(pd.Series(sites), site_data["fips"], load_svi_index(index_path))
+    bins = pd.Series(svi_bins(svi), index=sites, name="svi_bin")
+    state = site_data["state_ab"].reindex(sites).fillna("NA")
+    return state + "_" + bins.map("{:.1f}".format), bins
+
+def fetch_obs(sites, startDT, endDT, tile_dir, max_rows, max_concurrency):
+    df = retrieve_observations(sites, startDT, endDT, tile_dir,
+        max_rows=max_rows, max_concurrency=max_concurrency)
+    return from_pandas(df, columns=SITE_COLUMNS)
+
+def clean_obs(table, startDT, endDT, max_gap, method):
+    # First valid value of each hour, only gaps up to max_gap hours filled
+    sites, hours, filled, _ = quality_control(to_pandas(table), max_gap=max_gap, method=method,
+        start=startDT, end=pd.Timestamp(endDT) + pd.Timedelta("23h"))
+    return from_pandas(panel_frame(sites, hours, filled))
+
+def obs_quality(table, startDT, endDT, max_gap, method):
+    # Per-site report on the raw observations of the whole period
+    return quality_control(to_pandas(table), max_gap=max_gap, method=method,
+        start=startDT, end=pd.Timestamp(endDT) + pd.Timedelta("23h"))[3]
+
+def fetch_annual_peaks(sites):
+    return clean_annual_peaks(AnnualPeakService().get(np.asarray(sites)))
+
+def combine_svi(*frames, index_path):
+    index = build_svi_index(frames, index_path)
+    return pd.DataFrame({"fips": index["fips"], "rank": index["rank"], "value": index["value"]})
+
+def make_pairs(sim, obs, site_data, svi, sites, index_path):
+    # Simulations of this chunk's sites
+    sim = sim.filter(pc.is_in(sim["usgs_site_code"], value_set=pa.array(sites)))
+    return attach_pairs_svi(pair(sim, obs), site_data["fips"], load_svi_index(index_path))
+
+def evaluate_chunk(pairs, annual_peaks):
+    # Metrics with the SVI of each site
+    ct = site_metrics(pairs, annual_peaks)
+    codes, sites = site_codes(pairs["usgs_site_code"])
+    first = first_rows(codes)
+    ct["svi"] = pd.Series(pairs["svi"].to_numpy()[first], index=sites)
+    ct["fips"] = pd.Series(pairs["fips"].to_numpy()[first], index=sites)
+    return ct
+
+def verify_forecast_tasks(scheduler, startDT, endDT, n_chunks, prefix, WORKFLOW_DEFAULTS):
+    # Forecasts, one task per reference time
+    configuration = WORKFLOW_DEFAULTS.forecast_configuration
+    times = pd.date_range(start=startDT, end=endDT, freq=WORKFLOW_DEFAULTS.forecast_frequency)
+    tasks = [Task(f"forecast/{configuration}/{rt}", fetch_forecast, args=(rt, configuration))
+        for rt in times.strftime("%Y%m%dT%HZ")]
+    run_tasks(scheduler, tasks)
+
+    # Observations and flood thresholds of all chunks
+    obs = pa.concat_tables([scheduler.result(f"{prefix}obs/{i}") for i in range(n_chunks)])
+    peaks = pd.concat([scheduler.result(f"{prefix}annual_peaks/{i}") for i in range(n_chunks)])
+    thresholds = peaks.groupby("site_no")["peak_va"].quantile(0.333)
+
+    # Statistics by site and lead time, one memory-mapped forecast at a time
+    _, sites = site_codes(obs["usgs_site_code"])
+    verifier = LeadVerifier(sites, range(1, WORKFLOW_DEFAULTS.max_lead_hours + 1), thresholds)
+    for t in tasks:
+        verifier.add(forecast_pairs(scheduler.result(t.key), obs))
+    return verifier
+
+def update_evaluation_state(scheduler, n_chunks, state_path):
+    # Fold each chunk's pairs into the running statistics, hours already
+    # folded by an earlier run are skipped
+    evaluator = IncrementalEvaluator.load(state_path) or IncrementalEvaluator()
+    for i in range(n_chunks):
+        peaks = scheduler.result(f"annual_peaks/{i}")
+        thresholds = peaks.groupby("site_no")["peak_va"].quantile(0.333)
+        evaluator.add(scheduler.result(f"pairs/{i}"), thresholds)
+    evaluator.save(state_path)
+    return evaluator
+
+def run_tasks(scheduler, tasks):
+    # Finished tasks are kept, so a rerun resumes where this one stopped
+    status = scheduler.run(tasks)
+    unfinished = sorted(k for k, s in status.items() if s != "done")
+    if unfinished:
+        raise RuntimeError(f"{len(unfinished)} unfinished tasks, see "
+            f"{scheduler.manifest_path} and rerun to resume: {unfinished[:10]}")
+
+@profiled()
+def evaluate_tasks(startDT, endDT, WORKFLOW_DEFAULTS):
+    scheduler = TaskScheduler(WORKFLOW_DEFAULTS.task_dir)
+    index_path = WORKFLOW_DEFAULTS.svi_index_path
+    tile_dir = str(Path(WORKFLOW_DEFAULTS.task_dir) / "obs_tiles")
+
+    # Simulations, one task per reference time
+    times = pd.date_range(start=startDT, end=endDT, freq="1D") + pd.Timedelta("16h")
+    rts = times.strftime("%Y%m%dT%HZ")
+    sim_tasks = [Task(f"sim/{rt}", fetch_sim, args=(rt,)) for rt in rts]
+    sim_tasks.append(Task("sim", combine_sim, kwargs={"policy": WORKFLOW_DEFAULTS.cycle_policy},
+        depends=tuple(t.key for t in sim_tasks)))
+    run_tasks(scheduler, sim_tasks)
+
+    # Site information, one task per chunk of sites
+    _, sites = site_codes(scheduler.result("sim")["usgs_site_code"])
+    chunks = [tuple(sites[i:i + WORKFLOW_DEFAULTS.chunk_size])
+        for i in range(0, len(sites), WORKFLOW_DEFAULTS.chunk_size)]
+    site_tasks = [Task(f"site_data/{i}", fetch_site_data, args=(c,)) for i, c in enumerate(chunks)]
+    site_tasks.append(Task("site_data", combine_site_data, depends=tuple(t.key for t in site_tasks)))
+    run_tasks(scheduler, site_tasks)
+    site_data = scheduler.result("site_data")
+
+    # SVI, one task per state
+    states = sorted(site_data.dropna()["state_ab"].unique())
+    svi_tasks = [Task(f"svi/{s}", get_svi_attributes, args=(s,)) for s in states]
+    svi_tasks.append(Task("svi", combine_svi, kwargs={"index_path": index_path},
+        depends=tuple(t.key for t in svi_tasks)))
+    run_tasks(scheduler, svi_tasks)
+
+    # Approximate mode, only a stratified sample of sites from here on, with
+    # task keys of their own for each fraction and seed
+    approximate = WORKFLOW_DEFAULTS.sample_fraction < 1.0
+    prefix = ""
+    if approximate:
+        prefix = f"sample/{WORKFLOW_DEFAULTS.sample_fraction:g}_{WORKFLOW_DEFAULTS.sample_seed}/"
+        strata, svi_bin = site_strata(sites, site_data, index_path)
+        sample = stratified_sample(strata, WORKFLOW_DEFAULTS.sample_fraction,
+            seed=WORKFLOW_DEFAULTS.sample_seed)
+        sites = sample.index.to_numpy()
+        chunks = [tuple(sites[i:i + WORKFLOW_DEFAULTS.chunk_size])
+            for i in range(0, len(sites), WORKFLOW_DEFAULTS.chunk_size)]
+
+    # Observations, peaks, pairs, and metrics for every chunk
+    tasks = []
+    for i, c in enumerate(chunks):
+        tasks += [
+            Task(f"{prefix}obs_raw/{i}", fetch_obs, args=(c, startDT, endDT, tile_dir,
+                WORKFLOW_DEFAULTS.max_request_rows, WORKFLOW_DEFAULTS.max_concurrent_requests)),
+            Task(f"{prefix}obs/{i}", clean_obs, args=(startDT, endDT,
+                WORKFLOW_DEFAULTS.max_gap_hours, WORKFLOW_DEFAULTS.gap_fill_method),
+                depends=(f"{prefix}obs_raw/{i}",)),
+            Task(f"{prefix}quality/{i}", obs_quality, args=(startDT, endDT,
+                WORKFLOW_DEFAULTS.max_gap_hours, WORKFLOW_DEFAULTS.gap_fill_method),
+                depends=(f"{prefix}obs_raw/{i}",)),
+            Task(f"{prefix}annual_peaks/{i}", fetch_annual_peaks, args=(c,)),
+            Task(f"{prefix}pairs/{i}", make_pairs, args=(c, index_path),
+                depends=("sim", f"{prefix}obs/{i}", "site_data", "svi")),
+            Task(f"{prefix}evaluation/{i}", evaluate_chunk,
+                depends=(f"{prefix}pairs/{i}", f"{prefix}annual_peaks/{i}"))
+        ]
+    run_tasks(scheduler, tasks)
+    ct = pd.concat([scheduler.result(f"{prefix}evaluation/{i}") for i in range(len(chunks))])
+
+    # Running per-site statistics across runs of successive periods, and
+    # gaps, duplicates, negative values, and flat lines of the observations,
+    # of full runs only
+    if not approximate:
+        update_evaluation_state(scheduler, len(chunks), WORKFLOW_DEFAULTS.evaluation_state_path)
+        pd.concat([scheduler.result(f"quality/{i}") for i in range(len(chunks))]).to_csv(
+            WORKFLOW_DEFAULTS.quality_report_path)
+
+    # Estimates by SVI decile with bootstrap intervals
+    if approximate:
+        pairs = pa.concat_tables([scheduler.result(f"{prefix}pairs/{i}") for i in range(len(chunks))])
+        peaks = pd.concat([scheduler.result(f"{prefix}annual_peaks/{i}") for i in range(len(chunks))])
+        estimates = approximate_metrics(pairs, peaks.groupby("site_no")["peak_va"].quantile(0.333),
+            sample, svi_bin, time_fraction=WORKFLOW_DEFAULTS.time_fraction,
+            seed=WORKFLOW_DEFAULTS.sample_seed)
+        estimates.to_csv(WORKFLOW_DEFAULTS.approximate_path)
+        make_errorbars(estimates.index, estimates["TS"], estimates["TS_lower"], estimates["TS_upper"],
+            "National Ranked SVI (decile)",
+            f"Critical Success Index ({WORKFLOW_DEFAULTS.sample_fraction:.0%} of sites)",
+            "plots/eval_results_approximate.png"
+            )
+
+    # Plot SVI of gages and ungaged counties
+    plot_svi_coverage(ct["svi"].to_numpy(), ct["fips"].to_numpy(), scheduler.result("svi"))
+
+    # Forecast skill by site and lead time
+    if WORKFLOW_DEFAULTS.forecast_configuration:
+        verifier = verify_forecast_tasks(scheduler, startDT, endDT, len(chunks), prefix,
+            WORKFLOW_DEFAULTS)
+        verifier.metrics().to_csv(WORKFLOW_DEFAULTS.lead_metrics_path)
+        skill = verifier.metrics(pooled=True)
+        make_xy(skill.index, skill["nash_sutcliffe_efficiency"],
+            "Lead Time (hours)",
+            "Nash-Sutcliffe Efficiency",
+            "plots/skill_lead_time.png"
+            )
+    return ct
+
 def main(WORKFLOW_DEFAULTS: WorkflowDefaults):
+    # Start one execution backend for all stages
+    execution.configure(
+        kind=WORKFLOW_DEFAULTS.execution_backend,
+        max_workers=WORKFLOW_DEFAULTS.max_workers,
+        min_parallel_size=WORKFLOW_DEFAULTS.min_parallel_size
+    )
+
     # Evaluation parameters
     startDT = "2021-08-26"
     endDT = "2021-09-06"
 
-    # Get evaluation results
-    ct = evaluate(startDT, endDT, WORKFLOW_DEFAULTS)
+    # Get evaluation results, as restartable tasks with svi
+    if WORKFLOW_DEFAULTS.resumable:
+        ct = evaluate_tasks(startDT, endDT, WORKFLOW_DEFAULTS)
+    else:
+        ct = evaluate(startDT, endDT, WORKFLOW_DEFAULTS)
+
+        # Get pairs
+        pairs = get_pairs(startDT, endDT, WORKFLOW_DEFAULTS)
 
-    # Get pairs
-    pairs = get_pairs(startDT, endDT, WORKFLOW_DEFAULTS)
+        # Map svi to evaluation results
+        codes, sites = site_codes(pairs["usgs_site_code"])
+        first = first_rows(codes)
+        ct["svi"] = pd.Series(pairs["svi"].to_numpy()[first], index=sites)
+        ct["fips"] = pd.Series(pairs["fips"].to_numpy()[first], index=sites)
 
-    # Map svi to evaluation results
-    svi = pairs.drop_duplicates(["usgs_site_code"], keep="first").set_index("usgs_site_code")
-    ct["svi"] = svi["svi"]
-    ct["fips"] = svi["fips"]
+    # Sampled site results are unweighted, their estimates are plotted by
+    # evaluate_tasks and the rollup of full runs is kept
+    if WORKFLOW_DEFAULTS.resumable and WORKFLOW_DEFAULTS.sample_fraction < 1.0:
+        return
+
+    # Roll site results up to county, state, SVI bin, and nation
+    cube = RollupCube.build(ct, fips=ct["fips"], svi=ct["svi"])
+    cube.save(WORKFLOW_DEFAULTS.rollup_path)
 
     # Plot evaluation results vs svi
-    ct = ct.dropna()
-    ct = ct.groupby("fips").mean()
-    make_xy(ct["svi"], ct["TS"], 
+    counties = cube.level("county").dropna(subset=["svi", "TS"])
+    make_xy(counties["svi"], counties["TS"], 
         "National Ranked SVI",
         "Critical Success Index by US County",
         "plots/eval_results_sim.png"
         )
+    bins = cube.level("svi_bin")
+    make_xy(bins["svi"], bins["TS"],
+        "National Ranked SVI",
+        "Critical Success Index by SVI Decile",
+        "plots/eval_results_svi_bins.png"
+        )
+
+# Stand-ins for the web services, used by check_evaluate_tasks. The site and
+# peak services only replace the request, so their get methods are checked
+CHECK_SITES = {"01000001": ("01", "001"), "01000002": ("01", "003"), "06000003": ("06", "001")}
+CHECK_SVI = {"AL": {"01001": 0.2, "01003": 0.7}, "CA": {"06001": 0.5, "06003": 0.9}}
+STUB_CALLS = {}
+
+def _stub_flow(site, times):
+    # Hourly flood pulses, out of phase between sites, in m^3/s
+    hours = (pd.DatetimeIndex(times).as_unit("s").asi8 // 3600).astype(float)
+    return 2.0 + 10.0 * np.exp(-((hours + 7.0 * int(site[-1])) % 48.0 - 24.0) ** 2.0 / 20.0)
+
+def _count(name):
+    STUB_CALLS[name] = STUB_CALLS.get(name, 0) + 1
+
+class _StubNWMDataService:
+    def get(self, reference_time, configuration):
+        _count("sim")
+        rt = pd.Timestamp(reference_time.replace("T", " ").rstrip("Z"))
+        times = pd.date_range(rt - pd.Timedelta("27h"), rt, freq="1h")
+        return pd.concat([pd.DataFrame({"usgs_site_code": s, "reference_time": rt,
+            "value_time": times, "value": 0.9 * _stub_flow(s, times)}) for s in CHECK_SITES],
+            ignore_index=True)
+
+class _StubSiteService(SiteService):
+    def get_dataframe(self, sites, session):
+        _count("site_data")
+        sites = sites.split(",")
+        return pd.DataFrame({"site_no": sites,
+            "state_cd": [CHECK_SITES[s][0] for s in sites],
+            "county_cd": [CHECK_SITES[s][1] for s in sites]})
+
+class _StubAnnualPeakService(AnnualPeakService):
+    def get_dataframe(self, sites, session):
+        _count("annual_peaks")
+        sites = sites.split(",")
+        years = np.arange(1990, 2020)
+        return pd.DataFrame({"site_no": np.repeat(sites, len(years)),
+            "peak_dt": np.tile([f"{y}-06-01" for y in years], len(sites)),
+            "peak_va": np.tile(np.linspace(200.0, 500.0, len(years)), len(sites))})
+
+def _stub_observations(sites, startDT, endDT, tile_dir, **kwargs):
+    _count("obs")
+    times = pd.date_range(startDT, pd.Timestamp(endDT) + pd.Timedelta("23h45min"), freq="15min")
+    return pd.concat([pd.DataFrame({"usgs_site_code": s, "value_time": times,
+        "value": _stub_flow(s, times) / 0.3048 ** 3.0}) for s in sites], ignore_index=True)
+
+def _stub_svi_attributes(state):
+    _count("svi")
+    counties = CHECK_SVI[state]
+    return pd.DataFrame({"fips": list(counties), "theme": "svi",
+        "rank": list(counties.values()), "value": list(counties.values())})
+
+def check_evaluate_tasks():
+    """Run evaluate_tasks end to end on stub services in a temporary
+    directory, then rerun it and check that every task is resumed.
+
+        python -c "import main; main.check_evaluate_tasks()"
+    """
+    from tempfile import TemporaryDirectory
+    import os
+    import shutil
+    stubs = {
+        "NWMDataService": _StubNWMDataService,
+        "SiteService": _StubSiteService,
+        "AnnualPeakService": _StubAnnualPeakService,
+        "retrieve_observations": _stub_observations,
+        "get_svi_attributes": _stub_svi_attributes
+    }
+    originals = {k: globals()[k] for k in stubs}
+    STUB_CALLS.clear()
+    cwd = os.getcwd()
+    execution.configure(kind="serial")
+    with TemporaryDirectory() as workdir:
+        shutil.copy(Path(__file__).resolve().parent / "USPS_state_codes.csv", workdir)
+        os.chdir(workdir)
+        Path("plots").mkdir()
+        globals().update(stubs)
+        try:
+            defaults = WorkflowDefaults(chunk_size=2)
+            ct = evaluate_tasks("2021-08-26", "2021-08-29", defaults)
+            calls = dict(STUB_CALLS)
+            again = evaluate_tasks("2021-08-26", "2021-08-29", defaults)
+        finally:
+            globals().update(originals)
+            os.chdir(cwd)
+
+    # One request per reference time, chunk, and state, none on the rerun
+    assert calls == {"sim": 4, "site_data": 2, "svi": 2, "obs": 2, "annual_peaks": 2}, calls
+    assert STUB_CALLS == calls, STUB_CALLS
+    assert sorted(ct.index) == sorted(CHECK_SITES)
+    assert np.allclose(ct["svi"].reindex(list(CHECK_SITES)), [0.2, 0.7, 0.5])
+    assert ct["TS"].between(0.0, 1.0).all()
+    pd.testing.assert_frame_equal(ct, again)
+    print(ct[["svi", "POD", "POFA", "TS"]])
 
 if __name__ == "__main__":
     WORKFLOW_DEFAULTS = WorkflowDefaults()
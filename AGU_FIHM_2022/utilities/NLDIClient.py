@@ -0,0 +1,42 @@
+from typing import Callable, Optional
+from io import StringIO
+
+import pandas as pd
+import geopandas as gpd
+
+from .http_cache import get_session
+
+class NLDIClient:
+    """Client tool to retrieve data from the Network Linked Data Index API.
+    Responses are cached on disk by utilities.http_cache."""
+    base_url: str = "https://labs.waterdata.usgs.gov/api/nldi"
+
+    def get_data(
+        self,
+        endpoint: str,
+        data_handler: Callable[[StringIO], pd.DataFrame],
+        parameters: Optional[dict[str, str]] = None
+    ) -> pd.DataFrame:
+        """Generic data retrieval method."""
+        with get_session().get(self.base_url + endpoint, params=parameters) as response:
+            response.raise_for_status()
+            return data_handler(StringIO(response.text))
+
+    def get_data_sources(self) -> pd.DataFrame:
+        """Get list of data sources."""
+        return self.get_data("/linked-data", pd.read_json)
+
+    def get_registered_feature(self, feature_source: str, feature_id: str) -> gpd.GeoDataFrame:
+        """Get site information."""
+        return self.get_data(f"/linked-data/{feature_source}/{feature_id}", gpd.read_file)
+
+    def get_basin(self, feature_source: str, feature_id: str, simplified: bool, split_catchment: bool) -> gpd.GeoDataFrame:
+        """Get upstream catchment boundary."""
+        return self.get_data(
+            f"/linked-data/{feature_source}/{feature_id}/basin",
+            gpd.read_file,
+            parameters = {
+                "simplified": str(simplified).lower(),
+                "splitCatchment": str(split_catchment).lower()
+            }
+        )
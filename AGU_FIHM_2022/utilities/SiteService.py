@@ -1,9 +1,10 @@
-import requests
 import pandas as pd
 from io import StringIO
 from time import sleep
 import numpy as np
 
+from .http_cache import get_session
+
 class SiteService:
     base_url: str = "https://waterservices.usgs.gov/nwis/site/"
 
@@ -17,9 +18,10 @@ class SiteService:
             "siteStatus": "all"
             }
 
-        # Get raw compressed data
+        # Get raw compressed data, pausing only after network requests
         with session.get(self.base_url, params=params) as response:
-            sleep(0.2)
+            if not response.from_cache:
+                sleep(0.2)
             return response.text
 
     def get_dataframe(self, sites, session):
@@ -44,32 +46,34 @@ class SiteService:
 
     def get(self, sites, chunk_size=100):
         # Split up site list
+        sites = np.asarray(sites)
         num_chunks = int(len(sites) // chunk_size) + 1
         chunks = np.array_split(sites, num_chunks)
 
-        # Get raw compressed data
-        with requests.Session() as session:
-            # Retrieve chunks
-            dfs = []
-            for idx, c in enumerate(chunks):
-                print(f"Retrieving chunk: {idx}")
-                df = self.get_dataframe(",".join(c), session)
-                dfs.append(df)
+        # Shared session with response cache
+        session = get_session()
+
+        # Retrieve chunks
+        dfs = []
+        for idx, c in enumerate(chunks):
+            print(f"Retrieving chunk: {idx}")
+            df = self.get_dataframe(",".join(c), session)
+            dfs.append(df)
 
-            # Compare to sites
-            retrieved = pd.concat(dfs, ignore_index=True)
-            mask = np.isin(sites, retrieved["site_no"])
-            missing = sites[~mask]
-            print(f"These sites were missing:")
-            print(missing)
+        # Compare to sites
+        retrieved = pd.concat(dfs, ignore_index=True)
+        mask = np.isin(sites, retrieved["site_no"])
+        missing = sites[~mask]
+        print(f"These sites were missing:")
+        print(missing)
 
-            # Retrieve chunks
-            dfs = []
-            for s in missing:
-                print(f"Retrieving missing site: {s}")
-                df = self.get_dataframe(s, session)
-                dfs.append(df)
+        # Retrieve chunks
+        dfs = []
+        for s in missing:
+            print(f"Retrieving missing site: {s}")
+            df = self.get_dataframe(s, session)
+            dfs.append(df)
 
-            # Combine sites
-            dfs.append(retrieved)
-            return pd.concat(dfs, ignore_index=True)
+        # Combine sites
+        dfs.append(retrieved)
+        return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,229 @@
+"""
+Water-year annual extremes for many sites at once.
+
+Annual maximum, minimum, and minimum N-day mean streamflow are computed with
+reductions over a dense site x time matrix using integer year labels, in
+place of per-site resample chains. Years default to water years
+(October-September, labeled by the calendar year in which they end).
+"""
+from typing import Iterable, Iterator, Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+WATER_YEAR_START: int = 10
+
+def year_labels(days: npt.NDArray[np.int64], start_month: int = WATER_YEAR_START) -> npt.NDArray[np.int64]:
+    """Label integer days since 1970-01-01 with the year in which their
+    annual period ends. start_month=10 is the water year (October-September),
+    4 is the climatic year (April-March), and 1 is the calendar year.
+    """
+    months = days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    shifted = months - (start_month - 1)
+    return 1970 + shifted // 12 + (start_month != 1)
+
+def year_lengths(labels: npt.NDArray[np.int64], start_month: int = WATER_YEAR_START) -> npt.NDArray[np.int64]:
+    """Number of days in each labeled year."""
+    first = labels - (start_month != 1)
+    starts = (first - 1970) * 12 + (start_month - 1)
+    starts = starts.astype("datetime64[M]").astype("datetime64[D]")
+    ends = (starts.astype("datetime64[M]") + 12).astype("datetime64[D]")
+    return (ends - starts).astype(np.int64)
+
+def boundaries(labels: npt.NDArray) -> npt.NDArray[np.int64]:
+    """Start position of each run of equal labels in a sorted array."""
+    return np.flatnonzero(np.diff(labels, prepend=labels[0] - 1))
+
+def rolling_mean(matrix: npt.NDArray, window: int) -> npt.NDArray:
+    """Trailing window mean along the last axis. Windows containing any
+    missing value are NaN, matching pandas rolling(min_periods=window).
+    """
+    if window == 1:
+        return matrix
+    valid = ~np.isnan(matrix)
+    pad = np.zeros(matrix.shape[:-1] + (1,))
+    total = np.concatenate((pad, np.cumsum(np.where(valid, matrix, 0.0), axis=-1)), axis=-1)
+    count = np.concatenate((pad, np.cumsum(valid, axis=-1)), axis=-1)
+    result = np.full(matrix.shape, np.nan)
+    window_total = total[..., window:] - total[..., :-window]
+    window_count = count[..., window:] - count[..., :-window]
+    with np.errstate(invalid="ignore"):
+        result[..., window-1:] = np.where(
+            window_count == window, window_total / window, np.nan)
+    return result
+
+def extremes_matrix(
+    matrix: npt.NDArray[np.float64],
+    days: npt.NDArray[np.int64],
+    steps_per_day: int,
+    durations: Iterable[int] = (7,),
+    start_month: int = WATER_YEAR_START,
+    min_fraction: float = 0.9,
+    raw: bool = True
+) -> tuple[npt.NDArray[np.int64], dict[str, npt.NDArray[np.float64]]]:
+    """Annual extremes of a dense, regular site x time matrix.
+
+    Parameters
+    ----------
+    matrix: numpy.ndarray
+        Site x time values with NaN for missing steps.
+    days: numpy.ndarray
+        Integer day since 1970-01-01 of each time step (column).
+    steps_per_day: int
+        Number of time steps per day.
+    durations: iterable of int, optional
+        Window lengths in days of the minimum N-day means, computed from
+        daily means (as for 7Q10).
+    start_month: int, optional
+        First month of the annual period.
+    min_fraction: float, optional
+        Years with fewer valid values than this fraction of the year are NaN.
+    raw: bool, optional
+        Include the annual maximum and minimum of the step values.
+
+    Returns
+    -------
+    Year labels and a dict of site x year matrices keyed by "max", "min",
+    "min_<N>d", and "completeness" (fraction of valid steps).
+    """
+    labels = year_labels(days, start_month)
+    year_starts = boundaries(labels)
+    years = labels[year_starts]
+    expected = year_lengths(years, start_month)[np.newaxis, :]
+    results = {}
+
+    # Annual extremes of step values
+    valid = np.add.reduceat(~np.isnan(matrix), year_starts, axis=1)
+    completeness = valid / (expected * steps_per_day)
+    complete = completeness >= min_fraction
+    if raw:
+        with np.errstate(invalid="ignore"):
+            results["max"] = np.where(complete, np.fmax.reduceat(matrix, year_starts, axis=1), np.nan)
+            results["min"] = np.where(complete, np.fmin.reduceat(matrix, year_starts, axis=1), np.nan)
+
+    # Daily means
+    durations = list(durations)
+    if durations:
+        if steps_per_day == 1:
+            daily = matrix
+            daily_labels = labels
+        else:
+            day_starts = boundaries(days)
+            counts = np.add.reduceat(~np.isnan(matrix), day_starts, axis=1)
+            totals = np.add.reduceat(np.nan_to_num(matrix), day_starts, axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                daily = np.where(counts > 0, totals / counts, np.nan)
+            daily_labels = labels[day_starts]
+        daily_year_starts = boundaries(daily_labels)
+
+    # Annual minimum N-day means, each assigned to the day its window ends
+    for d in durations:
+        rolled = rolling_mean(daily, d)
+        valid = np.add.reduceat(~np.isnan(rolled), daily_year_starts, axis=1)
+        with np.errstate(invalid="ignore"):
+            minima = np.fmin.reduceat(rolled, daily_year_starts, axis=1)
+        results[f"min_{d}d"] = np.where(valid >= min_fraction * expected, minima, np.nan)
+    results["completeness"] = completeness
+    return years, results
+
+def to_matrix(
+    df: pd.DataFrame,
+    site: str,
+    time: str,
+    value: str,
+    step: Optional[pd.Timedelta] = None
+) -> tuple[pd.Index, npt.NDArray[np.float64], npt.NDArray[np.int64], int]:
+    """Scatter a long table onto a dense site x time matrix on a regular grid
+    aligned to midnight. Duplicate times keep the last value.
+
+    Returns sites, the matrix, the day of each column, and steps per day.
+    """
+    codes, sites = pd.factorize(df[site], sort=True)
+    t = df[time].to_numpy(dtype="datetime64[ns]").view(np.int64)
+    day_ns = int(pd.Timedelta("1D").value)
+    if step is not None:
+        step_ns = int(pd.Timedelta(step).value)
+    else:
+        # Largest step on which every time falls (no sort required)
+        step_ns = int(np.gcd.reduce(t - t.min() // day_ns * day_ns))
+    if step_ns == 0 or day_ns % step_ns != 0:
+        raise ValueError(f"Time step must divide one day, got {pd.Timedelta(step_ns)}")
+
+    # Regular grid of whole days
+    first = t.min() // day_ns * day_ns
+    n_steps = (t.max() // day_ns * day_ns + day_ns - first) // step_ns
+    matrix = np.full((len(sites), n_steps), np.nan)
+    matrix[codes, (t - first) // step_ns] = df[value].to_numpy(dtype=np.float64)
+    days = (first + np.arange(n_steps) * step_ns) // day_ns
+    return sites, matrix, days, day_ns // step_ns
+
+def panel_to_long(panel: pd.DataFrame, site: str = "site", time: str = "value_time", value: str = "value") -> pd.DataFrame:
+    """Melt a time x site panel (e.g. from get_retrospective) to a long table."""
+    long = panel.rename_axis(index=time, columns=site).stack(future_stack=True).rename(value).reset_index()
+    return long.dropna(subset=[value])
+
+def iter_site_chunks(df: pd.DataFrame, site: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Split an in-memory long table into frames of at most chunk_size whole sites."""
+    codes, sites = pd.factorize(df[site])
+    if len(sites) <= chunk_size:
+        yield df
+        return
+    chunk = codes // chunk_size
+    order = np.argsort(chunk, kind="stable")
+    splits = np.flatnonzero(np.diff(chunk[order])) + 1
+    for idx in np.split(order, splits):
+        yield df.iloc[idx]
+
+def annual_extremes(
+    data: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+    durations: Iterable[int] = (7,),
+    start_month: int = WATER_YEAR_START,
+    min_fraction: float = 0.9,
+    step: Optional[pd.Timedelta] = None,
+    chunk_size: int = 1000,
+    site: str = "site",
+    time: str = "value_time",
+    value: str = "value",
+    panel: bool = False
+) -> pd.DataFrame:
+    """Compute water-year annual max, min, and minimum N-day mean for every site.
+
+    Parameters
+    ----------
+    data: pandas.DataFrame or iterable of pandas.DataFrame
+        A long table with site, time, and value columns, a time x site panel
+        (set panel=True), or an iterable of long tables each holding complete
+        records for their sites.
+    durations: iterable of int, optional
+        N-day windows for annual minimum N-day mean flows.
+    start_month: int, optional
+        First month of the annual period, 10 for water years.
+    min_fraction: float, optional
+        Minimum fraction of valid values in a year, otherwise the year's
+        statistics are NaN.
+    step: pandas.Timedelta, optional
+        Time step of the record, inferred from the smallest interval by default.
+    chunk_size: int, optional
+        Number of sites processed at once when data is a single frame.
+
+    Returns
+    -------
+    pandas.DataFrame indexed by (site, water_year) with max, min,
+    min_<N>d, and completeness columns.
+    """
+    if panel:
+        data = panel_to_long(data, site=site, time=time, value=value)
+    if isinstance(data, pd.DataFrame):
+        data = iter_site_chunks(data, site=site, chunk_size=chunk_size)
+
+    frames = []
+    for chunk in data:
+        sites, matrix, days, steps_per_day = to_matrix(chunk, site, time, value, step)
+        years, results = extremes_matrix(matrix, days, steps_per_day, durations,
+            start_month=start_month, min_fraction=min_fraction)
+        frames.append(pd.DataFrame(
+            {k: v.ravel() for k, v in results.items()},
+            index=pd.MultiIndex.from_product([sites, years], names=[site, "water_year"])
+        ))
+    return pd.concat(frames).sort_index()
@@ -0,0 +1,287 @@
+"""
+Approximate evaluation from a stratified sample of sites and time blocks.
+
+Sites are sampled within strata (e.g. state x SVI bin) at a given fraction,
+before any observations are retrieved, so retrieval and pairing cost scale
+with the fraction. Time is split into blocks (days by default) and a
+fraction of blocks is kept. Metrics of each reporting group (e.g. SVI bin)
+are ratios of weighted sums of the STATISTICS of the sampled (site, block)
+cells, each site weighted by the inverse of its stratum's sampling fraction:
+
+    sample = stratified_sample(strata, fraction=0.1)
+    ... retrieve and pair sample.index only ...
+    estimates = approximate_metrics(pairs, thresholds, sample, groups, time_fraction=0.5)
+
+Error bars are percentile intervals of a bootstrap that resamples sites
+within their strata and time blocks, so they account for both sampling
+stages and for dependence between hours of the same site and day.
+"""
+from typing import Iterable, Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+import pyarrow as pa
+
+from .arrow_tables import HOUR_NS, values, epoch_ns, site_codes
+from .forecast_verification import STATISTICS, cell_statistics, metrics_from_statistics
+
+METRICS: tuple[str, ...] = ("TS", "POD", "POFA", "nash_sutcliffe_efficiency")
+
+def svi_bins(svi: npt.ArrayLike, n_bins: int = 10) -> npt.NDArray[np.float64]:
+    """Lower edge of the equal-width bin of each SVI rank, NaN for missing
+    (NaN or negative) ranks."""
+    svi = np.asarray(svi, dtype=np.float64)
+    with np.errstate(invalid="ignore"):
+        edge = np.clip(np.floor(svi * n_bins), 0, n_bins - 1) / n_bins
+        return np.where(svi >= 0.0, edge, np.nan)
+
+def stratified_sample(
+    strata: pd.Series,
+    fraction: float = 0.1,
+    minimum: int = 2,
+    seed: int = 0
+) -> pd.DataFrame:
+    """Sample sites within strata.
+
+    Parameters
+    ----------
+    strata: pandas.Series
+        Stratum label of every site, indexed by site.
+    fraction: float, optional
+        Fraction of each stratum to sample.
+    minimum: int, optional
+        Fewest sites sampled per stratum (all of a smaller stratum), so
+        every stratum contributes and can be bootstrapped.
+    seed: int, optional
+        Random seed.
+
+    Returns
+    -------
+    DataFrame indexed by sampled site with the stratum and the weight
+    (stratum size over sampled sites) of each site.
+    """
+    rng = np.random.default_rng(seed)
+    codes, labels = pd.factorize(strata, sort=True)
+    size = np.bincount(codes, minlength=len(labels))
+    quota = np.minimum(size, np.maximum(np.ceil(fraction * size).astype(np.int64), minimum))
+
+    # Random order within each stratum, keep the first quota sites
+    order = np.lexsort((rng.random(len(codes)), codes))
+    rank = np.arange(len(codes)) - np.searchsorted(codes[order], codes[order])
+    chosen = np.sort(order[rank < quota[codes[order]]])
+    return pd.DataFrame({
+        "stratum": strata.to_numpy()[chosen],
+        "weight": (size / quota)[codes[chosen]]
+    }, index=strata.index[chosen])
+
+def block_statistics(
+    pairs: pa.Table,
+    sites: npt.ArrayLike,
+    thresholds: Optional[pd.Series] = None,
+    block_hours: int = 24,
+    site: str = "usgs_site_code",
+    time: str = "value_time"
+) -> npt.NDArray[np.float64]:
+    """STATISTICS of every (site, time block) cell of pairs, as an array of
+    shape (statistic, site, block). Blocks are block_hours long, counted
+    from the first hour of pairs."""
+    sites = pa.array(np.asarray(sites).astype(str), type=pa.string())
+    codes, _ = site_codes(pairs[site].cast(pa.string()), sites)
+    hours = epoch_ns(pairs[time]) // HOUR_NS
+    blocks = (hours - (hours.min() if len(hours) else 0)) // block_hours
+    n_blocks = int(blocks.max(initial=-1)) + 1
+    keep = np.flatnonzero(codes >= 0)
+    threshold = None
+    if thresholds is not None:
+        threshold = thresholds.reindex(sites.to_numpy(zero_copy_only=False)).to_numpy(
+            dtype=np.float64)[codes[keep]]
+    stats = cell_statistics(codes[keep] * n_blocks + blocks[keep], len(sites) * n_blocks,
+        values(pairs["sim"])[keep], values(pairs["obs"])[keep], threshold)
+    return stats.reshape(len(STATISTICS), len(sites), n_blocks)
+
+def group_sums(
+    stats: npt.NDArray[np.float64],
+    weights: npt.NDArray[np.float64],
+    groups: npt.NDArray[np.int64],
+    n_groups: int,
+    site_counts: Optional[npt.NDArray[np.float64]] = None,
+    block_counts: Optional[npt.NDArray[np.float64]] = None
+) -> npt.NDArray[np.float64]:
+    """Weighted sums of (statistic, site, block) cells by group, shape
+    (statistic, group), or (statistic, replicate, group) when bootstrap
+    counts of sites and blocks (replicate x site, replicate x block) are
+    given."""
+    membership = np.zeros((stats.shape[1], n_groups))
+    membership[np.arange(stats.shape[1]), groups] = weights
+    if site_counts is None:
+        return stats.sum(axis=2) @ membership
+    by_site = np.einsum("rb,ksb->krs", block_counts, stats)
+    return np.einsum("krs,rs,sg->krg", by_site, site_counts, membership)
+
+def bootstrap_counts(
+    strata: npt.NDArray[np.int64],
+    n_blocks: int,
+    n_boot: int,
+    rng: np.random.Generator
+) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]:
+    """Times every site and every block is drawn in each bootstrap
+    replicate. Sites are resampled within their stratum with the rescaling
+    bootstrap of Rao and Wu: n - 1 draws from a stratum of n sampled sites,
+    counts scaled by n / (n - 1), which keeps the variance unbiased for the
+    small per-stratum samples of low fractions. Strata of one site keep it."""
+    order = np.argsort(strata, kind="stable")
+    start = np.searchsorted(strata[order], strata[order], side="left")
+    size = np.searchsorted(strata[order], strata[order], side="right") - start
+    draws = order[start + np.floor(rng.random((n_boot, len(order))) * size).astype(np.int64)]
+
+    # One draw fewer per stratum, except single-site strata
+    first = np.arange(len(order)) == start
+    single = size == 1
+    draws = draws[:, ~first | single]
+    replicate = np.repeat(np.arange(n_boot), draws.shape[1])
+    site_counts = np.bincount(replicate * len(order) + draws.ravel(),
+        minlength=n_boot * len(order)).reshape(n_boot, len(order)).astype(np.float64)
+    scale = np.ones(len(order))
+    scale[order] = np.where(single, 1.0, size / np.maximum(size - 1, 1))
+    site_counts *= scale
+    blocks = rng.integers(0, n_blocks, (n_boot, n_blocks))
+    block_counts = np.bincount((np.arange(n_boot)[:, None] * n_blocks + blocks).ravel(),
+        minlength=n_boot * n_blocks).reshape(n_boot, n_blocks).astype(np.float64)
+    return site_counts, block_counts
+
+def approximate_metrics(
+    pairs: pa.Table,
+    thresholds: Optional[pd.Series],
+    sample: pd.DataFrame,
+    groups: pd.Series,
+    time_fraction: float = 1.0,
+    block_hours: int = 24,
+    n_boot: int = 200,
+    confidence: float = 0.95,
+    metrics: Iterable[str] = METRICS,
+    seed: int = 0
+) -> pd.DataFrame:
+    """Metrics of every group estimated from the pairs of sampled sites,
+    with bootstrap intervals.
+
+    Parameters
+    ----------
+    pairs: pyarrow.Table
+        Pairs (site, time, sim, obs) of the sampled sites.
+    thresholds: pandas.Series, optional
+        Flood threshold of each site for the categorical metrics.
+    sample: pandas.DataFrame
+        Sampled sites with stratum and weight, from stratified_sample.
+    groups: pandas.Series
+        Reporting group (e.g. SVI bin) of each site.
+    time_fraction: float, optional
+        Fraction of time blocks to keep.
+    block_hours: int, optional
+        Length of time blocks.
+    n_boot: int, optional
+        Bootstrap replicates.
+    confidence: float, optional
+        Coverage of the intervals.
+    metrics: iterable of str, optional
+        Metrics of forecast_verification.metrics_from_statistics to report.
+    seed: int, optional
+        Random seed of block sampling and the bootstrap.
+
+    Returns
+    -------
+    DataFrame indexed by group with the number of sampled sites and, for
+    every metric, the estimate and its lower and upper bounds.
+    """
+    rng = np.random.default_rng(seed)
+    stats = block_statistics(pairs, sample.index, thresholds, block_hours)
+
+    # Keep a random fraction of blocks, the same for every site
+    n_blocks = stats.shape[2]
+    kept = np.sort(rng.permutation(n_blocks)[:max(1, int(round(time_fraction * n_blocks)))])
+    stats = stats[:, :, kept]
+
+    # Point estimates, then bootstrap replicates
+    group_codes, group_labels = pd.factorize(groups.reindex(sample.index), sort=True)
+    known = group_codes >= 0
+    stats, group_codes = stats[:, known], group_codes[known]
+    weights = sample["weight"].to_numpy(dtype=np.float64)[known]
+    strata, _ = pd.factorize(sample["stratum"].to_numpy()[known])
+    estimate = metrics_from_statistics(group_sums(stats, weights, group_codes, len(group_labels)))
+    site_counts, block_counts = bootstrap_counts(strata, len(kept), n_boot, rng)
+    if len(kept) == n_blocks:
+        # Every block is kept, time is not sampled
+        block_counts[:] = 1.0
+    replicates = metrics_from_statistics(group_sums(stats, weights, group_codes,
+        len(group_labels), site_counts, block_counts))
+
+    tail = 50.0 * (1.0 - confidence)
+    result = pd.DataFrame({"sites": np.bincount(group_codes, minlength=len(group_labels))},
+        index=pd.Index(group_labels, name=groups.name))
+    for name in metrics:
+        with np.errstate(invalid="ignore"):
+            lower, upper = np.nanpercentile(replicates[name], [tail, 100.0 - tail], axis=0)
+        result[name] = estimate[name]
+        result[f"{name}_lower"] = lower
+        result[f"{name}_upper"] = upper
+    return result
+
+def main():
+    """Validate intervals against the full results of a synthetic network:
+    sites in states and SVI bins whose skill depends on SVI, AR(1) hourly
+    flows, and repeated samples at several fractions."""
+    from time import perf_counter
+    import warnings
+    warnings.simplefilter("ignore", RuntimeWarning)
+    rng = np.random.default_rng(2024)
+    n_sites, n_hours = 2000, 24 * 60
+    sites = pd.Index([f"{i:08d}" for i in range(n_sites)], name="usgs_site_code")
+    state = pd.Series(rng.integers(0, 10, n_sites), index=sites).map("{:02d}".format)
+    svi = rng.random(n_sites)
+    svi_bin = pd.Series(svi_bins(svi), index=sites, name="svi_bin")
+    strata = state + "_" + svi_bin.map("{:.1f}".format)
+
+    # Correlated hourly flows, noisier simulations at higher SVI
+    noise = rng.normal(0.0, 1.0, (n_sites, n_hours))
+    log_flow = np.zeros((n_sites, n_hours))
+    for t in range(1, n_hours):
+        log_flow[:, t] = 0.97 * log_flow[:, t - 1] + 0.25 * noise[:, t]
+    obs = np.exp(3.0 + log_flow)
+    sim = obs * np.exp(rng.normal(0.0, 0.2 + 0.5 * svi[:, None], (n_sites, n_hours)))
+    thresholds = pd.Series(np.quantile(obs, 0.9, axis=1), index=sites)
+    times = pd.date_range("2021-07-01", periods=n_hours, freq="1h")
+    pairs = pa.table({
+        "usgs_site_code": np.repeat(sites.to_numpy(), n_hours),
+        "value_time": np.tile(times, n_sites),
+        "sim": sim.ravel(),
+        "obs": obs.ravel()
+    })
+
+    # Full results
+    start = perf_counter()
+    full = approximate_metrics(pairs, thresholds, pd.DataFrame({"stratum": strata, "weight": 1.0}),
+        svi_bin, n_boot=1)
+    print(f"Full: {perf_counter() - start:.2f} s")
+
+    # Coverage of the intervals over repeated samples
+    for fraction, time_fraction in [(0.05, 1.0), (0.1, 0.5), (0.25, 0.5)]:
+        covered, total, seconds = 0, 0, 0.0
+        for seed in range(10):
+            sample = stratified_sample(strata, fraction, seed=seed)
+            subset = pairs.filter(pa.compute.is_in(pairs["usgs_site_code"],
+                value_set=pa.array(sample.index.to_numpy())))
+            start = perf_counter()
+            estimate = approximate_metrics(subset, thresholds, sample, svi_bin,
+                time_fraction=time_fraction, seed=seed)
+            seconds += perf_counter() - start
+            for name in METRICS:
+                inside = (full[name] >= estimate[f"{name}_lower"]) & (full[name] <= estimate[f"{name}_upper"])
+                covered += inside.sum()
+                total += len(inside)
+        print(f"fraction {fraction:.2f}, time fraction {time_fraction:.1f}: "
+            f"{covered / total:.0%} of intervals cover the full result, {seconds / 10:.2f} s per sample")
+        assert covered / total >= 0.85
+    print(estimate[["sites", "TS", "TS_lower", "TS_upper"]].join(full["TS"].rename("TS_full")))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Arrow tables for the pairing pipeline.
+
+Retrieval, cleaning, pairing, and metrics pass pyarrow Tables between
+stages. Column selection and appending columns are zero-copy, and each
+stage computes integer keys (site codes and epoch hours) with numpy over
+the Arrow buffers, so a stage gathers its output rows with a single take
+instead of the chain of drop_duplicates, set_index, and reset_index
+copies made by the pandas version. Conversion to and from pandas happens
+only at the edges (HDF5 cache, plots, and evaluation tables).
+
+Every full or column copy is reported with profiling.count_copy so stage
+records show how many copies were made and how large they were.
+"""
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .profiling import count_copy
+
+HOUR_NS: int = 3_600_000_000_000
+
+def from_pandas(df: pd.DataFrame, columns: Optional[list[str]] = None) -> pa.Table:
+    """Convert a DataFrame (e.g. read from the HDF5 cache) to a Table.
+    Categorical columns are decoded to plain strings."""
+    if columns is not None:
+        df = df[columns]
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.name, table[i].cast(field.type.value_type))
+    count_copy(table.nbytes)
+    return table
+
+def to_pandas(table: pa.Table) -> pd.DataFrame:
+    """Convert a Table to a DataFrame at the edge of the pipeline."""
+    count_copy(table.nbytes)
+    return table.to_pandas()
+
+def values(column: pa.ChunkedArray) -> npt.NDArray[np.float64]:
+    """Float64 numpy view of a numeric column (a copy only if the column has
+    several chunks or nulls). Nulls become NaN."""
+    return column.to_numpy().astype(np.float64, copy=False)
+
+def epoch_ns(column: pa.ChunkedArray) -> npt.NDArray[np.int64]:
+    """Integer nanoseconds since 1970-01-01 of a timestamp column."""
+    return column.cast(pa.timestamp("ns")).to_numpy().view(np.int64)
+
+def sorted_sites(*columns: pa.ChunkedArray) -> pa.Array:
+    """Sorted unique values of one or more site columns."""
+    chunks = [c for column in columns for c in column.chunks]
+    unique = pc.unique(pa.chunked_array(chunks, type=columns[0].type))
+    return unique.take(pc.sort_indices(unique))
+
+def site_codes(column: pa.ChunkedArray, sites: Optional[pa.Array] = None) -> tuple[npt.NDArray[np.int64], npt.NDArray]:
+    """Encode a site column as integer positions in sites (sorted unique values
+    of the column by default). Returns codes and the site labels, -1 for
+    values not in sites.
+    """
+    if sites is None:
+        sites = sorted_sites(column)
+    codes = pc.index_in(column, value_set=sites).fill_null(-1).to_numpy()
+    return codes.astype(np.int64), sites.to_numpy(zero_copy_only=False)
+
+def first_rows(codes: npt.NDArray[np.int64]) -> npt.NDArray[np.int64]:
+    """Position of the first row of each code, in code order."""
+    _, first = np.unique(codes, return_index=True)
+    return first
+
+def offsets(x: npt.NDArray[np.int64]) -> npt.NDArray[np.int64]:
+    """Integer offsets of x from its minimum in units of their greatest common
+    divisor (e.g. hours for hourly times), small enough to combine into keys."""
+    if not len(x):
+        return x
+    d = x - x.min()
+    step = np.gcd.reduce(d)
+    return d // step if step else d
+
+def sort_rows(keys: list[npt.NDArray[np.int64]]) -> npt.NDArray[np.int64]:
+    """Stable order of rows by non-negative integer keys, most significant
+    first. Keys are packed into one int64 and argsorted when their ranges
+    fit, else sorted with lexsort."""
+    combined = np.zeros(len(keys[0]), dtype=np.int64)
+    total = 1
+    for key in keys:
+        width = int(key.max(initial=0)) + 1
+        total *= width
+        if total >= 2 ** 62:
+            return np.lexsort(keys[::-1])
+        combined *= width
+        combined += key
+    return np.argsort(combined, kind="stable")
+
+# Which overlapping cycle supplies the value of a (site, time)
+CYCLE_POLICIES: tuple[str, ...] = ("first", "latest", "shortest_lead")
+
+def cycle_rank(
+    table: pa.Table,
+    policy: str = "first",
+    time: str = "value_time",
+    reference_time: str = "reference_time"
+) -> Optional[npt.NDArray[np.int64]]:
+    """Preference of every row among overlapping model cycles, lower is
+    preferred and ties keep row order. "first" keeps row order (None),
+    "latest" prefers the latest reference time, and "shortest_lead" the
+    smallest absolute time from reference time to valid time, then the
+    latest reference time.
+    """
+    if policy not in CYCLE_POLICIES:
+        raise ValueError(f"Unknown cycle policy: {policy}")
+    if policy == "first":
+        return None
+    ref = epoch_ns(table[reference_time])
+    latest = offsets(-ref)
+    if policy == "latest":
+        return latest
+    lead = offsets(np.abs(epoch_ns(table[time]) - ref))
+    return lead * (latest.max(initial=0) + 1) + latest
+
+def hourly_first(
+    table: pa.Table,
+    site: str = "usgs_site_code",
+    time: str = "value_time",
+    value: str = "value",
+    keep: Optional[npt.NDArray[np.bool_]] = None,
+    rank: Optional[npt.NDArray[np.int64]] = None,
+    reference_time: str = "reference_time"
+) -> pa.Table:
+    """Keep the first valid value of each site and hour, with times floored
+    to the hour and rows sorted by site and time. Equivalent to
+    drop_duplicates followed by groupby([site, Grouper(freq="1h")]).first().
+
+    keep optionally masks the rows to consider. rank optionally orders the
+    rows within each site and hour (lower first), e.g. from cycle_rank. A
+    reference_time column, if any, is kept after the value column to record
+    the model cycle each value came from.
+    """
+    codes, _ = site_codes(table[site])
+    hours = epoch_ns(table[time]) // HOUR_NS
+    columns = [site, time, value]
+    if reference_time in table.column_names:
+        columns.append(reference_time)
+    table = table.select(columns)
+
+    # Stable sort of the valid rows by (site, hour, rank), first row of each run
+    rows = ~np.isnan(values(table[value]))
+    if keep is not None:
+        rows &= keep
+    rows = np.flatnonzero(rows)
+    keys = [codes[rows], offsets(hours[rows])]
+    if rank is not None:
+        keys.append(rank[rows])
+    rows = rows[sort_rows(keys)]
+    new = np.ones(len(rows), dtype=bool)
+    new[1:] = (np.diff(codes[rows]) != 0) | (np.diff(hours[rows]) != 0)
+    rows = rows[new]
+
+    # One gather, then replace times with the hour
+    result = table.take(rows)
+    count_copy(result.nbytes)
+    floored = pa.array(hours[rows] * HOUR_NS, type=pa.timestamp("ns"))
+    return result.set_column(1, time, floored.cast(table.schema.field(time).type))
+
+def pair(
+    sim: pa.Table,
+    obs: pa.Table,
+    site: str = "usgs_site_code",
+    time: str = "value_time",
+    value: str = "value"
+) -> pa.Table:
+    """Inner join hourly simulations and observations on (site, hour), keeping
+    rows where both values are non-negative. Inputs must be unique on
+    (site, hour), as returned by hourly_first.
+
+    Returns site, time, sim, and obs columns sorted by site and time.
+    """
+    # Integer (site, hour) keys on a shared site dictionary
+    sites = sorted_sites(sim[site], obs[site])
+    sim_codes, _ = site_codes(sim[site], sites)
+    obs_codes, _ = site_codes(obs[site], sites)
+    sim_hours = epoch_ns(sim[time]) // HOUR_NS
+    obs_hours = epoch_ns(obs[time]) // HOUR_NS
+    origin = min(sim_hours.min(initial=0), obs_hours.min(initial=0))
+    span = max(sim_hours.max(initial=0), obs_hours.max(initial=0)) - origin + 1
+    sim_keys = sim_codes * span + (sim_hours - origin)
+    obs_keys = obs_codes * span + (obs_hours - origin)
+
+    # Matching rows, sorted by key
+    _, i_sim, i_obs = np.intersect1d(sim_keys, obs_keys,
+        assume_unique=True, return_indices=True)
+    s = values(sim[value])[i_sim]
+    o = values(obs[value])[i_obs]
+    valid = (s >= 0.0) & (o >= 0.0)
+
+    # Gather keys once and append the value columns
+    pairs = sim.select([site, time]).take(i_sim[valid])
+    pairs = pairs.append_column("sim", pa.array(s[valid]))
+    pairs = pairs.append_column("obs", pa.array(o[valid]))
+    count_copy(pairs.nbytes)
+    return pairs
+
+def contingency_tables(
+    codes: npt.NDArray[np.int64],
+    sites: npt.NDArray,
+    obs_flag: npt.NDArray[np.bool_],
+    sim_flag: npt.NDArray[np.bool_],
+    site: str = "usgs_site_code"
+) -> pd.DataFrame:
+    """Per-site contingency tables with the columns of
+    hydrotools.metrics.compute_contingency_table, counted with bincount."""
+    cell = 2 * obs_flag.astype(np.int64) + sim_flag.astype(np.int64)
+    counts = np.bincount(4 * codes + cell, minlength=4 * len(sites)).reshape(-1, 4)
+    return pd.DataFrame(
+        counts[:, [3, 1, 2, 0]],
+        index=pd.Index(sites, name=site),
+        columns=["true_positive", "false_positive", "false_negative", "true_negative"]
+    )
@@ -0,0 +1,241 @@
+"""
+Pearson Type III fitting for many series at once.
+
+Series are rows of a (sites x years) matrix padded with NaN. Parameters are
+estimated for every row in one vectorized computation by the method of
+moments or by L-moments, and quantiles are evaluated for all rows and
+probabilities together. Maximum likelihood refinement (as in
+scipy.stats.pearson3.fit) is optional and runs row chunks on the shared
+execution backend.
+
+    matrix = segments_to_matrix(codes, values, n_sites)
+    params = fit_pearson3(matrix, method="lmoments")
+    table = pearson3_ppf(params, [0.1, 1.0 / 1.5])
+"""
+from dataclasses import dataclass
+
+import numpy as np
+import numpy.typing as npt
+from scipy.special import gammaln
+from scipy.stats import pearson3
+
+from . import execution
+
+@dataclass
+class Pearson3Params:
+    """Per-series sample size, location (mean), scale (standard deviation),
+    and skew coefficient."""
+    n: npt.NDArray[np.int64]
+    mean: npt.NDArray[np.float64]
+    std: npt.NDArray[np.float64]
+    skew: npt.NDArray[np.float64]
+
+def segments_to_matrix(
+    codes: npt.NDArray[np.int64],
+    values: npt.NDArray[np.float64],
+    n_segments: int
+) -> npt.NDArray[np.float64]:
+    """Pack values grouped by integer codes into a segment x position matrix
+    padded with NaN, e.g. annual maxima of each site in its own row."""
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    n = np.bincount(codes, minlength=n_segments)
+    starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+    matrix = np.full((n_segments, max(n.max(initial=0), 1)), np.nan)
+    matrix[codes, np.arange(len(codes)) - starts[codes]] = values[order]
+    return matrix
+
+def sample_moments(matrix: npt.NDArray[np.float64]) -> Pearson3Params:
+    """Count, mean, and bias corrected standard deviation and skew
+    (Bulletin 17B, eq. 5) of each row, ignoring NaN."""
+    valid = ~np.isnan(matrix)
+    n = valid.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.nansum(matrix, axis=1) / n
+        d = np.where(valid, matrix - mean[:, np.newaxis], 0.0)
+        m2 = np.sum(d * d, axis=1)
+        m3 = np.sum(d * d * d, axis=1)
+        std = np.sqrt(m2 / (n - 1.0))
+        skew = n * m3 / ((n - 1.0) * (n - 2.0) * std ** 3.0)
+    skew = np.where(std > 0.0, skew, 0.0)
+    return Pearson3Params(n, mean, std, skew)
+
+def sample_lmoments(matrix: npt.NDArray[np.float64]) -> tuple[npt.NDArray, ...]:
+    """Count, first two sample L-moments, and L-skewness of each row, ignoring
+    NaN, from unbiased probability weighted moments (Hosking, 1990)."""
+    x = np.sort(matrix, axis=1)
+    n = (~np.isnan(x)).sum(axis=1).astype(np.float64)[:, np.newaxis]
+    x = np.nan_to_num(x)
+
+    # Probability weighted moments b0, b1, b2. NaN sort last, so rank i of
+    # each valid value is its column.
+    i = np.arange(x.shape[1], dtype=np.float64)[np.newaxis, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        b0 = x.sum(axis=1, keepdims=True) / n
+        b1 = np.sum(x * i / (n - 1.0), axis=1, keepdims=True) / n
+        b2 = np.sum(x * i * (i - 1.0) / ((n - 1.0) * (n - 2.0)), axis=1, keepdims=True) / n
+        l1 = b0
+        l2 = 2.0 * b1 - b0
+        t3 = (6.0 * b2 - 6.0 * b1 + b0) / l2
+    t3 = np.where(l2 > 0.0, t3, 0.0)
+    return n[:, 0].astype(np.int64), l1[:, 0], l2[:, 0], t3[:, 0]
+
+def lmoments_to_pearson3(
+    l1: npt.NDArray,
+    l2: npt.NDArray,
+    t3: npt.NDArray
+) -> tuple[npt.NDArray, npt.NDArray, npt.NDArray]:
+    """Pearson Type III mean, standard deviation, and skew from L-moments,
+    using the rational approximations of Hosking and Wallis (1997, A.8)."""
+    # Shape parameter alpha of the underlying gamma distribution
+    t = np.abs(t3)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        z = np.where(t < 1.0 / 3.0, 3.0 * np.pi * t * t, 1.0 - t)
+        alpha = np.where(
+            t < 1.0 / 3.0,
+            (1.0 + 0.2906 * z) / (z + 0.1882 * z ** 2.0 + 0.0442 * z ** 3.0),
+            (0.36067 * z - 0.59567 * z ** 2.0 + 0.25361 * z ** 3.0) /
+                (1.0 - 2.78861 * z + 2.56096 * z ** 2.0 - 0.77045 * z ** 3.0)
+        )
+        ratio = np.exp(0.5 * np.log(alpha) + gammaln(alpha) - gammaln(alpha + 0.5))
+
+    # Symmetric (normal) limit as alpha goes to infinity
+    symmetric = t < 1e-6
+    skew = np.where(symmetric, 0.0, 2.0 * np.sign(t3) / np.sqrt(alpha))
+    std = l2 * np.sqrt(np.pi) * np.where(symmetric, 1.0, ratio)
+    return l1, std, skew
+
+def _mle_task(task: tuple) -> npt.NDArray[np.float64]:
+    rows, guesses = task
+    fitted = np.full((len(rows), 3), np.nan)
+    for k, (row, (mean, std, skew)) in enumerate(zip(rows, guesses)):
+        row = row[~np.isnan(row)]
+        if len(row) < 3 or not std > 0.0:
+            continue
+
+        # From the given estimates and from scipy's own starting point,
+        # keeping the higher likelihood, as the likelihood has local optima
+        fitted[k] = skew, mean, std
+        best = -np.inf
+        for start, options in (((skew,), dict(loc=mean, scale=std)), ((), {})):
+            try:
+                candidate = pearson3.fit(row, *start, **options)
+            except (ValueError, RuntimeError, FloatingPointError):
+                continue
+            loglik = pearson3.logpdf(row, *candidate).sum()
+            if loglik > best:
+                fitted[k], best = candidate, loglik
+    return fitted
+
+def refine_mle(
+    matrix: npt.NDArray[np.float64],
+    params: Pearson3Params,
+    chunk_size: int = 1000
+) -> Pearson3Params:
+    """Refine parameters by maximum likelihood, starting each series from the
+    given estimates. Row chunks run on the shared execution backend
+    (configure a process backend to use multiple cores).
+    """
+    guesses = np.stack((params.mean, params.std, params.skew), axis=1)
+    tasks = [(matrix[i:i+chunk_size], guesses[i:i+chunk_size])
+        for i in range(0, len(matrix), chunk_size)]
+    fitted = execution.get_backend().map(_mle_task, tasks, size=matrix.size)
+    fitted = np.concatenate(fitted) if fitted else np.empty((0, 3))
+    skew, mean, std = fitted.T
+    return Pearson3Params(params.n, mean, std, skew)
+
+def fit_pearson3(
+    matrix: npt.NDArray[np.float64],
+    method: str = "moments",
+    log: bool = False,
+    min_years: int = 10,
+    chunk_size: int = 1000
+) -> Pearson3Params:
+    """Fit a Pearson Type III distribution to every row of a (sites x years)
+    matrix padded with NaN.
+
+    Parameters
+    ----------
+    matrix: numpy.ndarray
+        One series per row, NaN for missing years.
+    method: str, optional
+        "moments" for the method of moments (Bulletin 17B), "lmoments" for
+        L-moments, or "mle" for maximum likelihood refined from the moment
+        estimates.
+    log: bool, optional
+        Fit the log10 of positive values (Log-Pearson Type III).
+    min_years: int, optional
+        Rows with fewer valid values have NaN parameters.
+    chunk_size: int, optional
+        Rows per task for maximum likelihood refinement.
+
+    Returns
+    -------
+    Pearson3Params of per-row arrays.
+    """
+    if log:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            matrix = np.where(matrix > 0.0, np.log10(matrix), np.nan)
+    if method in ("moments", "mle"):
+        params = sample_moments(matrix)
+    elif method == "lmoments":
+        n, l1, l2, t3 = sample_lmoments(matrix)
+        params = Pearson3Params(n, *lmoments_to_pearson3(l1, l2, t3))
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+    # Mask short records before any refinement
+    short = params.n < min_years
+    for a in (params.mean, params.std, params.skew):
+        a[short] = np.nan
+    if method == "mle":
+        params = refine_mle(matrix, params, chunk_size=chunk_size)
+    return params
+
+def pearson3_ppf(
+    params: Pearson3Params,
+    probabilities: npt.ArrayLike,
+    log: bool = False
+) -> npt.NDArray[np.float64]:
+    """Evaluate quantiles at non-exceedance probabilities for every series,
+    e.g. 0.1 for 7Q10 or 1 - 1/1.5 for the 1.5-year flood.
+
+    Returns a series x probability matrix, in real space if log is True.
+    """
+    q = np.asarray(probabilities, dtype=np.float64)[np.newaxis, :]
+    K = pearson3.ppf(q, np.nan_to_num(params.skew)[:, np.newaxis])
+    table = params.mean[:, np.newaxis] + K * params.std[:, np.newaxis]
+    return 10.0 ** table if log else table
+
+def main(n_sites: int = 2000, years: int = 40):
+    """Compare vectorized fits with per-series scipy.stats.pearson3.fit on a
+    synthetic matrix of annual minima."""
+    from time import perf_counter
+
+    # Synthetic annual series with varying length and skew
+    rng = np.random.default_rng(2024)
+    skew = rng.uniform(-1.0, 2.0, n_sites)
+    matrix = pearson3.rvs(skew[:, np.newaxis], loc=10.0, scale=3.0,
+        size=(n_sites, years), random_state=rng)
+    matrix[rng.random(matrix.shape) < 0.1] = np.nan
+    q = [0.1, 1.0 - 1.0 / 1.5]
+
+    # Vectorized
+    for method in ["moments", "lmoments"]:
+        start = perf_counter()
+        table = pearson3_ppf(fit_pearson3(matrix, method=method), q)
+        print(f"{method:<9} {perf_counter() - start:.3f} s, 7Q10 of first site {table[0, 0]:.3f}")
+
+    # Per-series maximum likelihood on a subset
+    subset = matrix[:100]
+    start = perf_counter()
+    reference = np.array([pearson3.ppf(q, *pearson3.fit(r[~np.isnan(r)])) for r in subset])
+    elapsed = perf_counter() - start
+    refined = pearson3_ppf(fit_pearson3(subset, method="mle"), q)
+    print(f"scipy fit {elapsed * n_sites / len(subset):.3f} s (extrapolated), "
+        f"7Q10 of first site {reference[0, 0]:.3f}")
+    print(f"Median relative difference of refined MLE: "
+        f"{np.nanmedian(np.abs(refined / reference - 1.0)):.2e}")
+
+if __name__ == "__main__":
+    main()
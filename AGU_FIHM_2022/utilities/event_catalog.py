@@ -0,0 +1,327 @@
+"""
+Persistent catalog of detected events in SQLite.
+
+Events of all sites are rows of one table (site, start, end, peak,
+peak_time, volume, and any other numeric statistics). An R-tree on
+(time interval, peak) answers interval-overlap and peak threshold queries
+without scanning, and an index on (site, start) serves per-site lookups:
+
+    with EventCatalog("events.sqlite") as catalog:
+        catalog_site(catalog, "02146470", series, halflife="6h", window="7D")
+        big = catalog.query(start="2020-01-01", end="2020-12-31", min_peak=5000.0,
+            sites=southeast_sites)
+
+The R-tree holds integer coordinates (epoch minutes, whole value units),
+rounded outward, so it returns a superset that is filtered exactly on the
+event table. Detection runs incrementally: catalog_site detects events
+in the data after the site's last detected time (less a lookback) and
+replaces the events that were provisional at the previous run.
+"""
+from typing import Iterable, Optional, Union
+from pathlib import Path
+import sqlite3
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from . import event_detection
+
+# Columns stored for every event, times as epoch seconds
+CORE_COLUMNS: tuple[str, ...] = ("site", "start", "end", "peak", "peak_time", "volume")
+INT32_MAX: int = np.iinfo(np.int32).max
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    site TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    "end" INTEGER NOT NULL,
+    peak REAL,
+    peak_time INTEGER,
+    volume REAL
+);
+CREATE INDEX IF NOT EXISTS events_site_start ON events (site, start);
+CREATE VIRTUAL TABLE IF NOT EXISTS events_rtree USING rtree_i32 (
+    id, start_minute, end_minute, peak_low, peak_high
+);
+CREATE TABLE IF NOT EXISTS coverage (
+    site TEXT PRIMARY KEY,
+    detected_until INTEGER NOT NULL
+);
+"""
+
+def epoch_seconds(times: npt.ArrayLike) -> npt.NDArray[np.int64]:
+    return pd.DatetimeIndex(times).as_unit("s").asi8
+
+class EventCatalog:
+    """SQLite event catalog. Use as a context manager or call close()."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(SCHEMA)
+        self.columns = [row[1] for row in self.connection.execute("PRAGMA table_info(events)")][1:]
+
+    def __enter__(self) -> "EventCatalog":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def _add_columns(self, events: pd.DataFrame) -> None:
+        # Extra numeric statistics become REAL columns
+        for name in events.columns:
+            if name not in self.columns and pd.api.types.is_numeric_dtype(events[name]):
+                self.connection.execute(f'ALTER TABLE events ADD COLUMN "{name}" REAL')
+                self.columns.append(name)
+
+    def update(
+        self,
+        events: pd.DataFrame,
+        replace_from: Optional[pd.Series] = None,
+        through: Optional[pd.Series] = None
+    ) -> int:
+        """Add events (site, start, end, and optionally peak, peak_time,
+        volume, and other numeric columns) in one transaction.
+
+        replace_from holds, by site, the time from which the site's stored
+        events are replaced by the new ones (events starting at or after it
+        are deleted first). through holds, by site, the time detection has
+        covered. Returns the number of events added.
+        """
+        events = events.reset_index(drop=True)
+        with self.connection:
+            self._add_columns(events)
+            if replace_from is not None and len(replace_from):
+                rows = [(str(s), int(t)) for s, t in zip(replace_from.index, epoch_seconds(replace_from))]
+                self.connection.executemany("DELETE FROM events_rtree WHERE id IN "
+                    "(SELECT id FROM events WHERE site = ? AND start >= ?)", rows)
+                self.connection.executemany("DELETE FROM events WHERE site = ? AND start >= ?", rows)
+            if len(events):
+                self._insert(events)
+            if through is not None and len(through):
+                self.connection.executemany("INSERT INTO coverage (site, detected_until) VALUES (?, ?) "
+                    "ON CONFLICT (site) DO UPDATE SET detected_until = excluded.detected_until",
+                    [(str(s), int(t)) for s, t in zip(through.index, epoch_seconds(through))])
+        return len(events)
+
+    def _insert(self, events: pd.DataFrame) -> None:
+        start = epoch_seconds(events["start"])
+        end = epoch_seconds(events["end"])
+        columns = {"site": events["site"].astype(str).to_numpy(dtype=object), "start": start, "end": end}
+        for name in self.columns[3:]:
+            if name not in events:
+                columns[name] = np.full(len(events), None, dtype=object)
+            elif name == "peak_time":
+                columns[name] = epoch_seconds(events[name])
+            else:
+                columns[name] = events[name].to_numpy(dtype=np.float64)
+        # Ids are assigned by SQLite and read back row by row
+        names = ", ".join(f'"{c}"' for c in columns)
+        marks = ", ".join("?" * len(columns))
+        values = [c.tolist() if isinstance(c, np.ndarray) else list(c) for c in columns.values()]
+        cursor = self.connection.cursor()
+        ids = []
+        for row in zip(*values):
+            cursor.execute(f"INSERT INTO events ({names}) VALUES ({marks})", row)
+            ids.append(cursor.lastrowid)
+
+        # Outward-rounded integer boxes, events without a peak span all peaks
+        peak = columns["peak"] if "peak" in events else np.full(len(events), np.nan)
+        peak = np.asarray(peak, dtype=np.float64)
+        low = np.where(np.isnan(peak), -INT32_MAX, np.clip(np.floor(np.nan_to_num(peak)), -INT32_MAX, INT32_MAX))
+        high = np.where(np.isnan(peak), INT32_MAX, np.clip(np.ceil(np.nan_to_num(peak)), -INT32_MAX, INT32_MAX))
+        self.connection.executemany("INSERT INTO events_rtree VALUES (?, ?, ?, ?, ?)", zip(
+            ids, (start // 60).tolist(), (-(-end // 60)).tolist(),
+            low.astype(np.int64).tolist(), high.astype(np.int64).tolist()))
+
+    def detected_until(self, site: str) -> Optional[pd.Timestamp]:
+        """Time detection has covered for a site, None if never run."""
+        row = self.connection.execute("SELECT detected_until FROM coverage WHERE site = ?",
+            (str(site),)).fetchone()
+        return None if row is None else pd.Timestamp(row[0], unit="s")
+
+    def query(
+        self,
+        start: Optional[Union[str, pd.Timestamp]] = None,
+        end: Optional[Union[str, pd.Timestamp]] = None,
+        min_peak: Optional[float] = None,
+        sites: Optional[Iterable[str]] = None
+    ) -> pd.DataFrame:
+        """Events overlapping [start, end] with peak of at least min_peak,
+        at sites (all by default), sorted by site and start."""
+        conditions, params = [], []
+        box = []
+        if start is not None:
+            t = int(pd.Timestamp(start).value // 1_000_000_000)
+            box.append("r.end_minute >= ?")
+            params.append(t // 60)
+            conditions.append('e."end" >= ?')
+        if end is not None:
+            t_end = int(pd.Timestamp(end).value // 1_000_000_000)
+            box.append("r.start_minute <= ?")
+            params.append(-(-t_end // 60))
+            conditions.append("e.start <= ?")
+        if min_peak is not None:
+            box.append("r.peak_high >= ?")
+            params.append(int(np.floor(min_peak)))
+            conditions.append("e.peak >= ?")
+        exact = ([t] if start is not None else []) + ([t_end] if end is not None else []) + \
+            ([float(min_peak)] if min_peak is not None else [])
+
+        columns = ", ".join(f'e."{c}"' for c in self.columns)
+        if box:
+            sql = (f"SELECT {columns} FROM events_rtree AS r JOIN events AS e ON e.id = r.id "
+                f"WHERE {' AND '.join(box + conditions)}")
+            params = params + exact
+        else:
+            sql = f"SELECT {columns} FROM events AS e"
+        if sites is not None:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS query_sites (site TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM query_sites")
+            self.connection.executemany("INSERT OR IGNORE INTO query_sites VALUES (?)",
+                [(str(s),) for s in sites])
+            sql += (" AND" if box else " WHERE") + " e.site IN (SELECT site FROM query_sites)"
+        df = pd.read_sql_query(sql + " ORDER BY e.site, e.start", self.connection, params=params)
+        for name in ["start", "end", "peak_time"]:
+            df[name] = pd.to_datetime(df[name], unit="s")
+        return df
+
+def event_summary(series: pd.Series, events: pd.DataFrame) -> pd.DataFrame:
+    """Peak, peak time, and volume (value units x hours, from the series
+    interval) of each event of one series."""
+    events = events.reset_index(drop=True)
+    spacing = np.diff(epoch_seconds(series.index))
+    step = np.median(spacing) / 3600.0 if len(spacing) else 1.0
+    series = series.dropna()
+    t = epoch_seconds(series.index)
+    v = series.to_numpy(dtype=np.float64)
+    lo = np.searchsorted(t, epoch_seconds(events["start"]), side="left")
+    hi = np.searchsorted(t, epoch_seconds(events["end"]), side="right")
+
+    # Events without a valid value are dropped
+    keep = hi > lo
+    if not keep.any():
+        return events.iloc[:0].assign(peak=np.array([]), peak_time=pd.to_datetime([]),
+            volume=np.array([]))
+    events = events[keep].reset_index(drop=True)
+    lo, hi = lo[keep], hi[keep]
+
+    # Segment of every event in the flat arrays
+    lengths = hi - lo
+    event = np.repeat(np.arange(len(lo)), lengths)
+    positions = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    offsets = np.cumsum(lengths) - lengths
+    peak = np.maximum.reduceat(v[positions], offsets)
+    first = np.flatnonzero(v[positions] == peak[event])
+    first = first[np.concatenate(([True], event[first][1:] != event[first][:-1]))]
+    events["peak"] = peak
+    events["peak_time"] = series.index[positions[first]]
+    events["volume"] = np.add.reduceat(v[positions], offsets) * step
+    return events
+
+def catalog_site(
+    catalog: EventCatalog,
+    site: str,
+    series: pd.Series,
+    lookback: Union[str, pd.Timedelta] = "90D",
+    **kwargs
+) -> int:
+    """Detect events of one site in the data not yet covered by the catalog
+    and add them. Keyword arguments go to event_detection.list_events
+    (halflife and window are required).
+
+    Detection reruns over lookback before the covered time, so the rolling
+    trend and the median residual threshold see more than the new data.
+    Events starting within one window before the covered time were detected
+    without their trailing trend window and are replaced, earlier events
+    are left as stored. Returns the number of events added.
+    """
+    series = series.sort_index()
+    if series.empty:
+        return 0
+    until = catalog.detected_until(site)
+    cut = series.index[0]
+    if until is not None:
+        if series.index[-1] <= until:
+            return 0
+        series = series[until - pd.Timedelta(lookback):]
+        cut = until - pd.Timedelta(kwargs["window"])
+    events = event_detection.list_events(series, **kwargs)
+    events = event_summary(series, events[events["start"] >= cut])
+    events.insert(0, "site", str(site))
+    return catalog.update(events, replace_from=pd.Series([cut], index=[str(site)]),
+        through=pd.Series([series.index[-1]], index=[str(site)]))
+
+def main():
+    """Build a catalog of synthetic events of many sites, check incremental
+    detection against detection on the whole record, and time queries."""
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+    with TemporaryDirectory() as tmp:
+        path = Path(tmp) / "events.sqlite"
+        options = dict(halflife="6h", window="7D", minimum_event_duration="6h", start_radius="6h")
+
+        # Incremental detection, one month at a time
+        record = event_detection.synthetic_record(seed=3)
+        with EventCatalog(path) as catalog:
+            for end in pd.date_range(record.index[0] + pd.Timedelta("60D"), record.index[-1], freq="30D"):
+                catalog_site(catalog, "00000001", record[:end], **options)
+            catalog_site(catalog, "00000001", record, **options)
+            incremental = catalog.query(sites=["00000001"])
+        full = event_detection.list_events(record, **options)
+        matched = incremental["start"].isin(full["start"]).mean()
+        print(f"Incremental: {len(incremental)} events, whole record: {len(full)}, "
+            f"{matched:.0%} of starts match")
+        assert matched >= 0.9 and abs(len(incremental) - len(full)) <= 0.1 * len(full)
+
+        # Many sites, events appended in batches
+        rng = np.random.default_rng(2024)
+        n_sites, per_site = 3000, 300
+        sites = np.array([f"{1000000 + 137 * i:08d}" for i in range(n_sites)])
+        start = pd.Timestamp("1990-01-01") + pd.to_timedelta(
+            np.sort(rng.integers(0, 30 * 365 * 24, (n_sites, per_site)), axis=1).ravel(), unit="h")
+        events = pd.DataFrame({
+            "site": np.repeat(sites, per_site),
+            "start": start,
+            "end": start + pd.to_timedelta(rng.integers(6, 240, n_sites * per_site), unit="h"),
+            "peak": rng.lognormal(6.0, 1.5, n_sites * per_site)
+        })
+        events["peak_time"] = events["start"] + (events["end"] - events["start"]) / 3
+        events["volume"] = events["peak"] * 24.0
+        with EventCatalog(path) as catalog:
+            begin = perf_counter()
+            for batch in np.array_split(np.arange(len(events)), 10):
+                catalog.update(events.iloc[batch])
+            print(f"Appended {len(events)} events in {perf_counter() - begin:.1f} s")
+
+            # Overlap and threshold queries, checked against a frame scan
+            southeast = sites[::7]
+            queries = [
+                dict(start="2015-01-01", end="2015-12-31", min_peak=5000.0, sites=southeast),
+                dict(start="2005-06-01", end="2005-06-30"),
+                dict(min_peak=50000.0)
+            ]
+            for q in queries:
+                begin = perf_counter()
+                result = catalog.query(**q)
+                seconds = perf_counter() - begin
+                mask = np.ones(len(events), dtype=bool)
+                if "start" in q:
+                    mask &= (events["end"] >= q["start"]).to_numpy() & (events["start"] <= q["end"]).to_numpy()
+                if "min_peak" in q:
+                    mask &= (events["peak"] >= q["min_peak"]).to_numpy()
+                if "sites" in q:
+                    mask &= events["site"].isin(q["sites"]).to_numpy()
+                assert len(result) == mask.sum(), q
+                print(f"{len(result)} events in {1000 * seconds:.1f} ms: {q if 'sites' not in q else 'southeast 2015 > 5000'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+Hydrograph shape index for analog event searches.
+
+Every event (a start and end from event_detection.list_events) is resampled
+to a fixed number of points evenly spaced between its start and end and
+scaled to [0, 1] by its own minimum and maximum, so events compare by rise,
+peak and recession regardless of size and duration. The shapes are rows of
+one float32 matrix, searched by Euclidean distance with matrix products:
+
+    events = catalog.query(sites=sites)
+    events, vectors = catalog_shapes(records, events)
+    index = ShapeIndex.build(vectors, events, lists=1024)
+    analogs = index.search(event_shapes(series, current), k=10, probes=16)
+
+Exact searches scan all rows in blocks. With lists, rows are also grouped by
+k-means clusters of their shapes (an inverted file) and a search only scans
+the rows of the probes clusters nearest the query, which is approximate.
+"""
+from typing import Mapping, Optional, Union
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from .scheduler import write_result, read_result
+
+# Elements of the distance block computed at once
+BLOCK_SIZE: int = 2 ** 24
+
+def event_shapes(
+    series: pd.Series,
+    events: pd.DataFrame,
+    length: int = 64
+) -> npt.NDArray[np.float32]:
+    """Shape vector of each event (start and end columns) of one series,
+    linearly interpolated at length times from start to end and scaled to
+    [0, 1]. Flat events, and all events of a series without valid values,
+    are all zero."""
+    series = series.dropna()
+    if series.empty:
+        return np.zeros((len(events), length), dtype=np.float32)
+    t = series.index.as_unit("s").asi8.astype(np.float64)
+    start = pd.DatetimeIndex(events["start"]).as_unit("s").asi8.astype(np.float64)
+    end = pd.DatetimeIndex(events["end"]).as_unit("s").asi8.astype(np.float64)
+    grid = np.linspace(0.0, 1.0, length)
+    x = np.interp(start[:, None] + (end - start)[:, None] * grid, t, series.to_numpy(dtype=np.float64))
+    low = x.min(axis=1, keepdims=True, initial=np.inf)
+    span = x.max(axis=1, keepdims=True, initial=-np.inf) - low
+    with np.errstate(invalid="ignore", divide="ignore"):
+        shapes = np.where(span > 0.0, (x - low) / span, 0.0)
+    return shapes.astype(np.float32)
+
+def catalog_shapes(
+    records: Mapping[str, pd.Series],
+    events: pd.DataFrame,
+    length: int = 64
+) -> tuple[pd.DataFrame, npt.NDArray[np.float32]]:
+    """Shape vectors of events of many sites (site, start, end columns, as
+    returned by EventCatalog.query), from the series of each site in
+    records. Events of sites without a record are dropped. Returns the
+    events in the order of the vectors."""
+    frames, vectors = [], []
+    for site, group in events.groupby("site", sort=True):
+        if site not in records:
+            continue
+        frames.append(group)
+        vectors.append(event_shapes(records[site], group, length))
+    if not frames:
+        return events.iloc[:0], np.empty((0, length), dtype=np.float32)
+    return pd.concat(frames, ignore_index=True), np.concatenate(vectors)
+
+def _squared_distances(
+    queries: npt.NDArray[np.float32],
+    vectors: npt.NDArray[np.float32],
+    norms: npt.NDArray[np.float32]
+) -> npt.NDArray[np.float32]:
+    # |v|^2 - 2 q.v, the query norm is added by the caller
+    return norms[None, :] - 2.0 * (queries @ vectors.T)
+
+def _top_k(
+    distances: npt.NDArray[np.float32],
+    rows: npt.NDArray[np.int64],
+    k: int
+) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.int64]]:
+    # k smallest distances of each query row, sorted
+    if k == 1:
+        keep = np.argmin(distances, axis=1)[:, None]
+        return np.take_along_axis(distances, keep, axis=1), np.take_along_axis(rows, keep, axis=1)
+    if distances.shape[1] > k:
+        keep = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        distances = np.take_along_axis(distances, keep, axis=1)
+        rows = np.take_along_axis(rows, keep, axis=1)
+    order = np.argsort(distances, axis=1, kind="stable")
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+def nearest(
+    queries: npt.NDArray[np.float32],
+    vectors: npt.NDArray[np.float32],
+    k: int,
+    norms: Optional[npt.NDArray[np.float32]] = None
+) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.int64]]:
+    """Squared distances and rows of the k nearest vectors of each query,
+    in blocks of queries and vectors."""
+    if norms is None:
+        norms = np.einsum("ij,ij->i", vectors, vectors)
+    k = min(k, len(vectors))
+    best = np.empty((len(queries), k), dtype=np.float32)
+    rows = np.empty((len(queries), k), dtype=np.int64)
+    chunk = max(BLOCK_SIZE // max(len(vectors), 1), 1)
+    for q in range(0, len(queries), chunk):
+        block_best = np.full((min(chunk, len(queries) - q), 0), np.inf, dtype=np.float32)
+        block_rows = np.zeros(block_best.shape, dtype=np.int64)
+        step = max(BLOCK_SIZE // len(block_best), k)
+        for first in range(0, len(vectors), step):
+            block = _squared_distances(queries[q:q + chunk], vectors[first:first + step],
+                norms[first:first + step])
+            block_best, block_rows = _top_k(np.concatenate([block_best, block], axis=1),
+                np.concatenate([block_rows, np.broadcast_to(
+                    np.arange(first, first + block.shape[1]), block.shape)], axis=1), k)
+        best[q:q + chunk], rows[q:q + chunk] = block_best, block_rows
+    best += np.einsum("ij,ij->i", queries, queries)[:, None]
+    return best, rows
+
+def kmeans(
+    vectors: npt.NDArray[np.float32],
+    clusters: int,
+    iterations: int = 10,
+    sample: int = 100_000,
+    seed: Optional[int] = 0
+) -> npt.NDArray[np.float32]:
+    """Centroids of k-means clusters fitted to a random sample of rows."""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), min(sample, len(vectors)), replace=False)
+    x = np.asarray(vectors[np.sort(rows)], dtype=np.float32)
+    centroids = x[rng.choice(len(x), min(clusters, len(x)), replace=False)].copy()
+    for _ in range(iterations):
+        _, label = nearest(x, centroids, 1)
+        label = label[:, 0]
+
+        # Sums of the members of each cluster, empty clusters stay put
+        order = np.argsort(label, kind="stable")
+        counts = np.bincount(label, minlength=len(centroids))
+        filled = np.flatnonzero(counts)
+        sums = np.add.reduceat(x[order], np.cumsum(counts)[filled] - counts[filled], axis=0)
+        centroids[filled] = sums / counts[filled, None]
+    return centroids
+
+class ShapeIndex:
+    """Event shape vectors with their events, optionally grouped in
+    inverted lists of k-means clusters.
+
+    Parameters
+    ----------
+    vectors: numpy.ndarray
+        float32 shape vectors, one row per event.
+    events: pandas.DataFrame
+        Event of each row (site, start, end, peak, ...).
+    centroids, order, offsets: numpy.ndarray, optional
+        Cluster centroids, rows sorted by cluster, and the first position of
+        each cluster in order (with the total at the end).
+    """
+
+    def __init__(
+        self,
+        vectors: npt.NDArray[np.float32],
+        events: pd.DataFrame,
+        centroids: Optional[npt.NDArray[np.float32]] = None,
+        order: Optional[npt.NDArray[np.int64]] = None,
+        offsets: Optional[npt.NDArray[np.int64]] = None
+    ):
+        self.vectors = vectors
+        self.events = events.reset_index(drop=True)
+        self.norms = np.einsum("ij,ij->i", vectors, vectors)
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    @classmethod
+    def build(
+        cls,
+        vectors: npt.NDArray[np.float32],
+        events: pd.DataFrame,
+        lists: int = 0,
+        iterations: int = 10,
+        seed: Optional[int] = 0
+    ) -> "ShapeIndex":
+        """Index vectors, with lists k-means clusters for approximate search
+        (none for exact search only)."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if not lists or len(vectors) <= lists:
+            return cls(vectors, events)
+        centroids = kmeans(vectors, lists, iterations, seed=seed)
+        _, label = nearest(vectors, centroids, 1)
+        label = label[:, 0]
+        order = np.argsort(label, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(label, minlength=len(centroids)))))
+        return cls(vectors, events, centroids, order, offsets)
+
+    def nearest(
+        self,
+        queries: npt.NDArray[np.float32],
+        k: int = 10,
+        probes: Optional[int] = None
+    ) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.int64]]:
+        """Distances and rows of the k nearest events of each query, exact
+        unless probes (clusters scanned per query) is given. Rows are -1 and
+        distances infinite where fewer than k events were scanned."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if probes is None or self.centroids is None:
+            best, rows = nearest(queries, self.vectors, k, self.norms)
+        else:
+            best = np.full((len(queries), k), np.inf, dtype=np.float32)
+            rows = np.full((len(queries), k), -1, dtype=np.int64)
+            _, clusters = nearest(queries, self.centroids, probes)
+            for i, probed in enumerate(clusters):
+                # Rows of the probed clusters
+                lengths = self.offsets[probed + 1] - self.offsets[probed]
+                positions = np.repeat(self.offsets[probed] - np.cumsum(lengths) + lengths, lengths) + \
+                    np.arange(lengths.sum())
+                candidates = self.order[positions]
+                d, r = nearest(queries[i:i + 1], self.vectors[candidates], k, self.norms[candidates])
+                best[i, :d.shape[1]], rows[i, :d.shape[1]] = d[0], candidates[r[0]]
+
+        # Exact distances of the neighbors found, free of the cancellation
+        # in the expanded products
+        found = rows >= 0
+        difference = self.vectors[np.where(found, rows, 0)] - queries[:, None, :]
+        distances = np.where(found, np.sqrt(np.einsum("qkl,qkl->qk", difference, difference)), np.inf)
+        return distances.astype(np.float32), rows
+
+    def search(
+        self,
+        queries: npt.NDArray[np.float32],
+        k: int = 10,
+        probes: Optional[int] = None
+    ) -> pd.DataFrame:
+        """The k nearest events of each query with query, rank and distance
+        columns, nearest first."""
+        distances, rows = self.nearest(queries, k, probes)
+        found = rows >= 0
+        query, rank = np.nonzero(found)
+        result = self.events.iloc[rows[found]].reset_index(drop=True)
+        result.insert(0, "query", query)
+        result.insert(1, "rank", rank)
+        result.insert(2, "distance", distances[found])
+        return result
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Save to a directory, vectors as a numpy file that load maps."""
+        path = Path(path)
+        path.mkdir(exist_ok=True, parents=True)
+        np.save(path / "vectors.npy", self.vectors)
+        write_result(path / "events.arrow", self.events, "event_shapes")
+        if self.centroids is not None:
+            np.savez(path / "lists.npz", centroids=self.centroids, order=self.order,
+                offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Optional["ShapeIndex"]:
+        path = Path(path)
+        if not (path / "vectors.npy").exists():
+            return None
+        lists = {}
+        if (path / "lists.npz").exists():
+            with np.load(path / "lists.npz") as data:
+                lists = {name: data[name] for name in ["centroids", "order", "offsets"]}
+        return cls(np.load(path / "vectors.npy", mmap_mode="r"), read_result(path / "events.arrow"),
+            **lists)
+
+def synthetic_shapes(
+    n: int,
+    length: int = 64,
+    seed: Optional[int] = 2024
+) -> npt.NDArray[np.float32]:
+    """Event shapes with a power-law rise to a peak at a random fraction of
+    the event and an exponential recession, plus noise, scaled as
+    event_shapes scales events."""
+    rng = np.random.default_rng(seed)
+    shapes = np.empty((n, length), dtype=np.float32)
+    grid = np.linspace(0.0, 1.0, length, dtype=np.float32)
+    for first in range(0, n, 100_000):
+        m = min(100_000, n - first)
+        peak = rng.uniform(0.05, 0.6, (m, 1)).astype(np.float32)
+        power = rng.uniform(0.5, 3.0, (m, 1)).astype(np.float32)
+        decay = rng.uniform(0.05, 0.5, (m, 1)).astype(np.float32)
+        x = np.where(grid < peak, (grid / peak) ** power, np.exp(-(grid - peak) / decay))
+        x += rng.normal(0.0, 0.02, x.shape).astype(np.float32)
+        low = x.min(axis=1, keepdims=True)
+        shapes[first:first + m] = (x - low) / (x.max(axis=1, keepdims=True) - low)
+    return shapes
+
+def main():
+    """Search the events of the synthetic event detection record, then time
+    exact and approximate searches over a million synthetic shapes and
+    measure the recall of the approximate search."""
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+    from . import event_detection
+    from .event_catalog import event_summary
+
+    # Every event is its own nearest neighbor
+    record = event_detection.synthetic_record().ffill()
+    events = event_detection.list_events(record, halflife="6h", window="7D",
+        minimum_event_duration="6h", start_radius="6h")
+    events, vectors = catalog_shapes({"00000001": record}, events.assign(site="00000001"))
+    with TemporaryDirectory() as tmp:
+        path = Path(tmp) / "event_shapes"
+        ShapeIndex.build(vectors, events).save(path)
+        index = ShapeIndex.load(path)
+        analogs = index.search(vectors, k=3)
+        del index
+    first = analogs[analogs["rank"] == 0]
+    assert (first["start"].to_numpy() == events["start"].to_numpy()).all()
+    assert np.allclose(first["distance"], 0.0)
+    largest = int(np.argmax(event_summary(record, events)["peak"]))
+    print(f"{len(events)} record events, analogs of the largest:")
+    print(analogs[analogs["query"] == largest])
+
+    # A site without valid values has flat shapes
+    missing = catalog_shapes({"00000001": record, "00000002": record * np.nan},
+        pd.concat([events, events.assign(site="00000002")]))[1]
+    assert np.array_equal(missing[len(events):], np.zeros_like(vectors))
+
+    # A million shapes
+    n, n_queries, k = 1_000_000, 100, 10
+    shapes = synthetic_shapes(n)
+    queries = synthetic_shapes(n_queries, seed=7)
+    frame = pd.DataFrame({"site": np.arange(n) % 5000, "event": np.arange(n)})
+    begin = perf_counter()
+    index = ShapeIndex.build(shapes, frame, lists=1024)
+    print(f"Indexed {n} shapes ({shapes.nbytes / 2**20:.0f} MiB) in {perf_counter() - begin:.1f} s")
+    begin = perf_counter()
+    _, exact = index.nearest(queries[:1], k)
+    print(f"Exact, one query: {1000 * (perf_counter() - begin):.0f} ms")
+    begin = perf_counter()
+    _, exact = index.nearest(queries, k)
+    print(f"Exact, {n_queries} queries: {1000 * (perf_counter() - begin):.0f} ms")
+    for probes in [8, 32]:
+        begin = perf_counter()
+        _, approximate = index.nearest(queries, k, probes=probes)
+        seconds = perf_counter() - begin
+        recall = np.mean([len(np.intersect1d(a, e)) / k for a, e in zip(approximate, exact)])
+        print(f"Approximate, {probes} probes: {1000 * seconds / n_queries:.1f} ms per query, "
+            f"recall@{k} {recall:.3f}")
+    assert recall >= 0.9
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Shared execution backends for workflow stages.
+
+A single backend (serial, thread pool, process pool, or dask) is started on
+first use and reused by every stage in the process, instead of each stage
+starting its own cluster. Work below a size threshold runs serially, since
+small workloads finish faster in-process than the cost of dispatching them.
+
+    backend = get_backend()
+    results = backend.map(func, items, size=len(pairs))
+"""
+from typing import Any, Callable, Iterable, Optional
+from dataclasses import dataclass
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+import atexit
+import os
+
+@dataclass
+class ExecutionConfig:
+    kind: str = "serial"
+    max_workers: Optional[int] = None
+    threads_per_worker: int = 1
+    min_parallel_size: int = 1_000_000
+
+def _default_config() -> ExecutionConfig:
+    workers = os.environ.get("WORKFLOW_WORKERS")
+    return ExecutionConfig(
+        kind=os.environ.get("WORKFLOW_BACKEND", "serial"),
+        max_workers=int(workers) if workers else None,
+        min_parallel_size=int(os.environ.get("WORKFLOW_MIN_PARALLEL_SIZE", 1_000_000))
+    )
+
+class Backend:
+    """Runs functions over items with an optional pool. Subclasses set the pool."""
+    kind: str = "serial"
+
+    def __init__(self, config: ExecutionConfig):
+        self.config = config
+
+    def _map(self, func: Callable, items: list) -> list:
+        return [func(i) for i in items]
+
+    def map(self, func: Callable, items: Iterable, size: Optional[int] = None) -> list:
+        """Apply func to every item and return results in order.
+
+        size is the amount of work (e.g. rows); below the configured
+        threshold the items are processed serially.
+        """
+        items = list(items)
+        if len(items) < 2 or (size is not None and size < self.config.min_parallel_size):
+            return [func(i) for i in items]
+        return self._map(func, items)
+
+    def close(self) -> None:
+        """Release workers."""
+
+class ExecutorBackend(Backend):
+    """Backend built on a concurrent.futures executor."""
+    executor_class: type[Executor] = ThreadPoolExecutor
+
+    def __init__(self, config: ExecutionConfig):
+        super().__init__(config)
+        self.executor = self.executor_class(max_workers=config.max_workers)
+
+    def _map(self, func: Callable, items: list) -> list:
+        return list(self.executor.map(func, items))
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+class ThreadBackend(ExecutorBackend):
+    kind: str = "thread"
+    executor_class = ThreadPoolExecutor
+
+class ProcessBackend(ExecutorBackend):
+    kind: str = "process"
+    executor_class = ProcessPoolExecutor
+
+class DaskBackend(Backend):
+    """Backend on a local dask.distributed cluster."""
+    kind: str = "dask"
+
+    def __init__(self, config: ExecutionConfig):
+        super().__init__(config)
+        from dask.distributed import Client
+        n_workers = config.max_workers or max((os.cpu_count() or 2) - 1, 1)
+        self.client = Client(n_workers=n_workers, threads_per_worker=config.threads_per_worker)
+
+    def _map(self, func: Callable, items: list) -> list:
+        return self.client.gather(self.client.map(func, items, pure=False))
+
+    def close(self) -> None:
+        self.client.close()
+
+BACKENDS: dict[str, type[Backend]] = {
+    "serial": Backend,
+    "thread": ThreadBackend,
+    "process": ProcessBackend,
+    "dask": DaskBackend
+}
+
+CONFIG: ExecutionConfig = _default_config()
+_BACKEND: list[Optional[Backend]] = [None]
+
+def configure(**kwargs: Any) -> ExecutionConfig:
+    """Update the execution configuration. Closes a running backend so the
+    next get_backend call starts one with the new settings.
+    """
+    for key, value in kwargs.items():
+        if not hasattr(CONFIG, key):
+            raise ValueError(f"Unknown execution option: {key}")
+        setattr(CONFIG, key, value)
+    shutdown()
+    return CONFIG
+
+def get_backend() -> Backend:
+    """Return the process-wide backend, starting it on first use."""
+    if _BACKEND[0] is None:
+        if CONFIG.kind not in BACKENDS:
+            raise ValueError(f"Unknown execution backend: {CONFIG.kind}")
+        _BACKEND[0] = BACKENDS[CONFIG.kind](CONFIG)
+    return _BACKEND[0]
+
+def shutdown() -> None:
+    """Close the process-wide backend, if started."""
+    if _BACKEND[0] is not None:
+        _BACKEND[0].close()
+        _BACKEND[0] = None
+
+atexit.register(shutdown)
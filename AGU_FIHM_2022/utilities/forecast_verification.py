@@ -0,0 +1,271 @@
+"""
+Forecast verification stratified by site and lead time.
+
+Forecasts keep their reference time, and lead time is the integer number of
+hours from reference time to valid time. Each forecast value is paired with
+the hourly observation at its site and valid hour, and every pair falls in
+one (site, lead) cell. Metrics are computed from sums accumulated per cell
+with bincount (counts, sums, sums of squares and products, and contingency
+counts), so forecasts can be added one batch of reference times at a time
+and memory stays bounded by the number of cells, not the number of pairs:
+
+    verifier = LeadVerifier(sites, leads=range(1, 241), thresholds=thresholds)
+    for forecast in forecasts:
+        verifier.add(forecast_pairs(forecast, obs))
+    by_cell = verifier.metrics()
+    by_lead = verifier.metrics(pooled=True)
+"""
+from typing import Iterable, Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+import pyarrow as pa
+
+from .arrow_tables import HOUR_NS, values, epoch_ns, sorted_sites, site_codes
+from .profiling import count_copy
+
+# Sums accumulated per cell
+STATISTICS: tuple[str, ...] = (
+    "n", "sim", "obs", "sim2", "obs2", "sim_obs", "squared_error", "absolute_error",
+    "true_positive", "false_positive", "false_negative", "true_negative"
+)
+
+def lead_hours(reference_time: pa.ChunkedArray, value_time: pa.ChunkedArray) -> npt.NDArray[np.int64]:
+    """Whole hours from reference time to valid time."""
+    return (epoch_ns(value_time) - epoch_ns(reference_time)) // HOUR_NS
+
+def forecast_pairs(
+    forecasts: pa.Table,
+    obs: pa.Table,
+    site: str = "usgs_site_code",
+    reference_time: str = "reference_time",
+    time: str = "value_time",
+    value: str = "value"
+) -> pa.Table:
+    """Pair forecast values with hourly observations on (site, valid hour),
+    keeping rows where both values are non-negative. Observations must be
+    unique on (site, hour), as returned by hourly_first; forecasts may repeat
+    a valid hour for different reference times.
+
+    Returns site, reference time, valid time, lead_hours, sim, and obs columns.
+    """
+    # Sorted integer (site, hour) keys of the observations
+    sites = sorted_sites(obs[site])
+    obs_codes, _ = site_codes(obs[site], sites)
+    obs_hours = epoch_ns(obs[time]) // HOUR_NS
+    origin = obs_hours.min(initial=0)
+    span = obs_hours.max(initial=0) - origin + 1
+    obs_keys = obs_codes * span + (obs_hours - origin)
+    order = np.argsort(obs_keys, kind="stable")
+    obs_keys = obs_keys[order]
+
+    # Look up the valid hour of every forecast value
+    codes, _ = site_codes(forecasts[site], sites)
+    hours = epoch_ns(forecasts[time]) // HOUR_NS - origin
+    keys = codes * span + hours
+    found = np.clip(np.searchsorted(obs_keys, keys), 0, max(len(obs_keys) - 1, 0))
+    matched = (codes >= 0) & (hours >= 0) & (hours < span)
+    if len(obs_keys):
+        matched &= obs_keys[found] == keys
+    else:
+        matched[:] = False
+    rows = np.flatnonzero(matched)
+    s = values(forecasts[value])[rows]
+    o = values(obs[value])[order[found[rows]]]
+    valid = (s >= 0.0) & (o >= 0.0)
+    rows = rows[valid]
+
+    # Gather forecast keys once and append the derived columns
+    pairs = forecasts.select([site, reference_time, time]).take(rows)
+    pairs = pairs.append_column("lead_hours", pa.array(
+        lead_hours(pairs[reference_time], pairs[time])))
+    pairs = pairs.append_column("sim", pa.array(s[valid]))
+    pairs = pairs.append_column("obs", pa.array(o[valid]))
+    count_copy(pairs.nbytes)
+    return pairs
+
+def cell_statistics(
+    cells: npt.NDArray[np.int64],
+    n_cells: int,
+    sim: npt.NDArray[np.float64],
+    obs: npt.NDArray[np.float64],
+    threshold: Optional[npt.NDArray[np.float64]] = None
+) -> npt.NDArray[np.float64]:
+    """Sums of STATISTICS for every cell (rows of the result) from pairs
+    labeled with integer cells. threshold holds the flood threshold of each
+    pair; pairs with a NaN threshold are left out of the contingency counts.
+    """
+    error = sim - obs
+    weights = [None, sim, obs, sim * sim, obs * obs, sim * obs, error * error, np.abs(error)]
+    stats = np.zeros((len(STATISTICS), n_cells))
+    for i, w in enumerate(weights):
+        stats[i] = np.bincount(cells, weights=w, minlength=n_cells)
+    if threshold is not None:
+        known = ~np.isnan(threshold)
+        with np.errstate(invalid="ignore"):
+            obs_flag = obs >= threshold
+            sim_flag = sim >= threshold
+        table = 2 * obs_flag.astype(np.int64) + sim_flag.astype(np.int64)
+        counts = np.bincount(4 * cells[known] + table[known], minlength=4 * n_cells).reshape(-1, 4)
+        stats[8:] = counts[:, [3, 1, 2, 0]].T
+    return stats
+
+def metrics_from_statistics(stats: npt.NDArray[np.float64]) -> dict[str, npt.NDArray[np.float64]]:
+    """Continuous and categorical metrics from summed STATISTICS (first axis),
+    with the definitions of hydrotools.metrics."""
+    s = dict(zip(STATISTICS, stats))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        n = s["n"]
+        mean_sim = s["sim"] / n
+        mean_obs = s["obs"] / n
+        var_sim = np.maximum(s["sim2"] / n - mean_sim ** 2, 0.0)
+        var_obs = np.maximum(s["obs2"] / n - mean_obs ** 2, 0.0)
+        covariance = s["sim_obs"] / n - mean_sim * mean_obs
+        r = covariance / np.sqrt(var_sim * var_obs)
+        tp, fp, fn = s["true_positive"], s["false_positive"], s["false_negative"]
+        return {
+            "n": n,
+            "mean_obs": mean_obs,
+            "mean_sim": mean_sim,
+            "mean_error": mean_sim - mean_obs,
+            "mean_absolute_error": s["absolute_error"] / n,
+            "root_mean_squared_error": np.sqrt(s["squared_error"] / n),
+            "pearson_r": r,
+            "nash_sutcliffe_efficiency": 1.0 - s["squared_error"] / (n * var_obs),
+            "kling_gupta_efficiency": 1.0 - np.sqrt((r - 1.0) ** 2 +
+                (np.sqrt(var_sim / var_obs) - 1.0) ** 2 + (mean_sim / mean_obs - 1.0) ** 2),
+            "true_positive": tp,
+            "false_positive": fp,
+            "false_negative": fn,
+            "true_negative": s["true_negative"],
+            "POD": tp / (tp + fn),
+            "POFA": fp / (fp + tp),
+            "TS": tp / (tp + fp + fn)
+        }
+
+class LeadVerifier:
+    """Accumulates forecast pair statistics per (site, lead hour) cell.
+
+    Parameters
+    ----------
+    sites: iterable of str
+        Sites to verify, pairs at other sites are ignored.
+    leads: iterable of int
+        Lead hours to verify (a range), pairs at other leads are ignored.
+    thresholds: pandas.Series, optional
+        Flood threshold of each site for the categorical metrics.
+    """
+
+    def __init__(
+        self,
+        sites: Iterable[str],
+        leads: Iterable[int],
+        thresholds: Optional[pd.Series] = None
+    ):
+        self.sites = pa.array(sorted({str(s) for s in sites}), type=pa.string())
+        leads = np.asarray(list(leads), dtype=np.int64)
+        self.min_lead = int(leads.min())
+        self.n_leads = int(leads.max()) - self.min_lead + 1
+        self.thresholds = None
+        if thresholds is not None:
+            self.thresholds = thresholds.reindex(self.sites.to_numpy(zero_copy_only=False)).to_numpy(
+                dtype=np.float64)
+        self.stats = np.zeros((len(STATISTICS), len(self.sites) * self.n_leads))
+        self.n_pairs = 0
+
+    def add(self, pairs: pa.Table, site: str = "usgs_site_code") -> None:
+        """Add pairs with site, lead_hours, sim, and obs columns."""
+        codes, _ = site_codes(pairs[site].cast(pa.string()), self.sites)
+        leads = pairs["lead_hours"].to_numpy() - self.min_lead
+        keep = np.flatnonzero((codes >= 0) & (leads >= 0) & (leads < self.n_leads))
+        cells = codes[keep] * self.n_leads + leads[keep]
+        threshold = None if self.thresholds is None else self.thresholds[codes[keep]]
+        self.stats += cell_statistics(cells, self.stats.shape[1],
+            values(pairs["sim"])[keep], values(pairs["obs"])[keep], threshold)
+        self.n_pairs += len(keep)
+
+    def metrics(self, pooled: bool = False) -> pd.DataFrame:
+        """Metrics of every (site, lead_hours) cell with pairs, or of every
+        lead with all sites pooled."""
+        stats = self.stats.reshape(len(STATISTICS), len(self.sites), self.n_leads)
+        leads = np.arange(self.min_lead, self.min_lead + self.n_leads)
+        if pooled:
+            index = pd.Index(leads, name="lead_hours")
+            stats = stats.sum(axis=1)
+        else:
+            index = pd.MultiIndex.from_product(
+                [self.sites.to_numpy(zero_copy_only=False), leads],
+                names=["usgs_site_code", "lead_hours"])
+            stats = stats.reshape(len(STATISTICS), -1)
+        result = pd.DataFrame(metrics_from_statistics(stats), index=index)
+        result["n"] = result["n"].astype(np.int64)
+        return result[result["n"] > 0]
+
+def verify_forecasts(
+    forecasts: Iterable[pa.Table],
+    obs: pa.Table,
+    leads: Iterable[int],
+    thresholds: Optional[pd.Series] = None,
+    sites: Optional[Iterable[str]] = None,
+    pooled: bool = False
+) -> pd.DataFrame:
+    """Verify batches of forecasts (e.g. one table per reference time, read
+    one at a time) against hourly observations."""
+    if sites is None:
+        sites = sorted_sites(obs["usgs_site_code"]).to_numpy(zero_copy_only=False)
+    verifier = LeadVerifier(sites, leads, thresholds)
+    for forecast in forecasts:
+        verifier.add(forecast_pairs(forecast, obs))
+    return verifier.metrics(pooled=pooled)
+
+def main():
+    """Compare with hydrotools metrics computed per (site, lead) group on a
+    synthetic set of forecasts."""
+    from hydrotools.metrics import metrics
+    rng = np.random.default_rng(2024)
+    sites = [f"0{i:07d}" for i in range(1, 6)]
+    hours = pd.date_range("2021-08-26", "2021-09-20", freq="1h")
+
+    # Hourly observations and 6-hourly forecasts out to 72 hours
+    flow = rng.lognormal(3.0, 0.8, (len(sites), len(hours)))
+    obs = pa.table({
+        "usgs_site_code": np.repeat(sites, len(hours)),
+        "value_time": np.tile(hours, len(sites)),
+        "value": flow.ravel()
+    })
+    forecasts = []
+    for rt in pd.date_range("2021-08-26", "2021-09-15", freq="6h"):
+        valid = rt + pd.to_timedelta(np.arange(1, 73), unit="h")
+        truth = flow[:, hours.get_indexer(valid)]
+        noise = rng.normal(0.0, 0.01 * np.arange(1, 73), truth.shape)
+        forecasts.append(pa.table({
+            "usgs_site_code": np.repeat(sites, len(valid)),
+            "reference_time": np.full(truth.size, rt),
+            "value_time": np.tile(valid, len(sites)),
+            "value": (truth * np.exp(noise)).ravel()
+        }))
+    thresholds = pd.Series(np.quantile(flow, 0.8, axis=1), index=sites)
+    result = verify_forecasts(forecasts, obs, range(1, 73), thresholds)
+
+    # Reference: group all pairs and apply hydrotools metrics per cell
+    pairs = pa.concat_tables([forecast_pairs(f, obs) for f in forecasts]).to_pandas()
+    pairs["threshold"] = pairs["usgs_site_code"].map(thresholds)
+    for (site, lead), group in list(pairs.groupby(["usgs_site_code", "lead_hours"]))[::37]:
+        row = result.loc[(site, lead)]
+        ct = metrics.compute_contingency_table(group["obs"] >= group["threshold"],
+            group["sim"] >= group["threshold"])
+        expected = {
+            "root_mean_squared_error": metrics.root_mean_squared_error(group["obs"], group["sim"]),
+            "nash_sutcliffe_efficiency": metrics.nash_sutcliffe_efficiency(group["obs"], group["sim"]),
+            "kling_gupta_efficiency": metrics.kling_gupta_efficiency(group["obs"], group["sim"]),
+            "POD": metrics.probability_of_detection(ct),
+            "TS": metrics.threat_score(ct)
+        }
+        for name, value in expected.items():
+            assert np.isclose(row[name], value, equal_nan=True), (site, lead, name)
+    print(verify_forecasts(forecasts, obs, range(1, 73), thresholds, pooled=True)[
+        ["n", "root_mean_squared_error", "nash_sutcliffe_efficiency", "TS"]].iloc[::12])
+
+if __name__ == "__main__":
+    main()
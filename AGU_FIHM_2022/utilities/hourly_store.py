@@ -0,0 +1,244 @@
+"""
+Memory-mapped store of hourly site panels.
+
+Every site's hourly values are kept as a dense float32 row on a common axis
+of integer hours since 1970-01-01, all rows in one raw memory-mapped file.
+A JSON index holds the site order, the first hour, and the number of hours
+written. Reading a site or a time slice is an offset computation into the
+map, and whole-panel operations can run on the mapped matrix directly:
+
+    store = HourlyStore("obs.hourly")
+    series = store.read("01646500", start="2021-08-26")
+    years, extremes = extremes_matrix(store.panel(), store.days(), steps_per_day=24)
+
+Each row reserves capacity for future hours, so appending new hours writes
+into the reserved space; the file is only rewritten, with doubled capacity,
+when that space runs out. New sites are appended as new rows at the end of
+the file, without rewriting the rows already written.
+"""
+from typing import Iterable, Optional, Union
+from pathlib import Path
+import json
+import os
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+import pyarrow as pa
+
+HOUR_NS: int = 3_600_000_000_000
+
+def to_epoch_hours(times: Union[pd.Timestamp, str, npt.ArrayLike]) -> npt.NDArray[np.int64]:
+    """Floor datetimes to integer hours since 1970-01-01."""
+    t = np.asarray(pd.to_datetime(times), dtype="datetime64[ns]").view(np.int64)
+    return np.floor_divide(t, HOUR_NS)
+
+class HourlyStore:
+    """Dense float32 site x hour panel in a memory-mapped file."""
+    index_name: str = "index.json"
+    values_name: str = "values.f32"
+
+    def __init__(self, path: Union[str, Path], mode: str = "r"):
+        self.path = Path(path)
+        self.mode = mode
+        with (self.path / self.index_name).open("r", encoding="utf-8") as fi:
+            index = json.load(fi)
+        self.start_hour: int = index["start_hour"]
+        self.n_hours: int = index["n_hours"]
+        self.capacity: int = index["capacity"]
+        self.sites: list[str] = index["sites"]
+        self.rows: dict[str, int] = {s: i for i, s in enumerate(self.sites)}
+        self._map()
+
+    def _map(self) -> None:
+        shape = (len(self.sites), self.capacity)
+        if shape[0] == 0:
+            self.values = np.empty(shape, dtype=np.float32)
+            return
+        self.values = np.memmap(self.path / self.values_name, dtype=np.float32,
+            mode="r+" if self.mode != "r" else "r", shape=shape)
+
+    @classmethod
+    def create(
+        cls,
+        path: Union[str, Path],
+        start: Union[pd.Timestamp, str],
+        sites: Iterable[str] = (),
+        capacity: int = 24 * 366
+    ) -> "HourlyStore":
+        """Create an empty store whose hour axis begins at start."""
+        path = Path(path)
+        path.mkdir(exist_ok=True, parents=True)
+        sites = [str(s) for s in sites]
+        values = np.memmap(path / cls.values_name, dtype=np.float32, mode="w+",
+            shape=(max(len(sites), 1), capacity))
+        values[:] = np.nan
+        values.flush()
+        del values
+        cls._write_index(path, int(to_epoch_hours(start)), 0, capacity, sites)
+        return cls(path, mode="r+")
+
+    @classmethod
+    def _write_index(cls, path: Path, start_hour: int, n_hours: int, capacity: int, sites: list[str]) -> None:
+        partial = path / f"{cls.index_name}.partial"
+        with partial.open("w", encoding="utf-8") as fo:
+            json.dump({"start_hour": start_hour, "n_hours": n_hours,
+                "capacity": capacity, "sites": sites}, fo)
+        os.replace(partial, path / cls.index_name)
+
+    @property
+    def hours(self) -> npt.NDArray[np.int64]:
+        """Epoch hour of each written column."""
+        return np.arange(self.start_hour, self.start_hour + self.n_hours)
+
+    @property
+    def times(self) -> pd.DatetimeIndex:
+        return pd.DatetimeIndex(self.hours * HOUR_NS, name="value_time")
+
+    def days(self) -> npt.NDArray[np.int64]:
+        """Day since 1970-01-01 of each column, e.g. for extremes_matrix."""
+        return self.hours // 24
+
+    def _columns(self, start, end) -> slice:
+        lo = 0 if start is None else int(to_epoch_hours(start)) - self.start_hour
+        hi = self.n_hours if end is None else int(to_epoch_hours(end)) - self.start_hour + 1
+        return slice(min(max(lo, 0), self.n_hours), min(max(hi, 0), self.n_hours))
+
+    def panel(self, sites: Optional[Iterable[str]] = None, start=None, end=None) -> npt.NDArray[np.float32]:
+        """Site x hour matrix. All sites is a view of the map, a subset of
+        sites is gathered into memory."""
+        columns = self._columns(start, end)
+        if sites is None:
+            return self.values[:, columns]
+        rows = [self.rows[str(s)] for s in sites]
+        return self.values[rows, columns]
+
+    def read(self, site: str, start=None, end=None) -> pd.Series:
+        """Hourly series of one site, backed by the map."""
+        columns = self._columns(start, end)
+        return pd.Series(self.values[self.rows[str(site)], columns],
+            index=self.times[columns], name=str(site))
+
+    def _resize(self, n_sites: int, capacity: int) -> None:
+        # Rewrite the file with more rows or a longer hour axis
+        old = self.values
+        partial = self.path / f"{self.values_name}.partial"
+        values = np.memmap(partial, dtype=np.float32, mode="w+", shape=(max(n_sites, 1), capacity))
+        values[:] = np.nan
+        values[:old.shape[0], :min(old.shape[1], capacity)] = old[:, :capacity]
+        values.flush()
+        del values, old
+        self.values = None
+        os.replace(partial, self.path / self.values_name)
+        self.capacity = capacity
+
+    def _extend(self, n_sites: int) -> None:
+        # Append rows to the end of the file, dropping any rows left by an
+        # interrupted extension (an empty store holds one placeholder row)
+        self.values = None
+        row = np.full(self.capacity, np.nan, dtype=np.float32).tobytes()
+        n_rows = max(len(self.sites), 1)
+        with (self.path / self.values_name).open("r+b") as fo:
+            fo.truncate(n_rows * len(row))
+            fo.seek(0, os.SEEK_END)
+            for _ in range(n_rows, n_sites):
+                fo.write(row)
+
+    def write(
+        self,
+        data: Union[pd.DataFrame, pa.Table],
+        site: str = "usgs_site_code",
+        time: str = "value_time",
+        value: str = "value"
+    ) -> None:
+        """Write a long table of hourly values. Times are floored to the hour,
+        later rows overwrite earlier ones. Sites not in the store are added
+        and hours past the end are appended.
+        """
+        if self.mode == "r":
+            raise ValueError("Store is open read-only")
+        if isinstance(data, pa.Table):
+            data = data.select([site, time, value]).to_pandas()
+        codes, labels = pd.factorize(data[site])
+        labels = [str(s) for s in labels]
+        hours = to_epoch_hours(data[time]) - self.start_hour
+        if len(hours) and hours.min() < 0:
+            raise ValueError("Cannot write hours before the start of the store")
+
+        # Add sites and hours
+        new_sites = [s for s in labels if s not in self.rows]
+        n_hours = max(self.n_hours, int(hours.max()) + 1 if len(hours) else 0)
+        capacity = self.capacity
+        while capacity < n_hours:
+            capacity *= 2
+        grow = capacity != self.capacity
+        if grow:
+            self._resize(len(self.sites) + len(new_sites), capacity)
+        elif new_sites:
+            self._extend(len(self.sites) + len(new_sites))
+        if new_sites or grow:
+            self.sites += new_sites
+            self.rows.update({s: len(self.rows) + i for i, s in enumerate(new_sites)})
+            self._write_index(self.path, self.start_hour, self.n_hours, self.capacity, self.sites)
+            self._map()
+
+        # Scatter values
+        rows = np.array([self.rows[s] for s in labels], dtype=np.int64)[codes]
+        self.values[rows, hours] = data[value].to_numpy(dtype=np.float32)
+        self.values.flush()
+        self.n_hours = n_hours
+        self._write_index(self.path, self.start_hour, self.n_hours, self.capacity, self.sites)
+
+def main():
+    """Round-trip a small panel, add sites without rewriting the file, and
+    append hours past the reserved capacity."""
+    from tempfile import TemporaryDirectory
+
+    def frame(sites, hours):
+        times = pd.Timestamp("2021-08-26") + pd.to_timedelta(hours, unit="h")
+        return pd.DataFrame({
+            "usgs_site_code": np.repeat(sites, len(hours)),
+            "value_time": np.tile(times, len(sites)),
+            "value": np.arange(len(sites) * len(hours), dtype=np.float32) + 1000.0 * len(sites)
+        })
+
+    def check(store, df):
+        for s, group in df.groupby("usgs_site_code"):
+            series = store.read(s, start=group["value_time"].min(), end=group["value_time"].max())
+            assert np.array_equal(series.to_numpy(), group["value"].to_numpy()), s
+
+    with TemporaryDirectory() as tmp:
+        # Round trip
+        first = frame(["01", "02", "03"], np.arange(100))
+        store = HourlyStore.create(tmp, start="2021-08-26", capacity=24 * 7)
+        store.write(first)
+        check(HourlyStore(tmp), first)
+
+        # New sites are appended to the same file
+        inode = os.stat(store.path / store.values_name).st_ino
+        added = frame(["04", "05"], np.arange(50, 120))
+        store.write(added)
+        assert os.stat(store.path / store.values_name).st_ino == inode
+        reopened = HourlyStore(tmp)
+        assert reopened.sites == ["01", "02", "03", "04", "05"]
+        assert reopened.n_hours == 120 and np.isnan(reopened.read("04", end="2021-08-28 01:00")).all()
+        check(reopened, first)
+        check(reopened, added)
+
+        # Hours past the capacity rewrite the file with doubled capacity
+        later = frame(["02", "05"], np.arange(160, 200))
+        store.write(later)
+        reopened = HourlyStore(tmp)
+        assert reopened.capacity == 24 * 14 and reopened.n_hours == 200
+        check(reopened, first[first["usgs_site_code"] != "02"])
+        check(reopened, added[(added["usgs_site_code"] != "05")])
+        check(reopened, later)
+        # New sites after the rewrite
+        last = frame(["06"], np.arange(190, 210))
+        store.write(last)
+        reopened = HourlyStore(tmp)
+        check(reopened, last)
+        print(f"{len(reopened.sites)} sites x {reopened.n_hours} hours round-tripped")
+
+if __name__ == "__main__":
+    main()
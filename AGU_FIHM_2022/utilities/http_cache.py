@@ -0,0 +1,285 @@
+"""
+On-disk HTTP response cache for the USGS and NLDI web service clients.
+
+Responses are keyed on the normalized URL and query parameters (scheme and
+host lowercased, default ports dropped, parameters merged and sorted), so
+the same request always maps to the same entry regardless of how the URL
+was built. Each endpoint has a time to live. Fresh entries are returned
+without a request. Stale entries with an ETag or Last-Modified validator
+are revalidated with a conditional request, and a 304 response renews the
+entry without downloading the body again. All clients share one pooled
+requests.Session that asks for gzip responses.
+
+    session = get_session()
+    with session.get(url, params=params) as response:
+        text = response.text
+
+The cache location and TTLs are set with configure() or the environment
+variable WORKFLOW_HTTP_CACHE.
+"""
+from typing import Any, Optional
+from dataclasses import dataclass, field
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import hashlib
+import json
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Time to live in seconds of responses by URL prefix, longest prefix wins
+DEFAULT_TTLS: dict[str, float] = {
+    "https://waterservices.usgs.gov/nwis/site": 30 * 86400.0,
+    "https://nwis.waterdata.usgs.gov/nwis/peak": 7 * 86400.0,
+    "https://labs.waterdata.usgs.gov/api/nldi": 30 * 86400.0,
+    "https://waterdata.usgs.gov/nwisweb/get_ratings": 86400.0
+}
+
+@dataclass
+class CacheConfig:
+    cache_dir: Path = Path("http_cache")
+    ttls: dict[str, float] = field(default_factory=lambda: dict(DEFAULT_TTLS))
+    default_ttl: float = 86400.0
+    pool_maxsize: int = 10
+
+def _default_config() -> CacheConfig:
+    cache_dir = os.environ.get("WORKFLOW_HTTP_CACHE")
+    return CacheConfig(cache_dir=Path(cache_dir)) if cache_dir else CacheConfig()
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    revalidated: int = 0
+    misses: int = 0
+
+    @property
+    def requests(self) -> int:
+        return self.hits + self.revalidated + self.misses
+
+    @property
+    def hit_ratio(self) -> float:
+        """Fraction of requests answered without downloading a body."""
+        return (self.hits + self.revalidated) / self.requests if self.requests else 0.0
+
+def normalize_url(url: str, params: Optional[dict[str, Any]] = None) -> str:
+    """Canonical form of a URL and its query parameters."""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host += f":{parts.port}"
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    query += [(k, str(v)) for k, v in (params or {}).items()]
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(sorted(query)), ""))
+
+def cache_key(url: str, params: Optional[dict[str, Any]] = None) -> str:
+    """File name stem of a cache entry."""
+    return hashlib.sha256(normalize_url(url, params).encode()).hexdigest()
+
+class CachedResponse:
+    """The parts of a requests.Response the clients use, from the network
+    or the cache."""
+
+    def __init__(self, url: str, status_code: int, headers: dict[str, str],
+        content: bytes, from_cache: bool, encoding: Optional[str] = None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.from_cache = from_cache
+        self.encoding = encoding or requests.utils.get_encoding_from_headers(headers) or "utf-8"
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} for {self.url}")
+
+    def __enter__(self) -> "CachedResponse":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+class CachedSession:
+    """A pooled requests.Session with an on-disk response cache for GET."""
+
+    def __init__(self, config: CacheConfig):
+        self.config = config
+        self.stats = CacheStats()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=config.pool_maxsize, pool_maxsize=config.pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def ttl(self, url: str) -> float:
+        """Time to live of the endpoint serving a normalized URL."""
+        prefixes = [p for p in self.config.ttls if url.startswith(normalize_url(p).rstrip("/"))]
+        if not prefixes:
+            return self.config.default_ttl
+        return self.config.ttls[max(prefixes, key=len)]
+
+    def _paths(self, key: str) -> tuple[Path, Path]:
+        directory = self.config.cache_dir / key[:2]
+        return directory / f"{key}.json", directory / f"{key}.body"
+
+    def _load(self, key: str) -> Optional[dict[str, Any]]:
+        meta_path, body_path = self._paths(key)
+        if not (meta_path.exists() and body_path.exists()):
+            return None
+        with meta_path.open("r", encoding="utf-8") as fi:
+            return json.load(fi)
+
+    def _store(self, key: str, url: str, response: requests.Response) -> None:
+        meta_path, body_path = self._paths(key)
+        meta_path.parent.mkdir(exist_ok=True, parents=True)
+        partial = body_path.with_suffix(f".{os.getpid()}.partial")
+        partial.write_bytes(response.content)
+        os.replace(partial, body_path)
+        self._write_meta(meta_path, {
+            "url": url,
+            "status_code": response.status_code,
+            "encoding": response.encoding,
+            "headers": {k: response.headers[k] for k in ("Content-Type", "ETag", "Last-Modified")
+                if k in response.headers},
+            "stored": time.time(),
+            "expires": time.time() + self.ttl(url)
+        })
+
+    @staticmethod
+    def _write_meta(path: Path, meta: dict[str, Any]) -> None:
+        # Metadata is written last and atomically, a partial body is never referenced
+        partial = path.with_suffix(f".{os.getpid()}.partial")
+        with partial.open("w", encoding="utf-8") as fo:
+            json.dump(meta, fo)
+        os.replace(partial, path)
+
+    def _cached(self, key: str, meta: dict[str, Any]) -> CachedResponse:
+        _, body_path = self._paths(key)
+        return CachedResponse(meta["url"], meta["status_code"], meta["headers"],
+            body_path.read_bytes(), from_cache=True, encoding=meta.get("encoding"))
+
+    def get(self, url: str, params: Optional[dict[str, Any]] = None, **kwargs) -> CachedResponse:
+        """GET with caching. Only 200 responses are cached."""
+        normalized = normalize_url(url, params)
+        key = cache_key(url, params)
+        meta = self._load(key)
+
+        # Fresh entry
+        if meta is not None and time.time() < meta["expires"]:
+            self.stats.hits += 1
+            return self._cached(key, meta)
+
+        # Stale entry, revalidate if the server gave a validator
+        headers = dict(kwargs.pop("headers", None) or {})
+        if meta is not None:
+            if "ETag" in meta["headers"]:
+                headers["If-None-Match"] = meta["headers"]["ETag"]
+            if "Last-Modified" in meta["headers"]:
+                headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+        response = self.session.get(url, params=params, headers=headers, **kwargs)
+        if meta is not None and response.status_code == 304:
+            self.stats.revalidated += 1
+            meta["expires"] = time.time() + self.ttl(normalized)
+            self._write_meta(self._paths(key)[0], meta)
+            return self._cached(key, meta)
+
+        # New content
+        self.stats.misses += 1
+        if response.status_code == 200:
+            self._store(key, normalized, response)
+        return CachedResponse(response.url, response.status_code, dict(response.headers),
+            response.content, from_cache=False, encoding=response.encoding)
+
+    def close(self) -> None:
+        self.session.close()
+
+CONFIG: CacheConfig = _default_config()
+_SESSION: list[Optional[CachedSession]] = [None]
+
+def configure(**kwargs: Any) -> CacheConfig:
+    """Update the cache configuration. The shared session is restarted on
+    next use."""
+    for key, value in kwargs.items():
+        if not hasattr(CONFIG, key):
+            raise ValueError(f"Unknown cache option: {key}")
+        setattr(CONFIG, key, Path(value) if key == "cache_dir" else value)
+    if _SESSION[0] is not None:
+        _SESSION[0].close()
+        _SESSION[0] = None
+    return CONFIG
+
+def get_session() -> CachedSession:
+    """Return the process-wide cached session, starting it on first use."""
+    if _SESSION[0] is None:
+        _SESSION[0] = CachedSession(CONFIG)
+    return _SESSION[0]
+
+def main():
+    """Check hit ratio, revalidation, and gzip against a local stand-in server."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from tempfile import mkdtemp
+    from threading import Thread
+    import gzip
+
+    served = {"bodies": 0, "not_modified": 0, "gzip": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # Same body and validators for every resource
+            body = ("site_no\tpeak_va\n" + "01646500\t1000\n" * 200).encode()
+            etag = '"v1"'
+            if self.headers.get("If-None-Match") == etag:
+                served["not_modified"] += 1
+                self.send_response(304)
+                self.end_headers()
+                return
+            served["bodies"] += 1
+            compress = "gzip" in self.headers.get("Accept-Encoding", "")
+            if compress:
+                served["gzip"] += 1
+                body = gzip.compress(body)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            if compress:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # Metadata cached for an hour, peaks always stale and revalidated
+    configure(cache_dir=mkdtemp(), ttls={f"{base}/peak": 0.0}, default_ttl=3600.0)
+    session = get_session()
+    for _ in range(5):
+        session.get(f"{base}/site/", params={"sites": "01646500", "format": "rdb"})
+        session.get(f"{base}/site/?format=rdb", params={"sites": "01646500"})
+        with session.get(f"{base}/peak/", params={"multiple_site_no": "01646500"}) as response:
+            assert response.text.startswith("site_no")
+    server.shutdown()
+
+    stats = session.stats
+    print(f"Requests: {stats.requests}, hits: {stats.hits}, "
+        f"revalidated: {stats.revalidated}, misses: {stats.misses}")
+    print(f"Hit ratio: {stats.hit_ratio:.2f}, bodies served: {served['bodies']}, "
+        f"304 responses: {served['not_modified']}, gzip responses: {served['gzip']}")
+    assert stats.misses == 2 and stats.hits == 9 and stats.revalidated == 4
+    assert served["bodies"] == served["gzip"] == 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Incremental site evaluation from sufficient statistics.
+
+The state is one row per site of summed STATISTICS (see
+forecast_verification) and the last hour folded in. New pairs are reduced
+to the same sums with bincount and added to the state, so a daily update
+costs one day of pairs and metrics (NSE, KGE, RMSE, bias, POD, POFA, TS)
+are derived from the state without the history of pairs:
+
+    evaluator = IncrementalEvaluator.load("evaluation_state.arrow") or IncrementalEvaluator()
+    evaluator.add(pairs, thresholds)
+    evaluator.save("evaluation_state.arrow")
+    ct = evaluator.metrics()
+
+Pairs at or before a site's last folded hour are skipped, so folding the
+same day twice does not count it twice.
+"""
+from typing import Optional, Union
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .arrow_tables import HOUR_NS, values, epoch_ns, sorted_sites, site_codes
+from .forecast_verification import STATISTICS, cell_statistics, metrics_from_statistics
+from .scheduler import write_result, read_result
+
+# Hour before any data
+NO_HOUR: int = np.iinfo(np.int64).min
+
+class IncrementalEvaluator:
+    """Per-site sufficient statistics that new pairs are folded into.
+
+    Parameters
+    ----------
+    state: pandas.DataFrame, optional
+        State of a previous evaluator, indexed by site with STATISTICS and
+        last_hour columns.
+    """
+
+    def __init__(self, state: Optional[pd.DataFrame] = None):
+        if state is None:
+            state = pd.DataFrame(columns=[*STATISTICS, "last_hour"],
+                index=pd.Index([], name="usgs_site_code"))
+        self.sites = np.asarray(state.index.astype(str), dtype=object)
+        self.stats = state[list(STATISTICS)].to_numpy(dtype=np.float64).T.copy()
+        self.last_hour = state["last_hour"].to_numpy(dtype=np.int64).copy()
+
+    def _extend(self, sites: np.ndarray) -> None:
+        # Add new sites in sorted order, existing rows move with them
+        new = np.setdiff1d(sites, self.sites)
+        if not len(new):
+            return
+        merged = np.union1d(self.sites, new).astype(object)
+        rows = np.searchsorted(merged, self.sites)
+        stats = np.zeros((len(STATISTICS), len(merged)))
+        stats[:, rows] = self.stats
+        last_hour = np.full(len(merged), NO_HOUR, dtype=np.int64)
+        last_hour[rows] = self.last_hour
+        self.sites, self.stats, self.last_hour = merged, stats, last_hour
+
+    def add(
+        self,
+        pairs: pa.Table,
+        thresholds: Optional[pd.Series] = None,
+        site: str = "usgs_site_code",
+        time: str = "value_time"
+    ) -> int:
+        """Fold pairs (site, time, sim, obs columns, as returned by
+        arrow_tables.pair) into the state. thresholds holds the flood
+        threshold of each site for the contingency counts; sites without
+        one are left out of the counts. Returns the number of pairs added.
+        """
+        if not pairs.num_rows:
+            return 0
+        column = pairs[site].cast(pa.string())
+        self._extend(sorted_sites(column).to_numpy(zero_copy_only=False))
+        codes, _ = site_codes(column, pa.array(self.sites, type=pa.string()))
+        hours = epoch_ns(pairs[time]) // HOUR_NS
+
+        # Only hours after each site's last folded hour
+        keep = np.flatnonzero(hours > self.last_hour[codes])
+        codes, hours = codes[keep], hours[keep]
+        threshold = None
+        if thresholds is not None:
+            threshold = thresholds.reindex(self.sites).to_numpy(dtype=np.float64)[codes]
+        self.stats += cell_statistics(codes, len(self.sites),
+            values(pairs["sim"])[keep], values(pairs["obs"])[keep], threshold)
+        np.maximum.at(self.last_hour, codes, hours)
+        return len(keep)
+
+    @property
+    def state(self) -> pd.DataFrame:
+        """Sufficient statistics and last folded hour of every site."""
+        state = pd.DataFrame(self.stats.T, columns=list(STATISTICS),
+            index=pd.Index(self.sites, name="usgs_site_code"))
+        state["last_hour"] = self.last_hour
+        return state
+
+    def metrics(self) -> pd.DataFrame:
+        """Metrics of every site from the state, with the summed statistics
+        (so the result can be rolled up with utilities.rollup)."""
+        metrics = metrics_from_statistics(self.stats)
+        ct = self.state
+        ct["last_time"] = pd.to_datetime(np.where(self.last_hour == NO_HOUR, 0,
+            self.last_hour) * HOUR_NS)
+        for name in ["mean_error", "mean_absolute_error", "root_mean_squared_error",
+                "nash_sutcliffe_efficiency", "kling_gupta_efficiency", "POD", "POFA", "TS"]:
+            ct[name] = metrics[name]
+        return ct
+
+    def save(self, path: Union[str, Path]) -> None:
+        write_result(Path(path), self.state, "evaluation_state")
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Optional["IncrementalEvaluator"]:
+        if not Path(path).exists():
+            return None
+        return cls(read_result(Path(path)))
+
+def main():
+    """Fold 30 days of synthetic pairs one day at a time, with a repeated
+    day and sites appearing late, and compare with hydrotools metrics
+    computed from all pairs at once."""
+    from tempfile import mkdtemp
+    from hydrotools.metrics import metrics
+    rng = np.random.default_rng(2024)
+    sites = [f"0{i:07d}" for i in range(1, 41)]
+    hours = pd.date_range("2021-08-01", periods=30 * 24, freq="1h")
+    obs = rng.lognormal(3.0, 0.8, (len(sites), len(hours)))
+    sim = obs * rng.lognormal(0.1, 0.4, obs.shape)
+    thresholds = pd.Series(np.quantile(obs, 0.8, axis=1), index=sites)
+    thresholds.iloc[-1] = np.nan
+    first_day = np.where(np.arange(len(sites)) < 30, 0, 10)
+    frame = pd.DataFrame({
+        "usgs_site_code": np.repeat(sites, len(hours)),
+        "value_time": np.tile(hours, len(sites)),
+        "sim": sim.ravel(),
+        "obs": obs.ravel()
+    })
+    frame = frame[frame["value_time"].dt.dayofyear - hours[0].dayofyear >=
+        np.repeat(first_day, len(hours))]
+
+    # One day at a time, the state saved and loaded between days
+    path = Path(mkdtemp()) / "evaluation_state.arrow"
+    day = frame["value_time"].dt.floor("1D")
+    for d in day.unique():
+        evaluator = IncrementalEvaluator.load(path) or IncrementalEvaluator()
+        batch = pa.Table.from_pandas(frame[day == d], preserve_index=False)
+        evaluator.add(batch, thresholds)
+        if d == day.unique()[5]:
+            assert evaluator.add(batch, thresholds) == 0
+        evaluator.save(path)
+    result = IncrementalEvaluator.load(path).metrics()
+
+    # Full recomputation
+    for s, group in frame.groupby("usgs_site_code"):
+        y_sim, y_obs = group["sim"], group["obs"]
+        assert result.loc[s, "n"] == len(group)
+        assert np.isclose(result.loc[s, "nash_sutcliffe_efficiency"],
+            metrics.nash_sutcliffe_efficiency(y_obs, y_sim))
+        assert np.isclose(result.loc[s, "kling_gupta_efficiency"],
+            metrics.kling_gupta_efficiency(y_obs, y_sim))
+        assert np.isclose(result.loc[s, "root_mean_squared_error"],
+            metrics.root_mean_squared_error(y_obs, y_sim))
+        assert np.isclose(result.loc[s, "mean_absolute_error"], metrics.mean_error(y_obs, y_sim))
+        assert np.isclose(result.loc[s, "mean_error"], (y_sim - y_obs).mean())
+        if np.isnan(thresholds[s]):
+            assert result.loc[s, "true_positive":"true_negative"].sum() == 0
+            continue
+        ct = metrics.compute_contingency_table(y_obs >= thresholds[s], y_sim >= thresholds[s])
+        for name in ["true_positive", "false_positive", "false_negative", "true_negative"]:
+            assert result.loc[s, name] == ct[name], name
+        assert np.isclose(result.loc[s, "TS"], metrics.threat_score(ct))
+        assert np.isclose(result.loc[s, "POD"], metrics.probability_of_detection(ct))
+        assert np.isclose(result.loc[s, "POFA"], metrics.probability_of_false_alarm(ct))
+    print(f"{len(result)} sites, {int(result['n'].sum())} pairs folded in "
+        f"{day.nunique()} days match the full recomputation")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Lightweight stage instrumentation for workflow scripts.
+
+Each stage records wall time, CPU time, peak resident set size, an
+optional row count, and the number and size of full table copies reported
+with count_copy, and appends one JSON object per stage to a trace file.
+Optionally, each stage is also run under cProfile and its statistics,
+including those of the stages nested in it, are dumped to one file per run
+of the stage, {stage}.{pid}.{n}.prof, for inspection with pstats or
+snakeviz.
+
+Tracing is configured with configure() or the environment variables
+WORKFLOW_TRACE (path of the JSON-lines trace) and WORKFLOW_PROFILE_DIR
+(directory for per-stage .prof files). With neither set, stages are still
+timed and the record is available from the context manager but nothing is
+written.
+
+    with stage("get_sim") as record:
+        df = ...
+        record.rows = len(df)
+
+    @profiled("get_obs")
+    def get_obs(...):
+        ...
+"""
+from typing import Any, Callable, Optional
+from dataclasses import dataclass, field, asdict
+from contextlib import contextmanager
+from functools import wraps
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter, process_time
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+
+@dataclass
+class TraceConfig:
+    trace_path: Optional[Path] = None
+    profile_dir: Optional[Path] = None
+
+@dataclass
+class StageRecord:
+    stage: str
+    started: str = ""
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_rss_mb: float = 0.0
+    rss_growth_mb: float = 0.0
+    rows: Optional[int] = None
+    copies: int = 0
+    copied_mb: float = 0.0
+    status: str = "ok"
+    extra: dict[str, Any] = field(default_factory=dict)
+
+def _default_config() -> TraceConfig:
+    trace = os.environ.get("WORKFLOW_TRACE")
+    profile = os.environ.get("WORKFLOW_PROFILE_DIR")
+    return TraceConfig(
+        trace_path=Path(trace) if trace else None,
+        profile_dir=Path(profile) if profile else None
+    )
+
+CONFIG: TraceConfig = _default_config()
+
+# Profilers of the stages currently running, outermost first. Only the
+# innermost is enabled, a stage's dump adds the dumps of its nested stages.
+_PROFILERS: list[tuple[cProfile.Profile, list[Path]]] = []
+
+# Records of the stages currently running, outermost first
+_ACTIVE: list[StageRecord] = []
+
+# Number of profiles dumped by each stage name in this process
+_DUMPS: dict[str, int] = {}
+
+def configure(trace_path: Optional[Path] = None, profile_dir: Optional[Path] = None) -> TraceConfig:
+    """Set the trace file and cProfile output directory for this process."""
+    CONFIG.trace_path = Path(trace_path) if trace_path else None
+    CONFIG.profile_dir = Path(profile_dir) if profile_dir else None
+    return CONFIG
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    if sys.platform == "darwin":
+        return peak / 1024.0 ** 2.0
+    return peak / 1024.0
+
+def write_record(record: StageRecord) -> None:
+    """Append a stage record to the configured JSON-lines trace."""
+    if CONFIG.trace_path is None:
+        return
+    CONFIG.trace_path.parent.mkdir(exist_ok=True, parents=True)
+    with CONFIG.trace_path.open("a", encoding="utf-8") as fo:
+        fo.write(json.dumps(asdict(record)) + "\n")
+
+def count_copy(nbytes: int) -> None:
+    """Report a copy of nbytes of table data to every running stage."""
+    for record in _ACTIVE:
+        record.copies += 1
+        record.copied_mb += nbytes / 1024.0 ** 2.0
+
+def dump_profile(profiler: cProfile.Profile, nested: list[Path], path: Path) -> None:
+    """Dump a stage's profile together with the dumps of its nested stages."""
+    path.parent.mkdir(exist_ok=True, parents=True)
+    stats = pstats.Stats(profiler)
+    for p in nested:
+        stats.add(str(p))
+    stats.dump_stats(path)
+
+@contextmanager
+def stage(name: str, rows: Optional[int] = None, **extra):
+    """Time a block of code as a named stage. Yields the StageRecord so
+    the block can set rows or add extra fields.
+    """
+    # Start
+    record = StageRecord(stage=name, rows=rows, extra=dict(extra))
+    record.started = datetime.now(timezone.utc).isoformat()
+    profiler = None
+    if CONFIG.profile_dir:
+        if _PROFILERS:
+            _PROFILERS[-1][0].disable()
+        profiler = cProfile.Profile()
+        _PROFILERS.append((profiler, []))
+    rss_start = peak_rss_mb()
+    wall_start = perf_counter()
+    cpu_start = process_time()
+    if profiler:
+        profiler.enable()
+    _ACTIVE.append(record)
+
+    # Run the stage
+    try:
+        yield record
+    except BaseException:
+        record.status = "error"
+        raise
+    finally:
+        _ACTIVE.remove(record)
+        if profiler:
+            profiler.disable()
+            _, nested = _PROFILERS.pop()
+        record.wall_seconds = perf_counter() - wall_start
+        record.cpu_seconds = process_time() - cpu_start
+        record.peak_rss_mb = peak_rss_mb()
+        record.rss_growth_mb = record.peak_rss_mb - rss_start
+        if profiler:
+            _DUMPS[name] = _DUMPS.get(name, 0) + 1
+            path = CONFIG.profile_dir / f"{name}.{os.getpid()}.{_DUMPS[name]}.prof"
+            dump_profile(profiler, nested, path)
+            if _PROFILERS:
+                _PROFILERS[-1][1].append(path)
+                _PROFILERS[-1][0].enable()
+        write_record(record)
+
+def count_rows(result: Any) -> Optional[int]:
+    """Row count of a stage result, if it has one."""
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+def profiled(name: Optional[str] = None, rows: Callable[[Any], Optional[int]] = count_rows):
+    """Decorate a function to run as a named stage. The row count is
+    taken from the return value.
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name) as record:
+                result = func(*args, **kwargs)
+                record.rows = rows(result)
+            return result
+        return wrapper
+    return decorator
+
+def read_trace(trace_path: Path) -> list[dict[str, Any]]:
+    """Load a JSON-lines trace, e.g. to compare nightly runs with pandas.DataFrame(records)."""
+    with Path(trace_path).open("r", encoding="utf-8") as fi:
+        return [json.loads(line) for line in fi if line.strip()]
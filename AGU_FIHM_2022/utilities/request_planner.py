@@ -0,0 +1,274 @@
+"""
+Planned retrieval of instantaneous values for many sites and long periods.
+
+Rather than one IVDataService request for every site over the whole period,
+the sites x time range is split into tiles of about the same expected number
+of rows. Tiles are requested with bounded concurrency and each response is
+written to its own Arrow IPC file as soon as it arrives, so responses are not
+held in memory and a rerun only requests the tiles that failed:
+
+    tiles = plan_tiles(sites, "2021-08-26", "2021-09-06", max_rows=500_000)
+    status = run_tiles(IVDataService().get, tiles, TileStore("obs_tiles"))
+
+retrieve_observations does both and returns the combined observations.
+"""
+from typing import Any, Callable, Iterable, Optional, Union
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from threading import Lock
+import hashlib
+import time
+
+import numpy as np
+import pandas as pd
+
+from .scheduler import write_result, read_result, read_signature
+
+@dataclass(frozen=True)
+class Tile:
+    sites: tuple[str, ...]
+    start: pd.Timestamp
+    end: pd.Timestamp
+    expected_rows: int
+
+    @property
+    def key(self) -> str:
+        """File name stem of this tile, unique to its sites and time range."""
+        spec = "|".join((*self.sites, self.start.isoformat(), self.end.isoformat()))
+        return f"{self.start:%Y%m%dT%H%M}_{hashlib.sha1(spec.encode()).hexdigest()[:16]}"
+
+def plan_tiles(
+    sites: Iterable[str],
+    start: Union[str, pd.Timestamp],
+    end: Union[str, pd.Timestamp],
+    step: Union[str, pd.Timedelta] = "15min",
+    max_rows: int = 500_000,
+    max_sites: int = 100
+) -> list[Tile]:
+    """Split a request for sites over start to end (inclusive) into tiles of
+    at most max_sites sites and about max_rows expected rows each.
+
+    Sites are split first, so tiles keep the full time range unless a single
+    site's record is longer than max_rows. Both splits are balanced, every
+    tile has about the same number of sites and the same time span.
+
+    Parameters
+    ----------
+    sites: iterable of str
+        Site codes.
+    start, end: str or pandas.Timestamp
+        Inclusive time range.
+    step: str or pandas.Timedelta, optional
+        Expected time between values of one site.
+    max_rows: int, optional
+        Largest number of expected rows in one request.
+    max_sites: int, optional
+        Largest number of sites in one request.
+
+    Returns
+    -------
+    List of Tile.
+    """
+    sites = sorted({str(s) for s in sites})
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    step = pd.Timedelta(step)
+    if not sites:
+        return []
+    rows_per_site = (end - start) // step + 1
+
+    # Time pieces when one site is too long, then sites per tile
+    n_times = -(-rows_per_site // max_rows)
+    piece_rows = -(-rows_per_site // n_times)
+    sites_per_tile = max(1, min(max_sites, max_rows // piece_rows))
+    n_groups = -(-len(sites) // sites_per_tile)
+
+    # Piece boundaries on whole steps, inclusive ends
+    edges = [start + step * (k * (rows_per_site - 1) // n_times) for k in range(n_times)] + [end]
+    pieces = [(edges[k], edges[k+1] - pd.Timedelta("1min") if k < n_times - 1 else end)
+        for k in range(n_times)]
+    tiles = []
+    for group in np.array_split(np.array(sites), n_groups):
+        for piece_start, piece_end in pieces:
+            rows = len(group) * ((piece_end - piece_start) // step + 1)
+            tiles.append(Tile(tuple(str(s) for s in group), piece_start, piece_end, int(rows)))
+    return tiles
+
+class TileStore:
+    """Directory of tile responses, one Arrow IPC file per tile."""
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+
+    def path(self, tile: Tile) -> Path:
+        return self.directory / f"{tile.key}.arrow"
+
+    def is_done(self, tile: Tile) -> bool:
+        return read_signature(self.path(tile)) == tile.key
+
+    def write(self, tile: Tile, df: pd.DataFrame) -> None:
+        write_result(self.path(tile), df, tile.key)
+
+    def read(self, tiles: Iterable[Tile]) -> pd.DataFrame:
+        """Combined responses of tiles."""
+        frames = [read_result(self.path(t)) for t in tiles]
+        frames = [f for f in frames if f is not None and not f.empty]
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+def run_tiles(
+    fetch: Callable[..., pd.DataFrame],
+    tiles: Iterable[Tile],
+    store: TileStore,
+    max_concurrency: int = 4,
+    retries: int = 2,
+    backoff: float = 5.0
+) -> dict[str, dict[str, Any]]:
+    """Request every tile not already in the store and write each response
+    as it arrives. Failed tiles are retried up to retries more times, waiting
+    backoff seconds (doubling) between rounds.
+
+    fetch is called as fetch(sites=..., startDT=..., endDT=...), for example
+    IVDataService().get.
+
+    Returns the status (done or failed), attempts, and last error of every tile.
+    """
+    tiles = list(tiles)
+    status = {t.key: {"status": "done", "attempts": 0, "error": None}
+        for t in tiles if store.is_done(t)}
+    pending = [t for t in tiles if t.key not in status]
+
+    def request(tile: Tile) -> pd.DataFrame:
+        return fetch(sites=list(tile.sites), startDT=tile.start, endDT=tile.end)
+
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        # Responses are written by this thread as they complete
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = {executor.submit(request, t): t for t in pending}
+            for future in as_completed(futures):
+                tile = futures[future]
+                try:
+                    store.write(tile, future.result())
+                except Exception as e:
+                    failed.append(tile)
+                    status[tile.key] = {"status": "failed", "attempts": attempt + 1,
+                        "error": f"{type(e).__name__}: {e}"}
+                else:
+                    status[tile.key] = {"status": "done", "attempts": attempt + 1, "error": None}
+        pending = failed
+    return status
+
+def retrieve_observations(
+    sites: Iterable[str],
+    startDT: Union[str, pd.Timestamp],
+    endDT: Union[str, pd.Timestamp],
+    tile_dir: Union[str, Path],
+    fetch: Optional[Callable[..., pd.DataFrame]] = None,
+    max_concurrency: int = 4,
+    retries: int = 2,
+    **kwargs
+) -> pd.DataFrame:
+    """Retrieve instantaneous values in planned tiles (keyword arguments are
+    passed to plan_tiles). Raises RuntimeError if tiles still fail after
+    retries; rerunning requests only the missing tiles.
+    """
+    if fetch is None:
+        from hydrotools.nwis_client.iv import IVDataService
+        fetch = IVDataService().get
+    tiles = plan_tiles(sites, startDT, endDT, **kwargs)
+    store = TileStore(tile_dir)
+    status = run_tiles(fetch, tiles, store, max_concurrency=max_concurrency, retries=retries)
+    failed = sorted(k for k, s in status.items() if s["status"] != "done")
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(tiles)} tiles failed, rerun to "
+            f"retrieve them: {status[failed[0]]['error']}")
+    return store.read(tiles)
+
+class StubIVService:
+    """Local stand-in for IVDataService. Returns 15-minute values that depend
+    only on site and time, rejects requests larger than max_rows, and fails
+    calls at random with probability failure_rate.
+    """
+
+    def __init__(self, max_rows: int = 1_000_000, failure_rate: float = 0.0, seed: int = 0):
+        self.max_rows = max_rows
+        self.failure_rate = failure_rate
+        self.rng = np.random.default_rng(seed)
+        self.lock = Lock()
+        self.calls: list[tuple[int, int]] = []
+
+    def get(self, sites: Iterable[str], startDT, endDT) -> pd.DataFrame:
+        sites = [str(s) for s in sites]
+        times = pd.date_range(pd.Timestamp(startDT).ceil("15min"), endDT, freq="15min")
+        rows = len(sites) * len(times)
+        with self.lock:
+            self.calls.append((len(sites), rows))
+            fail = self.rng.random() < self.failure_rate
+        if rows > self.max_rows:
+            raise TimeoutError(f"Request for {rows} rows timed out")
+        if fail:
+            raise ConnectionError("Connection reset by stub")
+        hours = times.asi8 // 3_600_000_000_000
+        codes = np.array([int(s) for s in sites])
+        return pd.DataFrame({
+            "usgs_site_code": np.repeat(sites, len(times)),
+            "value_time": np.tile(times, len(sites)),
+            "value": (np.repeat(codes % 1000, len(times)) + np.tile(hours % 97, len(sites))).astype(float),
+            "qualifiers": "P"
+        })
+
+def main():
+    """Tile sizing and failure recovery against the stub service."""
+    from tempfile import mkdtemp
+    sites = [f"{1000000 + 137 * i:08d}" for i in range(300)]
+    start, end = "2021-08-01", "2021-09-30 23:45"
+
+    # One request for everything is too large for the service
+    service = StubIVService(max_rows=100_000)
+    try:
+        service.get(sites, start, end)
+    except TimeoutError as e:
+        print(f"Single request: {e}")
+
+    # Balanced tiles under the limit
+    tiles = plan_tiles(sites, start, end, max_rows=100_000, max_sites=50)
+    sizes = [t.expected_rows for t in tiles]
+    print(f"{len(tiles)} tiles, {min(sizes)} to {max(sizes)} expected rows, "
+        f"{min(len(t.sites) for t in tiles)} to {max(len(t.sites) for t in tiles)} sites")
+    assert max(sizes) <= 100_000
+
+    # Flaky service, retries recover every tile
+    tile_dir = mkdtemp()
+    flaky = StubIVService(max_rows=100_000, failure_rate=0.3, seed=1)
+    status = run_tiles(flaky.get, tiles, TileStore(tile_dir), retries=10, backoff=0.0)
+    retried = sum(s["attempts"] > 1 for s in status.values())
+    print(f"Flaky service: {len(flaky.calls)} calls for {len(tiles)} tiles, {retried} tiles retried")
+    assert all(s["status"] == "done" for s in status.values())
+
+    # Rerun after failures only requests the missing tiles
+    tile_dir = mkdtemp()
+    broken = StubIVService(max_rows=100_000, failure_rate=0.5, seed=2)
+    status = run_tiles(broken.get, tiles, TileStore(tile_dir), retries=0)
+    n_failed = sum(s["status"] == "failed" for s in status.values())
+    healthy = StubIVService(max_rows=100_000)
+    df = retrieve_observations(sites, start, end, tile_dir, fetch=healthy.get,
+        max_rows=100_000, max_sites=50)
+    print(f"Rerun: {n_failed} failed tiles, {len(healthy.calls)} requested again")
+    assert len(healthy.calls) == n_failed
+
+    # Same values as one unlimited request
+    expected = StubIVService(max_rows=10_000_000).get(sites, start, end)
+    df = df.sort_values(["usgs_site_code", "value_time"], ignore_index=True)
+    expected = expected.sort_values(["usgs_site_code", "value_time"], ignore_index=True)
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+    print(f"Retrieved {len(df)} rows")
+
+if __name__ == "__main__":
+    main()
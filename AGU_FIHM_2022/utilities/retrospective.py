@@ -0,0 +1,249 @@
+"""
+Batch retrieval of NWM retrospective streamflow for many channel features.
+
+The Zarr store is opened once, requested features are grouped by the store's
+feature chunks, and time chunks are read concurrently. Each batch is cached
+locally as one Arrow IPC file with a value_time column and one float32 column
+per feature, indexed by a small JSON manifest. Cached features are read back
+through a memory map without copying the column buffers.
+"""
+from typing import Iterable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import xarray as xr
+
+RETROSPECTIVE_URL: str = "s3://noaa-nwm-retrospective-3-0-pds/CONUS/zarr/chrtout.zarr"
+
+def open_retrospective(
+    url: str = RETROSPECTIVE_URL,
+    storage_options: Optional[dict] = None
+) -> xr.Dataset:
+    """Lazily open a retrospective CHRTOUT Zarr store. Public S3 stores are
+    opened anonymously by default. Requires s3fs for S3 URLs.
+    """
+    if storage_options is None and url.startswith("s3://"):
+        storage_options = {"anon": True}
+    backend_kwargs = {"consolidated": True}
+    if storage_options:
+        backend_kwargs["storage_options"] = storage_options
+    return xr.open_dataset(url, engine="zarr", backend_kwargs=backend_kwargs, chunks=None)
+
+def chunk_shape(da: xr.DataArray) -> dict[str, int]:
+    """Chunk size of each dimension of a Zarr-backed variable."""
+    chunks = da.encoding.get("chunks") or da.encoding.get("preferred_chunks")
+    if isinstance(chunks, dict):
+        return dict(chunks)
+    if chunks is None:
+        return dict(da.sizes)
+    return dict(zip(da.dims, chunks))
+
+def read_features(
+    ds: xr.Dataset,
+    feature_ids: Iterable[int],
+    variable: str = "streamflow",
+    max_workers: int = 8
+) -> pd.DataFrame:
+    """Read complete time series for a set of features, returning a
+    time x feature_id DataFrame of float32 values.
+
+    Features are read in groups that share a Zarr feature chunk and each group
+    is read one time chunk per task, so every stored chunk is fetched at most
+    once.
+    """
+    da = ds[variable]
+    chunks = chunk_shape(da)
+    time_chunk = chunks.get("time", da.sizes["time"])
+    feature_chunk = chunks.get("feature_id", da.sizes["feature_id"])
+
+    # Locate features in the store
+    feature_ids = np.unique(np.asarray(list(feature_ids), dtype=np.int64))
+    positions = ds.indexes["feature_id"].get_indexer(feature_ids)
+    if (positions < 0).any():
+        raise KeyError(f"Features not in store: {feature_ids[positions < 0].tolist()}")
+    order = np.argsort(positions)
+    feature_ids, positions = feature_ids[order], positions[order]
+
+    # One task per (feature chunk, time chunk)
+    n_times = da.sizes["time"]
+    time_starts = range(0, n_times, time_chunk)
+    groups = np.split(np.arange(len(positions)),
+        np.flatnonzero(np.diff(positions // feature_chunk)) + 1)
+    values = np.empty((n_times, len(positions)), dtype=np.float32)
+
+    def read_block(group, t0):
+        block = da.isel(time=slice(t0, t0 + time_chunk), feature_id=positions[group])
+        values[t0:t0 + time_chunk, group] = block.transpose("time", "feature_id").values
+
+    # Read concurrently, network bound
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(read_block, g, t0) for g in groups for t0 in time_starts]
+        for f in futures:
+            f.result()
+
+    return pd.DataFrame(values,
+        index=pd.DatetimeIndex(ds.indexes["time"], name="value_time"),
+        columns=pd.Index(feature_ids, name="feature_id"))
+
+class RetrospectiveCache:
+    """Local Arrow IPC cache of retrospective time series."""
+    manifest_name: str = "manifest.json"
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self.manifest_path = self.cache_dir / self.manifest_name
+        if self.manifest_path.exists():
+            with self.manifest_path.open("r", encoding="utf-8") as fi:
+                self.manifest: dict[str, str] = json.load(fi)
+        else:
+            self.manifest = {}
+
+    def missing(self, feature_ids: Iterable[int]) -> list[int]:
+        """Feature IDs that are not cached."""
+        return [int(f) for f in feature_ids if str(int(f)) not in self.manifest]
+
+    def write(self, df: pd.DataFrame) -> None:
+        """Cache a time x feature_id frame as a new batch file."""
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        ofile = f"batch_{len(set(self.manifest.values())):05d}.arrow"
+        columns = {"value_time": pa.array(df.index.values)}
+        for f in df.columns:
+            columns[str(int(f))] = pa.array(df[f].to_numpy(dtype=np.float32))
+        table = pa.table(columns)
+        with pa.OSFile(str(self.cache_dir / ofile), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+        # Update manifest last and atomically, so interrupted writes are not
+        # referenced
+        self.manifest.update({str(int(f)): ofile for f in df.columns})
+        partial = self.manifest_path.with_suffix(".partial")
+        with partial.open("w", encoding="utf-8") as fo:
+            json.dump(self.manifest, fo)
+        os.replace(partial, self.manifest_path)
+
+    def read(
+        self,
+        feature_ids: Iterable[int],
+        start: Optional[pd.Timestamp] = None,
+        end: Optional[pd.Timestamp] = None
+    ) -> pd.DataFrame:
+        """Read cached features as a time x feature_id DataFrame."""
+        # Group requested features by batch file
+        feature_ids = [int(f) for f in feature_ids]
+        batches: dict[str, list[int]] = {}
+        for f in feature_ids:
+            batches.setdefault(self.manifest[str(f)], []).append(f)
+
+        # Memory-map batches and take column buffers without copying
+        series = {}
+        index = None
+        for ifile, features in batches.items():
+            source = pa.memory_map(str(self.cache_dir / ifile), "r")
+            table = pa.ipc.open_file(source).read_all()
+            times = table.column("value_time").to_numpy()
+            lo = 0 if start is None else np.searchsorted(times, np.datetime64(pd.Timestamp(start)))
+            hi = len(times) if end is None else np.searchsorted(
+                times, np.datetime64(pd.Timestamp(end)), side="right")
+            if index is None:
+                index = pd.DatetimeIndex(times[lo:hi], name="value_time")
+            for f in features:
+                series[f] = table.column(str(f)).to_numpy()[lo:hi]
+
+        return pd.DataFrame(series, index=index,
+            columns=pd.Index(feature_ids, name="feature_id"))
+
+def get_retrospective(
+    feature_ids: Iterable[int],
+    cache_dir: Path = Path("NWM_data"),
+    url: str = RETROSPECTIVE_URL,
+    start: Optional[pd.Timestamp] = None,
+    end: Optional[pd.Timestamp] = None,
+    batch_size: int = 1000,
+    max_workers: int = 8,
+    storage_options: Optional[dict] = None
+) -> pd.DataFrame:
+    """Return NWM retrospective streamflow for many features as a
+    time x feature_id DataFrame in m^3/s, retrieving only features that are
+    not already cached.
+
+    Parameters
+    ----------
+    feature_ids: iterable of int
+        NWM channel feature IDs.
+    cache_dir: pathlib.Path, optional
+        Local cache directory.
+    url: str, optional
+        Zarr store URL, e.g. a local fixture path.
+    start, end: pandas.Timestamp, optional
+        Period to return. The full record is always cached.
+    batch_size: int, optional
+        Maximum number of features retrieved and cached per batch file.
+    max_workers: int, optional
+        Concurrent chunk reads.
+    storage_options: dict, optional
+        fsspec options passed to the Zarr backend.
+    """
+    feature_ids = list(dict.fromkeys(int(f) for f in feature_ids))
+    cache = RetrospectiveCache(cache_dir)
+
+    # Retrieve missing features, opening the store once
+    missing = cache.missing(feature_ids)
+    if missing:
+        ds = open_retrospective(url, storage_options)
+        for b in range(0, len(missing), batch_size):
+            cache.write(read_features(ds, missing[b:b + batch_size], max_workers=max_workers))
+
+    return cache.read(feature_ids, start=start, end=end)
+
+def make_fixture(
+    ofile: Path,
+    n_features: int = 50,
+    n_times: int = 24 * 90,
+    chunks: tuple[int, int] = (672, 16),
+    seed: int = 0
+) -> xr.Dataset:
+    """Write a small local CHRTOUT-like Zarr store with the same layout
+    as the retrospective store, for offline testing."""
+    rng = np.random.default_rng(seed)
+    ds = xr.Dataset(
+        {"streamflow": (("time", "feature_id"),
+            rng.lognormal(0.0, 1.0, (n_times, n_features)).round(2))},
+        coords={
+            "time": pd.date_range("1979-02-01", periods=n_times, freq="1h"),
+            "feature_id": np.sort(rng.choice(np.arange(1, 30 * n_features), n_features, replace=False))
+        }
+    )
+    encoding = {"streamflow": {"chunks": chunks}}
+    ds.to_zarr(ofile, mode="w", consolidated=True, encoding=encoding)
+    return ds
+
+def main(workdir: Optional[Path] = None):
+    """Check batch retrieval and caching against a local Zarr fixture, by
+    default in a temporary directory removed afterwards."""
+    if workdir is None:
+        from tempfile import TemporaryDirectory
+        with TemporaryDirectory() as tmp:
+            return main(Path(tmp))
+    workdir = Path(workdir)
+
+    # Build fixture
+    expected = make_fixture(workdir / "chrtout.zarr")
+    ids = expected["feature_id"].values
+    request = [int(ids[i]) for i in (3, 40, 0, 17, 16, 41)]
+
+    # First call reads the store, second call only the cache
+    for label in ("store", "cache"):
+        df = get_retrospective(request, cache_dir=workdir / "cache",
+            url=str(workdir / "chrtout.zarr"), batch_size=4)
+        reference = expected["streamflow"].sel(feature_id=request).values.astype(np.float32)
+        assert np.array_equal(df.values, reference), f"Mismatch reading from {label}"
+        print(f"Read {df.shape[1]} features x {df.shape[0]} hours from {label}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Hierarchical rollup of site evaluation results.
+
+Site results carry summed statistics (the STATISTICS of
+forecast_verification: counts, sums, sums of squares and products, and
+contingency counts), so every coarser level is the sum of its sites and
+metrics are recomputed from the sums instead of averaging site ratios. All
+levels (site, county, state, SVI bin, nation) are summed in one bincount
+pass over a stacked label array and kept in one small frame indexed by
+(level, key):
+
+    cube = RollupCube.build(ct, fips=ct["fips"], svi=ct["svi"])
+    counties = cube.level("county")
+    cube.save("evaluation_rollup.arrow")
+
+The counties of a state share the first two FIPS digits, and SVI bins are
+equal-width bins of the SVI rank on [0, 1].
+"""
+from typing import Optional, Union
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from .forecast_verification import STATISTICS, cell_statistics, metrics_from_statistics
+from .scheduler import write_result, read_result
+
+LEVELS: tuple[str, ...] = ("site", "county", "state", "svi_bin", "nation")
+
+def level_keys(
+    sites: pd.Index,
+    fips: npt.NDArray[np.float64],
+    svi: npt.NDArray[np.float64],
+    svi_bins: int = 10
+) -> dict[str, npt.NDArray[np.object_]]:
+    """Group key of every site at every level, None where unknown."""
+    known = ~np.isnan(fips)
+    county = np.where(known, np.nan_to_num(fips), 0).astype(np.int64)
+    ranked = ~np.isnan(svi)
+    edge = np.clip(np.floor(np.nan_to_num(svi) * svi_bins), 0, svi_bins - 1) / svi_bins
+    return {
+        "site": np.asarray(sites.astype(str), dtype=object),
+        "county": np.where(known, [f"{c:05d}" for c in county], None),
+        "state": np.where(known, [f"{c // 1000:02d}" for c in county], None),
+        "svi_bin": np.where(ranked, [f"{e:.2f}" for e in edge], None),
+        "nation": np.full(len(sites), "US", dtype=object)
+    }
+
+class RollupCube:
+    """Summed statistics and metrics of every group of every level, in a
+    frame indexed by (level, key)."""
+
+    def __init__(self, frame: pd.DataFrame):
+        self.frame = frame
+
+    @classmethod
+    def build(
+        cls,
+        stats: pd.DataFrame,
+        fips: Union[pd.Series, npt.ArrayLike],
+        svi: Union[pd.Series, npt.ArrayLike],
+        svi_bins: int = 10,
+        levels: tuple[str, ...] = LEVELS
+    ) -> "RollupCube":
+        """Roll site statistics (one row per site, STATISTICS columns) up to
+        every level. fips (integer county code) and svi (rank) are aligned
+        with the rows of stats; sites with a missing (negative or NaN) FIPS
+        or SVI are left out of the levels that need them."""
+        sums = stats.reindex(columns=list(STATISTICS)).fillna(0.0).to_numpy(dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            fips = np.array(fips, dtype=np.float64)
+            fips[fips < 0.0] = np.nan
+            svi = np.array(svi, dtype=np.float64)
+            svi[svi < 0.0] = np.nan
+        keys = level_keys(stats.index, fips, svi, svi_bins)
+
+        # Stacked labels, one block of sites per level
+        labels, index = [], []
+        offset = 0
+        for level in levels:
+            key = keys[level]
+            known = np.flatnonzero(key != None)
+            codes, groups = pd.factorize(key[known], sort=True)
+            label = np.full(len(key), -1, dtype=np.int64)
+            label[known] = codes + offset
+            labels.append(label)
+            index += [(level, g) for g in groups]
+            offset += len(groups)
+        labels = np.concatenate(labels)
+        keep = labels >= 0
+        labels = labels[keep]
+        rows = np.tile(np.arange(len(stats)), len(levels))[keep]
+
+        # One bincount per statistic over all levels
+        totals = np.stack([np.bincount(labels, weights=sums[rows, i], minlength=offset)
+            for i in range(len(STATISTICS))])
+        n_sites = np.bincount(labels, minlength=offset)
+        rated = ~np.isnan(svi[rows])
+        svi_mean = np.bincount(labels[rated], weights=svi[rows][rated], minlength=offset) / \
+            np.maximum(np.bincount(labels[rated], minlength=offset), 1)
+        svi_mean[np.bincount(labels[rated], minlength=offset) == 0] = np.nan
+
+        frame = pd.DataFrame(dict(zip(STATISTICS, totals)),
+            index=pd.MultiIndex.from_tuples(index, names=["level", "key"]))
+        frame.insert(0, "sites", n_sites)
+        frame.insert(1, "svi", svi_mean)
+        metrics = metrics_from_statistics(totals)
+        for name in ["mean_error", "mean_absolute_error", "root_mean_squared_error",
+                "pearson_r", "nash_sutcliffe_efficiency", "kling_gupta_efficiency",
+                "POD", "POFA", "TS"]:
+            frame[name] = metrics[name]
+        return cls(frame)
+
+    def level(self, level: str) -> pd.DataFrame:
+        """Rows of one level, indexed by key."""
+        return self.frame.xs(level, level="level")
+
+    def get(self, level: str, key: str) -> pd.Series:
+        return self.frame.loc[(level, key)]
+
+    def save(self, path: Union[str, Path]) -> None:
+        write_result(Path(path), self.frame, "rollup")
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Optional["RollupCube"]:
+        if not Path(path).exists():
+            return None
+        frame = read_result(Path(path))
+        return None if frame is None else cls(frame)
+
+def main():
+    """Compare with per-level pandas groupby sums on synthetic site results."""
+    from time import perf_counter
+    rng = np.random.default_rng(2024)
+    n_sites = 8000
+    sites = pd.Index([f"{i:08d}" for i in range(n_sites)], name="usgs_site_code")
+    fips = rng.choice(rng.integers(1001, 56045, 2000), n_sites).astype(np.float64)
+    fips[rng.random(n_sites) < 0.02] = np.nan
+    county_svi = pd.Series(rng.random(60000))
+    svi = county_svi.reindex(np.nan_to_num(fips).astype(int)).to_numpy().copy()
+    svi[np.isnan(fips)] = np.nan
+
+    # Site statistics of 240 hourly pairs per site
+    cells = np.repeat(np.arange(n_sites), 240)
+    obs = rng.lognormal(3.0, 0.8, len(cells))
+    sim = obs * rng.lognormal(0.0, 0.3, len(cells))
+    threshold = np.repeat(rng.lognormal(3.5, 0.5, n_sites), 240)
+    stats = pd.DataFrame(cell_statistics(cells, n_sites, sim, obs, threshold).T,
+        index=sites, columns=list(STATISTICS))
+
+    start = perf_counter()
+    cube = RollupCube.build(stats, fips, svi)
+    print(f"Rollup: {perf_counter() - start:.3f} s, {len(cube.frame)} groups")
+
+    # Reference sums, one groupby per level
+    df = stats.assign(fips=fips, svi=svi).dropna(subset=["fips"])
+    county = df.groupby(df["fips"].astype(int).map("{:05d}".format))[list(STATISTICS)].sum()
+    state = df.groupby((df["fips"] // 1000).astype(int).map("{:02d}".format))[list(STATISTICS)].sum()
+    for name, expected in [("county", county), ("state", state)]:
+        result = cube.level(name)[list(STATISTICS)]
+        pd.testing.assert_frame_equal(result, expected, check_names=False)
+    nation = cube.get("nation", "US")
+    assert np.allclose(nation[list(STATISTICS)].to_numpy(dtype=float), stats.sum().to_numpy())
+    assert cube.level("svi_bin")["sites"].sum() == np.isfinite(svi).sum()
+
+    # Ratios of sums, not means of ratios
+    tp, fp, fn = (cube.level("state")[c] for c in ["true_positive", "false_positive", "false_negative"])
+    assert np.allclose(cube.level("state")["TS"], tp / (tp + fp + fn))
+    print(cube.level("svi_bin")[["sites", "svi", "TS", "nash_sutcliffe_efficiency"]])
+
+if __name__ == "__main__":
+    main()
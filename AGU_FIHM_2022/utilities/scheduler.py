@@ -0,0 +1,247 @@
+"""
+Restartable task graphs for long evaluation runs.
+
+A run is split into tasks (for example one per chunk of sites), each with a
+key, a function, its arguments, and the keys of the tasks whose results it
+takes as inputs. Every task's result is written to its own Arrow IPC file
+and its status to a JSON manifest as soon as it finishes, so an interrupted
+or partly failed run resumes with only the unfinished tasks. Tasks whose
+inputs are ready run concurrently on the shared execution backend.
+
+    scheduler = TaskScheduler("tasks")
+    scheduler.run([
+        Task("obs/0", fetch_obs, args=(sites[:100],)),
+        Task("pairs/0", make_pairs, depends=("sim", "obs/0"))
+    ])
+    pairs = scheduler.result("pairs/0")
+
+Results must be pyarrow Tables, pandas DataFrames, or None. A finished
+task is rerun if its function or arguments change, or if any task upstream
+of it changes.
+"""
+from typing import Any, Callable, Iterable, Optional, Union
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+import hashlib
+import json
+import os
+import pickle
+
+import pandas as pd
+import pyarrow as pa
+
+from . import execution
+
+Result = Optional[Union[pa.Table, pd.DataFrame]]
+
+@dataclass
+class Task:
+    key: str
+    func: Callable[..., Result]
+    args: tuple = ()
+    kwargs: dict[str, Any] = field(default_factory=dict)
+    depends: tuple[str, ...] = ()
+
+    def signature(self, inputs: tuple[Optional[str], ...] = ()) -> str:
+        """Hash of the function, arguments, and inputs of this task. inputs
+        holds the signatures of the tasks in depends, so a change upstream
+        changes the signature of every task downstream."""
+        spec = (self.func.__module__, self.func.__qualname__, self.args,
+            sorted(self.kwargs.items()), self.depends, tuple(inputs))
+        return hashlib.sha1(pickle.dumps(spec)).hexdigest()
+
+def write_result(path: Path, result: Result, signature: str) -> None:
+    """Write a task result to an Arrow IPC file, replacing any previous result
+    only once the new file is complete."""
+    if isinstance(result, pd.DataFrame):
+        kind, table = "pandas", pa.Table.from_pandas(result, preserve_index=True)
+    elif isinstance(result, pa.Table):
+        kind, table = "arrow", result
+    elif result is None:
+        kind, table = "none", pa.table({})
+    else:
+        raise TypeError(f"Unsupported task result: {type(result).__name__}")
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        b"task_kind": kind.encode(),
+        b"task_signature": signature.encode()
+    })
+    path.parent.mkdir(exist_ok=True, parents=True)
+    partial = path.with_suffix(".partial")
+    with pa.OSFile(str(partial), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(partial, path)
+
+def read_signature(path: Path) -> Optional[str]:
+    """Signature stored with a task result, None if there is no result."""
+    if not path.exists():
+        return None
+    with pa.memory_map(str(path), "r") as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    return metadata.get(b"task_signature", b"").decode() or None
+
+def read_result(path: Path) -> Result:
+    """Read a task result. Arrow results are memory-mapped, not copied."""
+    table = pa.ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+    kind = table.schema.metadata[b"task_kind"].decode()
+    if kind == "pandas":
+        return table.to_pandas()
+    if kind == "none":
+        return None
+    return table
+
+def _run_task(item: tuple[str, Task, str]) -> dict[str, Any]:
+    workdir, task, signature = item
+    scheduler = TaskScheduler(workdir)
+    start = perf_counter()
+    try:
+        inputs = [scheduler.result(d) for d in task.depends]
+        result = task.func(*inputs, *task.args, **task.kwargs)
+        write_result(scheduler.result_path(task.key), result, signature)
+    except Exception as e:
+        return {"key": task.key, "status": "failed", "seconds": perf_counter() - start,
+            "error": f"{type(e).__name__}: {e}"}
+    return {"key": task.key, "status": "done", "seconds": perf_counter() - start, "error": None}
+
+class TaskScheduler:
+    """Runs tasks with results and statuses persisted under workdir."""
+    manifest_name: str = "manifest.json"
+
+    def __init__(self, workdir: Union[str, Path]):
+        self.workdir = Path(workdir)
+        self.manifest_path = self.workdir / self.manifest_name
+        if self.manifest_path.exists():
+            with self.manifest_path.open("r", encoding="utf-8") as fi:
+                self.manifest: dict[str, dict[str, Any]] = json.load(fi)
+        else:
+            self.manifest = {}
+
+    def result_path(self, key: str) -> Path:
+        """Result file of a task key, e.g. pairs/0 -> results/pairs/0.arrow."""
+        return self.workdir / "results" / f"{key}.arrow"
+
+    def result(self, key: str) -> Result:
+        """Load the result of a finished task."""
+        return read_result(self.result_path(key))
+
+    def signatures(self, tasks: dict[str, Task]) -> dict[str, str]:
+        """Signature of every task, from its own spec and the signatures of
+        its inputs: those of the tasks given, or those stored with the
+        results of other tasks."""
+        signatures: dict[str, str] = {}
+
+        def visit(key: str, path: tuple[str, ...]) -> Optional[str]:
+            if key not in tasks:
+                return read_signature(self.result_path(key))
+            if key in path:
+                raise ValueError(f"Task dependency cycle: {' -> '.join(path + (key,))}")
+            if key not in signatures:
+                task = tasks[key]
+                signatures[key] = task.signature(tuple(visit(d, path + (key,)) for d in task.depends))
+            return signatures[key]
+
+        for key in tasks:
+            visit(key, ())
+        return signatures
+
+    def is_done(self, task: Task, signature: Optional[str] = None) -> bool:
+        """True if the task has a result for its current function, arguments,
+        and inputs (by default, the stored results of its dependencies)."""
+        if signature is None:
+            signature = self.signatures({task.key: task})[task.key]
+        return read_signature(self.result_path(task.key)) == signature
+
+    def save_manifest(self) -> None:
+        self.workdir.mkdir(exist_ok=True, parents=True)
+        partial = self.manifest_path.with_suffix(".partial")
+        with partial.open("w", encoding="utf-8") as fo:
+            json.dump(self.manifest, fo, indent=1)
+        os.replace(partial, self.manifest_path)
+
+    def run(self, tasks: Iterable[Task]) -> dict[str, str]:
+        """Run every unfinished task once its inputs are ready.
+
+        Tasks are run in rounds: each round submits all tasks whose inputs
+        are finished to the execution backend and records every outcome in
+        the manifest. Failed tasks do not stop the run, but tasks that
+        depend on them are left blocked.
+
+        Returns the status of every task: done, failed, or blocked.
+        """
+        tasks = {t.key: t for t in tasks}
+        signatures = self.signatures(tasks)
+        status = {k: "done" if self.is_done(t, signatures[k]) else "pending"
+            for k, t in tasks.items()}
+
+        def ready(task: Task) -> bool:
+            return all(
+                status[d] == "done" if d in status else self.result_path(d).exists()
+                for d in task.depends
+            )
+
+        while True:
+            # Tasks with all inputs finished
+            batch = [t for k, t in tasks.items() if status[k] == "pending" and ready(t)]
+            if not batch:
+                break
+
+            # Run and record outcomes
+            outcomes = execution.get_backend().map(
+                _run_task, [(str(self.workdir), t, signatures[t.key]) for t in batch])
+            updated = datetime.now(timezone.utc).isoformat()
+            for outcome in outcomes:
+                status[outcome["key"]] = outcome["status"]
+                self.manifest[outcome["key"]] = {**outcome, "updated": updated}
+            self.save_manifest()
+
+        # Tasks left pending depend on failed tasks
+        for k, s in status.items():
+            if s == "pending":
+                status[k] = "blocked"
+                self.manifest[k] = {"key": k, "status": "blocked", "seconds": 0.0,
+                    "error": None, "updated": datetime.now(timezone.utc).isoformat()}
+            elif s == "done" and self.manifest.get(k, {}).get("status") != "done":
+                self.manifest[k] = {"key": k, "status": "done", "seconds": 0.0,
+                    "error": None, "updated": datetime.now(timezone.utc).isoformat()}
+        self.save_manifest()
+        return status
+
+def _constant(value: float) -> pa.Table:
+    return pa.table({"value": [value]})
+
+def _double(table: pa.Table) -> pa.Table:
+    return pa.table({"value": [2.0 * table["value"][0].as_py()]})
+
+def main():
+    """Run a two task graph, change the upstream argument, and check that
+    the downstream task reruns while an unchanged graph does not."""
+    from tempfile import mkdtemp
+    workdir = mkdtemp()
+
+    def graph(value: float) -> list[Task]:
+        return [Task("a", _constant, args=(value,)), Task("b", _double, depends=("a",))]
+
+    scheduler = TaskScheduler(workdir)
+    scheduler.run(graph(1.0))
+    assert scheduler.result("b")["value"][0].as_py() == 2.0
+    stored = read_signature(scheduler.result_path("b"))
+    TaskScheduler(workdir).run(graph(1.0))
+    assert read_signature(scheduler.result_path("b")) == stored
+
+    # New upstream argument, run with the whole graph
+    scheduler = TaskScheduler(workdir)
+    assert scheduler.run(graph(3.0)) == {"a": "done", "b": "done"}
+    assert scheduler.result("b")["value"][0].as_py() == 6.0
+
+    # Upstream rerun on its own, the downstream task is stale until rerun
+    assert scheduler.run(graph(5.0)[:1]) == {"a": "done"}
+    assert not scheduler.is_done(graph(5.0)[1])
+    assert scheduler.run(graph(5.0)[1:]) == {"b": "done"}
+    assert scheduler.result("b")["value"][0].as_py() == 10.0
+    print("Downstream tasks rerun when an upstream task changes")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Compact, memory-mapped lookup table of county Social Vulnerability Index (SVI)
+ranks keyed by integer FIPS code.
+
+The index is built once from the per-state GeoJSON files cached by the
+evaluation workflow and saved as a sorted numpy structured array. Loading
+it is a memory-map and joining it to sites is a binary search.
+"""
+from typing import Iterable
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+import geopandas as gpd
+
+SVI_DTYPE = np.dtype([("fips", "<i4"), ("rank", "<f4"), ("value", "<f4")])
+MISSING_FIPS: int = -1
+
+def read_attributes(path: Path) -> pd.DataFrame:
+    """Read only the attribute table of a GeoJSON file, skipping geometry construction."""
+    return pd.DataFrame(gpd.read_file(path, ignore_geometry=True))
+
+def build_svi_index(frames: Iterable[pd.DataFrame], ofile: Path) -> np.ndarray:
+    """Build and save a sorted SVI index from SVIClient attribute tables.
+
+    Only the overall "svi" theme is kept. Returns the memory-mapped index.
+    """
+    # Combine themes
+    df = pd.concat(frames, ignore_index=True)
+    df = df[df["theme"] == "svi"]
+
+    # Convert to compact types
+    index = np.empty(len(df), dtype=SVI_DTYPE)
+    index["fips"] = pd.to_numeric(df["fips"], errors="coerce").fillna(MISSING_FIPS).to_numpy()
+    index["rank"] = pd.to_numeric(df["rank"], errors="coerce").to_numpy()
+    index["value"] = pd.to_numeric(df["value"], errors="coerce").to_numpy()
+
+    # Sort and drop duplicate counties
+    index = index[index["fips"] != MISSING_FIPS]
+    index = index[np.argsort(index["fips"], kind="stable")]
+    index = index[np.concatenate(([True], np.diff(index["fips"]) != 0))]
+
+    # Save
+    Path(ofile).parent.mkdir(exist_ok=True, parents=True)
+    np.save(ofile, index)
+    return load_svi_index(ofile)
+
+def load_svi_index(ifile: Path) -> np.ndarray:
+    """Memory-map a saved SVI index."""
+    return np.load(ifile, mmap_mode="r")
+
+def encode_fips(fips: pd.Series) -> npt.NDArray[np.int32]:
+    """Convert string FIPS codes to int32, missing codes become MISSING_FIPS."""
+    return pd.to_numeric(fips, errors="coerce").fillna(MISSING_FIPS).to_numpy(dtype=np.int32)
+
+def lookup_rank(index: np.ndarray, fips: npt.NDArray[np.int32]) -> npt.NDArray[np.float32]:
+    """Look up the SVI rank of every FIPS code, NaN if the county is not indexed."""
+    keys = index["fips"]
+    position = np.clip(np.searchsorted(keys, fips), 0, max(len(keys) - 1, 0))
+    found = (len(keys) > 0) & (keys[position] == fips)
+    return np.where(found, index["rank"][position], np.float32(np.nan))
+
+def attach_svi(
+    site_codes: pd.Series,
+    site_fips: pd.Series,
+    index: np.ndarray
+) -> tuple[npt.NDArray[np.int32], npt.NDArray[np.float32]]:
+    """Join site codes to county FIPS codes and SVI ranks.
+
+    The join is resolved once per unique site and broadcast to every row
+    with the integer site codes.
+
+    Parameters
+    ----------
+    site_codes: pandas.Series
+        Site code of every row, e.g. pairs["usgs_site_code"].
+    site_fips: pandas.Series
+        String FIPS code indexed by site code, e.g. get_site_data()["fips"].
+    index: numpy.ndarray
+        SVI index as returned by load_svi_index.
+
+    Returns
+    -------
+    Tuple of int32 FIPS codes and float32 SVI ranks, one per row.
+    """
+    # Resolve each unique site once
+    site_fips = site_fips[~site_fips.index.duplicated()]
+    codes, sites = pd.factorize(site_codes.astype(str))
+    position = pd.Index(site_fips.index.astype(str)).get_indexer(sites)
+    fips = encode_fips(site_fips).take(position)
+    fips[position < 0] = MISSING_FIPS
+    rank = lookup_rank(index, fips)
+
+    # Broadcast to rows
+    return fips[codes], rank[codes]
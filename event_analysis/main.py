@@ -2,40 +2,79 @@
 from hydrotools.nwis_client.iv import IVDataService
 from hydrotools.events.event_detection import decomposition as ev
 import matplotlib.pyplot as plt
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter, process_time
+import cProfile
+import json
+import os
+
+@contextmanager
+def stage(name, rows=None):
+    # Time a block of code, as AGU_FIHM_2022/utilities/profiling.py: one
+    # JSON line per stage appended to WORKFLOW_TRACE, and a cProfile dump
+    # per stage in WORKFLOW_PROFILE_DIR
+    record = {"stage": name, "rows": rows}
+    profile_dir = os.environ.get("WORKFLOW_PROFILE_DIR")
+    profiler = cProfile.Profile() if profile_dir else None
+    wall_start = perf_counter()
+    cpu_start = process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+            Path(profile_dir).mkdir(exist_ok=True, parents=True)
+            profiler.dump_stats(Path(profile_dir) / f"{name}.{os.getpid()}.prof")
+        record["wall_seconds"] = perf_counter() - wall_start
+        record["cpu_seconds"] = process_time() - cpu_start
+        trace = os.environ.get("WORKFLOW_TRACE")
+        if trace:
+            with open(trace, "a", encoding="utf-8") as fo:
+                fo.write(json.dumps(record) + "\n")
 
 def main():
     # Retrieve streamflow observations for Little Hope Creek
-    client = IVDataService(value_time_label="value_time")
-    observations = client.get(
-        sites='02146470', 
-        startDT='2019-10-01', 
-        endDT='2020-09-30'
-        )
+    with stage("get_obs") as record:
+        client = IVDataService(value_time_label="value_time")
+        observations = client.get(
+            sites='02146470', 
+            startDT='2019-10-01', 
+            endDT='2020-09-30'
+            )
+        record["rows"] = len(observations)
 
-    # Drop extra columns to be more efficient
-    observations = observations[['value_time', 'value']]
+    with stage("resample_obs") as record:
+        # Drop extra columns to be more efficient
+        observations = observations[['value_time', 'value']]
 
-    # Check for duplicate time series, keep first by default
-    observations = observations.drop_duplicates(subset=['value_time'])
+        # Check for duplicate time series, keep first by default
+        observations = observations.drop_duplicates(subset=['value_time'])
 
-    # Resample to hourly, keep first measurement in each 1-hour bin
-    observations = observations.set_index('value_time')
-    observations = observations.resample('h').first().ffill()
+        # Resample to hourly, keep first measurement in each 1-hour bin
+        observations = observations.set_index('value_time')
+        observations = observations.resample('h').first().ffill()
+        record["rows"] = len(observations)
 
     # Detect events
-    events = ev.list_events(
-        observations['value'],
-        halflife='6H', 
-        window='7D',
-        minimum_event_duration='6H',
-        start_radius='7H'
-    )
+    with stage("list_events") as record:
+        events = ev.list_events(
+            observations['value'],
+            halflife='6H', 
+            window='7D',
+            minimum_event_duration='6H',
+            start_radius='7H'
+        )
+        record["rows"] = len(events)
 
     # Compute peak discharge for each event
-    events['peak'] = events.apply(
-        lambda e: observations['value'].loc[e.start:e.end].max(), 
-        axis=1
-        )
+    with stage("event_peaks", rows=len(events)):
+        events['peak'] = events.apply(
+            lambda e: observations['value'].loc[e.start:e.end].max(), 
+            axis=1
+            )
     print(observations)
     quit()
     # Plot a histogram of peak discharge values